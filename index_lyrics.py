@@ -11,6 +11,8 @@ Output: data/indexed_lyrics.csv
 # project imports
 from scrape_lyrics import make_lyric_file_name, CSV_MUSIXMATCH_MAPPING
 from utils import read_file_contents, configure_logging, logger
+from track_catalog import TrackCatalog, MXM_GROUP, INDEX_GROUP, COLUMN_GROUPS, artist_partition
+from song_registry import SONG_ID_COL
 
 # python and package imports
 from langdetect.lang_detect_exception import LangDetectException
@@ -32,13 +34,24 @@ def add_col_if_dne(df, col, value):
     return df
 
 
-def index_lyrics(csv_input, csv_output, artist_first_letter=None):
-
-    logger.info('Reading in input csv {0}'.format(csv_input))
+def index_lyrics(csv_input, csv_output, artist_first_letter=None, catalog_dir=None):
 
     start = time.time()
 
-    df = pd.read_csv(csv_input, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
+    catalog = None
+    if catalog_dir:
+        # read the mxm group (and our own group, if a previous run wrote one) instead of the csv
+        logger.info('Reading in track catalog {0}'.format(catalog_dir))
+        catalog = TrackCatalog(catalog_dir)
+        cols = catalog.columns(MXM_GROUP)
+        if catalog.has_group(INDEX_GROUP):
+            cols += catalog.columns(INDEX_GROUP)
+        # a single-letter run only loads its own artist partition
+        partitions = [artist_partition(artist_first_letter)] if artist_first_letter else None
+        df = catalog.read(cols, partitions)
+    else:
+        logger.info('Reading in input csv {0}'.format(csv_input))
+        df = pd.read_csv(csv_input, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
     # if starting from mxm_mapping csv, we need to add additional cols
     df = add_col_if_dne(df, 'is_english', -1)
     df = add_col_if_dne(df, 'lyrics_available', -1)
@@ -130,9 +143,12 @@ def index_lyrics(csv_input, csv_output, artist_first_letter=None):
         print(txt_lyricfile, contents)
         raise e
 
-    logger.info('saving indexed lyric data to {0}'.format(csv_output))
     df = df.sort_values('msd_artist')
-    df.to_csv(csv_output, encoding='utf-8', index=False)
+    if catalog:
+        catalog.write_group(INDEX_GROUP, df[[SONG_ID_COL] + COLUMN_GROUPS[INDEX_GROUP]], replace=not artist_first_letter)
+    else:
+        logger.info('saving indexed lyric data to {0}'.format(csv_output))
+        df.to_csv(csv_output, encoding='utf-8', index=False)
 
     end = time.time()
     elapsed_time = end - start
@@ -158,11 +174,12 @@ def parse_args():
     parser.add_argument('-a', '--artist-first-letter', action='store', required=False, default=None, help='Attempt to index lyrics only for artists that start with this letter.')
     parser.add_argument('-i', '--csv-input', action='store', required=False, default=CSV_MUSIXMATCH_MAPPING, help='Artist-Song mapping csv')
     parser.add_argument('-o', '--csv-output', action='store', required=False, default=CSV_INDEX_LYRICS, help='csv to write to (WARNING: will overwite)')
+    parser.add_argument('-c', '--catalog-dir', action='store', required=False, default=None, help='read from and write the index column group to this track catalog instead of csvs')
 
     args = parser.parse_args()
 
     # simple arg sanity check
-    if os.path.exists(args.csv_output):
+    if not args.catalog_dir and os.path.exists(args.csv_output):
         logger.warning('Output CSV "{0}" will be overwritten'.format(args.csv_output))
         while True:
             response = input('Is this okay? Please enter Y/N:').lower()
@@ -182,7 +199,7 @@ def main():
 
     configure_logging(logname='index_lyrics')
     args = parse_args()
-    index_lyrics(args.csv_input, args.csv_output, args.artist_first_letter)
+    index_lyrics(args.csv_input, args.csv_output, args.artist_first_letter, args.catalog_dir)
 
     return
 
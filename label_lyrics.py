@@ -17,17 +17,26 @@ import os
 import sys
 import time
 import json
+import glob
+import shutil
 import sqlite3
+import hashlib
 import argparse
+from urllib.parse import quote, unquote
+import numpy as np
 import pandas as pd
-from utils import configure_logging, logger
+from utils import configure_logging, logger, full_elapsed_time_str
 from index_lyrics import CSV_INDEX_LYRICS, add_col_if_dne
+from lastfm_tags import LASTFM_TAGS_DB, LASTFM_TAG_GRAPH_DIR, LastfmTagGraph
+from track_catalog import TrackCatalog, KEY_COL, ARTIST_COL, MXM_GROUP, INDEX_GROUP, LABEL_GROUP, COLUMN_GROUPS, artist_partition
+from song_registry import SONG_ID_COL
 
 
 CSV_LABELED_LYRICS = 'data/labeled_lyrics.csv'
 CSV_LABELED_LYRICS_EXPANDED = 'data/labeled_lyrics_expanded.csv'
-LASTFM_TAGS_DB = 'data/lastfm_tags.db'
 MOOD_UNKNOWN_KEY = 'unknown'
+CHECKPOINT_EVERY = 5000
+SHARD_PREFIX = 'artist-'
 
 
 # from Table 2 on pg 413 of http://www.ismir2009.ismir.net/proceedings/PS3-4.pdf
@@ -108,6 +117,44 @@ count_labeled = 0
 total_rows = 0
 
 
+def score_tags_for_mood(tags, submood_lists):
+    """
+    Scores one mood of the expanded taxonomy against a song's tags
+
+    Args:
+        tags: pd.Series of str, the song's tags
+        submood_lists: list, the mood's entry in MOOD_CATEGORIES_EXPANDED
+
+    Returns: int, number of tags that match a "like" but none of the "filters"
+    """
+    score = 0
+    for likemood in submood_lists[1]:
+        #print('\tlikemood={}'.format(likemood))
+        # how many tags contain this like-tag?
+        liketags = tags[tags.str.contains(likemood)]
+        if len(liketags) > 0:
+            # do any of the matched like-tags match the filters? if yes, we don't want them 
+            matched_filter = 0
+            for filtermood in submood_lists[2]:
+                matched_filter += liketags.str.count(filtermood).sum()
+            matched_likemoods = len(liketags) - matched_filter
+            score += matched_likemoods
+    return score
+
+
+def pick_mood(mood_scoreboard):
+    """
+    Returns: str, the first mood with the highest positive score or MOOD_UNKNOWN_KEY
+    """
+    matched_mood = MOOD_UNKNOWN_KEY
+    max_score = 0
+    for mood, score in mood_scoreboard.items():
+        if score > max_score:
+            matched_mood = mood
+            max_score = score
+    return matched_mood
+
+
 def match_song_tags_to_mood_expanded(tags):
     """
     With expanded moods, we run the risk of multiple moods being found
@@ -122,32 +169,99 @@ def match_song_tags_to_mood_expanded(tags):
     # first, check if expanded moods are populated
     if not MOOD_CATEGORIES_EXPANDED and len(MOOD_CATEGORIES_EXPANDED) <= 0:
         raise("error! MOOD_CATEGORIES_EXPANDED is not initialized")
-    matched_mood = MOOD_UNKNOWN_KEY
     mood_scoreboard = dict.fromkeys(MOOD_CATEGORIES_EXPANDED.keys(), 0)
     for mood, submood_lists in MOOD_CATEGORIES_EXPANDED.items():
         #print('mood={0}'.format(mood))
-        for likemood in submood_lists[1]:
-            #print('\tlikemood={}'.format(likemood))
-            # how many tags contain this like-tag?
-            liketags = tags[tags.str.contains(likemood)]
-            if len(liketags) > 0:
-                # do any of the matched like-tags match the filters? if yes, we don't want them 
-                matched_filter = 0
-                for filtermood in submood_lists[2]:
-                    matched_filter += liketags.str.count(filtermood).sum()
-                matched_likemoods = len(liketags) - matched_filter
-                mood_scoreboard[mood] += matched_likemoods
-    max_score = 0
-    for mood, score in mood_scoreboard.items():
-        if score > max_score:
-            matched_mood = mood
-            max_score = score
+        mood_scoreboard[mood] += score_tags_for_mood(tags, submood_lists)
+    matched_mood = pick_mood(mood_scoreboard)
     #print('matched_mood = ', matched_mood)
     #print('mood_scoreboard = {0}'.format(mood_scoreboard))
     return matched_mood, mood_scoreboard
 
 
-def get_mood_for_track(msd_id, lyrics_filename, conn, expanded_moods):
+def get_taxonomy(expanded_moods):
+    return MOOD_CATEGORIES_EXPANDED if expanded_moods else MOOD_CATEGORIES
+
+
+def taxonomy_hash(taxonomy):
+    """
+    Content hash of a mood taxonomy; any edit to a mood or its lists changes it
+
+    Returns: str, hex digest
+    """
+    return hashlib.sha1(json.dumps(taxonomy, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def taxonomy_path(labeled_csv, shard=None):
+    """
+    The taxonomy used to label a csv is stored alongside it. Shards that label part of a
+    shared output (see checkpoint_shard) each store their own.
+    """
+    if shard:
+        return '{0}.{1}.taxonomy.json'.format(labeled_csv, shard)
+    return '{0}.taxonomy.json'.format(labeled_csv)
+
+
+def save_taxonomy(labeled_csv, expanded_moods, shard=None):
+    taxonomy = get_taxonomy(expanded_moods)
+    with open(taxonomy_path(labeled_csv, shard), 'w', encoding='utf-8') as f:
+        json.dump({
+            'hash': taxonomy_hash(taxonomy),
+            'expanded_moods': expanded_moods,
+            'taxonomy': taxonomy,
+        }, f, indent=4, sort_keys=True)
+    return
+
+
+def load_taxonomy(labeled_csv, shard=None):
+    """
+    Returns: dict with hash, expanded_moods, and taxonomy keys or None if no taxonomy was saved
+    """
+    path = taxonomy_path(labeled_csv, shard)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def changed_moods(old_taxonomy, new_taxonomy):
+    """
+    Finds the moods whose "like" or "filter" lists differ between two expanded taxonomies.
+    Added and removed moods count as changed.
+
+    Returns: list of str
+    """
+    changed = list()
+    for mood in list(old_taxonomy.keys()) + [m for m in new_taxonomy.keys() if m not in old_taxonomy]:
+        old_lists = old_taxonomy.get(mood, [[], [], []])
+        new_lists = new_taxonomy.get(mood, [[], [], []])
+        if old_lists[1:] != new_lists[1:]:
+            changed.append(mood)
+    return changed
+
+
+def query_tags_for_track(msd_id, conn, tag_graph=None):
+    """
+    Retrieves the Last.fm tags of a track
+
+    Args:
+        msd_id: str, track id
+        conn: sqlite3 connection to the Last.fm tags db (unused if tag_graph is provided)
+        tag_graph: lastfm_tags.LastfmTagGraph, exported tag graph to read from instead of sqlite
+
+    Returns: pd.DataFrame with tid, tag, and val columns
+    """
+    if tag_graph is not None:
+        tag_ids, vals = tag_graph.tag_ids_for_track(msd_id)
+        return pd.DataFrame({
+            'tid': msd_id,
+            'tag': [tag_graph.tag(t) for t in tag_ids],
+            'val': vals}, columns=['tid', 'tag', 'val'])
+    sql = "SELECT tids.tid, tags.tag, tid_tag.val FROM tid_tag, tids, tags WHERE tids.ROWID=tid_tag.tid AND tid_tag.tag=tags.ROWID AND tids.tid='{0}'".format(sanitize(msd_id))
+    return pd.read_sql_query(sql, conn)
+
+
+def get_mood_for_track(msd_id, lyrics_filename, conn, expanded_moods, tag_graph=None):
     
     global count_total, count_lyrics_with_tags, count_no_mood_match, count_labeled
     
@@ -157,8 +271,7 @@ def get_mood_for_track(msd_id, lyrics_filename, conn, expanded_moods):
     mood_scoreboard = dict.fromkeys(MOOD_CATEGORIES_EXPANDED.keys(), 0)
 
     # query for tags
-    sql = "SELECT tids.tid, tags.tag, tid_tag.val FROM tid_tag, tids, tags WHERE tids.ROWID=tid_tag.tid AND tid_tag.tag=tags.ROWID AND tids.tid='{0}'".format(sanitize(msd_id))
-    data = pd.read_sql_query(sql, conn)
+    data = query_tags_for_track(msd_id, conn, tag_graph)
 
     # check if tags were returned
     found_tags = len(data)
@@ -195,15 +308,39 @@ def get_mood_for_track(msd_id, lyrics_filename, conn, expanded_moods):
     return [found_tags, matched_mood, match, mood_scoreboard]
 
     
-def label_lyrics(csv_input, csv_output, artist_first_letter=None, expanded_moods=False):
+def label_lyrics(csv_input, csv_output, artist_first_letter=None, expanded_moods=False, use_tag_graph=False,
+                 resume=False, checkpoint_every=CHECKPOINT_EVERY, catalog_dir=None):
+    """
+    Labels every english song with lyrics in csv_input with a mood and writes csv_output
+
+    Labeled rows are checkpointed to disk every checkpoint_every songs. With resume,
+    songs already checkpointed under the same taxonomy version are not labeled again.
+    Checkpoints are removed once a run completes. Runs over different artist_first_letter
+    shards keep separate checkpoints, so they can run side by side.
+
+    If catalog_dir is given, the mxm and index column groups of the track catalog are
+    read instead of csv_input and only the label column group is written (csv_output
+    is ignored).
+    """
 
     logger.info('artist_first_letter={}'.format(artist_first_letter))
     logger.info('expanded_moods={}'.format(expanded_moods))
+    logger.info('use_tag_graph={}'.format(use_tag_graph))
+    logger.info('resume={}'.format(resume))
     logger.info('Reading in input csv {0}'.format(csv_input))
 
     start = time.time()
 
-    df = pd.read_csv(csv_input, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
+    catalog = None
+    if catalog_dir:
+        catalog = TrackCatalog(catalog_dir)
+        # checkpoints and the taxonomy live next to the label group
+        csv_output = os.path.join(catalog_dir, LABEL_GROUP)
+        # a single-letter run only loads its own artist partition
+        partitions = [artist_partition(artist_first_letter)] if artist_first_letter else None
+        df = catalog.read([KEY_COL] + catalog.columns(MXM_GROUP) + catalog.columns(INDEX_GROUP), partitions)
+    else:
+        df = pd.read_csv(csv_input, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
     df = add_col_if_dne(df, 'mood', '')
     df = add_col_if_dne(df, 'found_tags', -1)
     df = add_col_if_dne(df, 'matched_mood', -1)
@@ -226,23 +363,55 @@ def label_lyrics(csv_input, csv_output, artist_first_letter=None, expanded_moods
 
     logger.debug('Elapsed Time: {0} minutes'.format(elapsed_time / 60))
 
-    logger.info('Connecting to last.fm sqlite db at {0}'.format(LASTFM_TAGS_DB))
-
-    dbfile = LASTFM_TAGS_DB
-
-    # sanity check
-    if not os.path.isfile(dbfile):
-        print('ERROR: db file {0} does not exist? Try running download_data.py!'.format(dbfile))
-
-    # open connection
-    conn = sqlite3.connect(dbfile)
+    conn = None
+    tag_graph = None
+    if use_tag_graph and LastfmTagGraph.exists():
+        logger.info('Reading last.fm tag graph at {0}'.format(LASTFM_TAG_GRAPH_DIR))
+        tag_graph = LastfmTagGraph()
+    else:
+        if use_tag_graph:
+            logger.warning('no tag graph at {0}; run lastfm_tags.py to export one. Falling back to sqlite.'.format(
+                LASTFM_TAG_GRAPH_DIR))
+
+        logger.info('Connecting to last.fm sqlite db at {0}'.format(LASTFM_TAGS_DB))
+
+        dbfile = LASTFM_TAGS_DB
+
+        # sanity check
+        if not os.path.isfile(dbfile):
+            print('ERROR: db file {0} does not exist? Try running download_data.py!'.format(dbfile))
+
+        # open connection
+        conn = sqlite3.connect(dbfile)
+
+    shard = checkpoint_shard(artist_first_letter)
+    ckpt_dir = checkpoint_dir(csv_output, expanded_moods, shard)
+    done = pd.Series(False, index=df.index)
+    resumed, resumed_with_tags, resumed_labeled = 0, 0, 0
+    if resume:
+        labeled = load_checkpoints(ckpt_dir)
+        if labeled is not None:
+            labeled = labeled.set_index('msd_id')
+            done = df.msd_id.isin(labeled.index)
+            for col in labeled.columns:
+                df.loc[done, col] = df.loc[done, 'msd_id'].map(labeled[col]).values
+            resumed = int(done.sum())
+            resumed_with_tags = int((df.loc[done, 'found_tags'] > 0).sum())
+            resumed_labeled = int((df.loc[done, 'matched_mood'] == 1).sum())
+            logger.info('Resuming: {0} songs already labeled in {1}'.format(resumed, ckpt_dir))
+    elif os.path.exists(ckpt_dir):
+        logger.warning('Discarding old checkpoints in {0} (use --resume to keep them)'.format(ckpt_dir))
+        shutil.rmtree(ckpt_dir)
 
     logger.info('Querying Last.fm and Labeling Lyrics')
 
     global total_rows
-    total_rows = len(df)
+    # progress counts only the songs this run labels
+    total_rows = int((~done).sum())
 
     start = time.time()
+    completed = False
+    pending = list()
 
     try:
 
@@ -256,32 +425,57 @@ def label_lyrics(csv_input, csv_output, artist_first_letter=None, expanded_moods
         #    )), axis=1)
         # --- old way
         # for each song, query tags and attempt to match moods
-        for index, row in df.iterrows():
+        for index, row in df[~done].iterrows():
             results = get_mood_for_track(
                 row['msd_id'],
                 row['lyrics_filename'],
                 conn,
-                expanded_moods)
+                expanded_moods,
+                tag_graph)
             df.loc[index, 'found_tags'] = results[0]
             df.loc[index, 'matched_mood'] = results[1]
             df.loc[index, 'mood'] = results[2]
             for mood, score in results[3].items():
                 df.loc[index, mood] = score
 
+            record = {'msd_id': row['msd_id'], 'found_tags': results[0], 'matched_mood': results[1], 'mood': results[2]}
+            record.update(results[3])
+            pending.append(record)
+            if len(pending) >= checkpoint_every:
+                save_checkpoint(ckpt_dir, pending)
+                pending = list()
+        completed = True
+
     except KeyboardInterrupt as kbi:
         logger.info(str(kbi))
+    finally:
+        # on a crash, keep what we have for --resume
+        save_checkpoint(ckpt_dir, pending)
 
     logger.debug('Merging all no-lyric rows to df...')
     logger.debug('Rows before merge (lyrics): {0}'.format(len(df)))
     logger.debug('Rows before merge (no lyrics): {0}'.format(len(dropped_df)))
     df = pd.concat([df, dropped_df])
     logger.debug('Rows after merge: {0}'.format(len(df)))
-    logger.info('saving labeled lyric data to {0}'.format(csv_output))
-    df.to_csv(csv_output, encoding='utf-8', index=False)
+    if catalog:
+        label_cols = COLUMN_GROUPS[LABEL_GROUP] + [m for m in MOOD_CATEGORIES_EXPANDED.keys() if m in df.columns]
+        # a single-letter run only rewrites its own partition
+        catalog.write_group(LABEL_GROUP, df[[SONG_ID_COL] + label_cols], replace=not artist_first_letter)
+    else:
+        logger.info('saving labeled lyric data to {0}'.format(csv_output))
+        df.to_csv(csv_output, encoding='utf-8', index=False)
+    # shards share the label group of a catalog, so each keeps its own taxonomy
+    save_taxonomy(csv_output, expanded_moods, shard if catalog else None)
+    if completed and os.path.exists(ckpt_dir):
+        logger.debug('removing checkpoints in {0}'.format(ckpt_dir))
+        shutil.rmtree(ckpt_dir)
 
     end = time.time()
     elapsed_time = end - start
 
+    if resumed:
+        logger.info('{0} songs resumed from checkpoints ({1} with tags, {2} labeled)'.format(
+            resumed, resumed_with_tags, resumed_labeled))
     logger.info('{0} songs processed'.format(count_total))
     logger.info('{0} songs with tags'.format(count_lyrics_with_tags))
     logger.info('{0} songs with no mood match'.format(count_no_mood_match))
@@ -292,6 +486,235 @@ def label_lyrics(csv_input, csv_output, artist_first_letter=None, expanded_moods
     return
 
 
+def checkpoint_shard(artist_first_letter):
+    """
+    Returns: str, name of the shard labeled by a run over artist_first_letter or None for a
+        run over every artist
+    """
+    if not artist_first_letter:
+        return None
+    return '{0}{1}'.format(SHARD_PREFIX, quote(artist_first_letter.lower(), safe=''))
+
+
+def checkpoint_dir(labeled_csv, expanded_moods, shard=None):
+    """
+    Labeled partitions are checkpointed next to the output csv, one directory per
+    taxonomy version so that a resume never mixes labels from different taxonomies.
+    Each shard (see checkpoint_shard) has its own directories so that shards running
+    side by side never discard or overwrite each other's checkpoints.
+    """
+    ckpt_root = '{0}.checkpoints'.format(labeled_csv)
+    if shard:
+        ckpt_root = os.path.join(ckpt_root, shard)
+    return os.path.join(ckpt_root, taxonomy_hash(get_taxonomy(expanded_moods)))
+
+
+def checkpoint_parts(ckpt_dir):
+    """
+    Returns: list of str, the partitions in ckpt_dir in the order they were written
+    """
+    parts = glob.glob(os.path.join(ckpt_dir, 'part-*.csv'))
+    return sorted(parts, key=lambda part: (part_sequence(part), part))
+
+
+def part_sequence(part):
+    """
+    Returns: int, the sequence number of a partition named part-<sequence>-<pid>.csv
+    """
+    return int(os.path.basename(part)[len('part-'):].split('.')[0].split('-')[0])
+
+
+def save_checkpoint(ckpt_dir, records):
+    """
+    Writes one partition of labeled rows. The partition is written to a temp file
+    first so a crash mid-write never leaves a truncated partition behind. Partition
+    names carry the writer's pid so that two writers never replace each other's.
+
+    Args:
+        ckpt_dir: str, checkpoint directory
+        records: list of dict, labeled rows (msd_id plus label columns)
+
+    Returns: None
+    """
+    if not records:
+        return
+    os.makedirs(ckpt_dir, exist_ok=True)
+    parts = checkpoint_parts(ckpt_dir)
+    sequence = part_sequence(parts[-1]) + 1 if parts else 0
+    part = os.path.join(ckpt_dir, 'part-{0:05d}-{1}.csv'.format(sequence, os.getpid()))
+    tmp = part + '.tmp'
+    pd.DataFrame(records).to_csv(tmp, encoding='utf-8', index=False)
+    os.replace(tmp, part)
+    logger.debug('checkpointed {0} labeled rows to {1}'.format(len(records), part))
+    return
+
+
+def load_checkpoints(ckpt_dir):
+    """
+    Returns: pd.DataFrame of every checkpointed labeled row or None if there are none
+    """
+    parts = checkpoint_parts(ckpt_dir)
+    if not parts:
+        return None
+    labeled = pd.concat([pd.read_csv(part, encoding='utf-8', dtype={'msd_id': str, 'mood': str}) for part in parts])
+    return labeled.drop_duplicates(subset='msd_id', keep='last')
+
+
+def taxonomy_shards(labeled_csv):
+    """
+    Returns: list of str, the artist_first_letter of every shard (see checkpoint_shard)
+        that saved its own taxonomy next to labeled_csv
+    """
+    prefix = '{0}.{1}'.format(os.path.basename(labeled_csv), SHARD_PREFIX)
+    suffix = '.taxonomy.json'
+    directory = os.path.dirname(labeled_csv) or '.'
+    if not os.path.isdir(directory):
+        return list()
+    return sorted(unquote(f[len(prefix):-len(suffix)]) for f in os.listdir(directory)
+                  if f.startswith(prefix) and f.endswith(suffix))
+
+
+def relabel_lyrics_incremental(csv_input, csv_output, graph_dir=LASTFM_TAG_GRAPH_DIR, catalog_dir=None,
+                               artist_first_letter=None):
+    """
+    Brings lyrics labeled with an older version of MOOD_CATEGORIES_EXPANDED up to date
+    without a full label_lyrics run.
+
+    Only the moods whose "like" or "filter" lists changed are rescored, and only for
+    tracks whose tags contain one of those moods' old or new "like" strings. Every
+    other track's score for a changed mood was 0 before and is 0 now, so the stored
+    scoreboard columns are reused for everything else and the final mood is picked
+    from the updated scoreboard.
+
+    If catalog_dir is given, the label column group of the track catalog is relabeled
+    in place instead of csv_input (csv_output is ignored). A catalog labeled shard by
+    shard keeps a taxonomy per shard, so each shard is relabeled against its own; pass
+    artist_first_letter to relabel a single shard.
+
+    Requires the tag graph exported by lastfm_tags.py.
+
+    Args:
+        csv_input: str, csv previously produced by label_lyrics with expanded moods
+        csv_output: str, csv to write to
+        graph_dir: str, tag graph directory
+        catalog_dir: str, track catalog to relabel instead of csv_input
+        artist_first_letter: str, only relabel the catalog shard of this letter
+
+    Returns: None
+    """
+    start = time.time()
+
+    shard = None
+    if catalog_dir:
+        labeled_csv = os.path.join(catalog_dir, LABEL_GROUP)
+        shard = checkpoint_shard(artist_first_letter)
+        if not artist_first_letter and not os.path.exists(taxonomy_path(labeled_csv)):
+            letters = taxonomy_shards(labeled_csv)
+            if letters:
+                logger.info('{0} was labeled by shard; relabeling shards {1}'.format(labeled_csv, letters))
+                for letter in letters:
+                    relabel_lyrics_incremental(csv_input, csv_output, graph_dir, catalog_dir, letter)
+                return
+    else:
+        labeled_csv = csv_input
+
+    old = load_taxonomy(labeled_csv, shard)
+    if old is None:
+        error = 'no taxonomy saved at {0}; run a full label_lyrics with --expanded-moods'.format(
+            taxonomy_path(labeled_csv, shard))
+        logger.error(error)
+        raise Exception(error)
+    if not old.get('expanded_moods', False):
+        # MOOD_CATEGORIES labels keep no scoreboard to rescore, so they can only be labeled from scratch
+        error = '{0} was labeled with MOOD_CATEGORIES; incremental relabeling needs expanded mood labels, ' \
+                'run a full label_lyrics instead'.format(taxonomy_path(labeled_csv, shard))
+        logger.error(error)
+        raise Exception(error)
+    if not LastfmTagGraph.exists(graph_dir):
+        error = 'no tag graph at {0}; run lastfm_tags.py to export one'.format(graph_dir)
+        logger.error(error)
+        raise Exception(error)
+
+    new_taxonomy = MOOD_CATEGORIES_EXPANDED
+    moods = list(new_taxonomy.keys())
+    changed = changed_moods(old['taxonomy'], new_taxonomy)
+    logger.info('taxonomy {0} -> {1}'.format(old['hash'], taxonomy_hash(new_taxonomy)))
+    logger.info('changed moods: {0}'.format(changed))
+
+    catalog = None
+    if catalog_dir:
+        logger.info('Reading in label group of track catalog {0} (artist_first_letter={1})'.format(
+            catalog_dir, artist_first_letter))
+        catalog = TrackCatalog(catalog_dir)
+        # a single-letter run only loads its own artist partition
+        partitions = [artist_partition(artist_first_letter)] if artist_first_letter else None
+        df = catalog.read([KEY_COL] + catalog.columns(LABEL_GROUP), partitions)
+        if artist_first_letter:
+            # the partition may hold other shards' artists too
+            artists = catalog.read_group(MXM_GROUP, [ARTIST_COL], partitions)
+            in_shard = artists[ARTIST_COL].astype(object).fillna('').astype(str).str.lower().str.startswith(
+                artist_first_letter.lower())
+            df = df[df[SONG_ID_COL].isin(artists[SONG_ID_COL][in_shard])]
+        # the catalog stores compacted columns, which cannot take every mood or score relabeling writes
+        widened = dict((c, np.int64) for c in catalog.columns(LABEL_GROUP) if pd.api.types.is_integer_dtype(df[c]))
+        widened['mood'] = object
+        df = df.astype(widened)
+    else:
+        logger.info('Reading in input csv {0}'.format(csv_input))
+        df = pd.read_csv(csv_input, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
+    removed = [m for m in old['taxonomy'].keys() if m not in new_taxonomy and m in df.columns]
+    df = df.drop(removed, axis=1)
+    for mood in moods:
+        df = add_col_if_dne(df, mood, 0)
+    tagged = df.found_tags > 0
+
+    rescore = [m for m in changed if m in new_taxonomy]
+    if rescore:
+        tag_graph = LastfmTagGraph(graph_dir)
+        # any tag containing an old or new "like" string of a changed mood may change that mood's score
+        tag_series = pd.Series(tag_graph.tag_strings())
+        touched_tags = np.zeros(len(tag_series), dtype=bool)
+        for mood in changed:
+            for taxonomy in (old['taxonomy'], new_taxonomy):
+                for likemood in taxonomy.get(mood, [[], [], []])[1]:
+                    touched_tags |= tag_series.str.contains(likemood).values
+        touched_tracks = tag_graph.tracks_with_any_tag(np.flatnonzero(touched_tags))
+        touched_ids = set(tag_graph.msd_id(i) for i in touched_tracks)
+        rows = df.index[tagged & df.msd_id.isin(touched_ids)]
+        logger.info('rescoring {0} moods for {1} of {2} tagged songs'.format(len(rescore), len(rows), tagged.sum()))
+
+        df.loc[tagged, rescore] = 0
+        for count, index in enumerate(rows):
+            tags = pd.Series(tag_graph.tags_for_track(df.at[index, 'msd_id']))
+            for mood in rescore:
+                df.at[index, mood] = score_tags_for_mood(tags, new_taxonomy[mood])
+            if count % 10000 == 0:
+                logger.debug('{0}/{1} rescored'.format(count, len(rows)))
+
+    # re-pick the mood of every tagged song from its scoreboard; this matches pick_mood
+    scores = df.loc[tagged, moods].fillna(0).values
+    best = scores.argmax(axis=1) if len(moods) else np.zeros(len(scores), dtype=int)
+    has_match = scores.max(axis=1) > 0 if len(moods) else np.zeros(len(scores), dtype=bool)
+    df.loc[tagged, 'mood'] = np.where(has_match, np.array(moods, dtype=object)[best], MOOD_UNKNOWN_KEY)
+    df.loc[tagged, 'matched_mood'] = has_match.astype(int)
+
+    if catalog:
+        label_cols = COLUMN_GROUPS[LABEL_GROUP] + moods
+        # a single-letter run only rewrites its own partition
+        catalog.write_group(LABEL_GROUP, df[[SONG_ID_COL] + label_cols], replace=not artist_first_letter)
+        save_taxonomy(labeled_csv, True, shard)
+    else:
+        logger.info('saving labeled lyric data to {0}'.format(csv_output))
+        df.to_csv(csv_output, encoding='utf-8', index=False)
+        save_taxonomy(csv_output, expanded_moods=True)
+
+    logger.info('{0} songs with tags'.format(tagged.sum()))
+    logger.info('{0} songs labeled'.format(has_match.sum()))
+    logger.info(full_elapsed_time_str(start))
+
+    return
+
+
 def parse_args():
 
     # parse args
@@ -302,11 +725,16 @@ def parse_args():
     parser.add_argument('-i', '--csv-input', action='store', required=False, default=CSV_INDEX_LYRICS, help='Artist-Song mapping csv with lyric file paths')
     parser.add_argument('-o', '--csv-output', action='store', required=False, default=CSV_LABELED_LYRICS, help='csv to write to (WARNING: will overwite)')
     parser.add_argument('-e', '--expanded-moods', action='store_true', required=False, default=False, help='use the MOOD_CATEGORIES_EXPANDED dict instead of MOOD_CATEGORIES')
+    parser.add_argument('-g', '--tag-graph', action='store_true', required=False, default=False, help='read tags from the memory-mapped export of lastfm_tags.py instead of the sqlite db')
+    parser.add_argument('-r', '--resume', action='store_true', required=False, default=False, help='skip songs already checkpointed by an interrupted run with the same taxonomy')
+    parser.add_argument('--checkpoint-every', action='store', type=int, required=False, default=CHECKPOINT_EVERY, help='number of labeled songs between checkpoints')
+    parser.add_argument('-c', '--catalog-dir', action='store', required=False, default=None, help='read from and write the label column group to this track catalog instead of csvs')
+    parser.add_argument('--incremental', action='store_true', required=False, default=False, help='csv-input (or the label group of --catalog-dir) was labeled with expanded moods; rescore only the moods changed since it was labeled (requires the tag graph)')
 
     args = parser.parse_args()
 
     # simple arg sanity check
-    if os.path.exists(args.csv_output):
+    if not args.catalog_dir and os.path.exists(args.csv_output):
         logger.warning('Output CSV "{0}" will be overwritten'.format(args.csv_output))
         while True:
             response = input('Is this okay? Please enter Y/N:').lower()
@@ -326,7 +754,12 @@ def main():
 
     configure_logging(logname='label_lyrics')
     args = parse_args()
-    label_lyrics(args.csv_input, args.csv_output, args.artist_first_letter, args.expanded_moods)
+    if args.incremental:
+        relabel_lyrics_incremental(args.csv_input, args.csv_output, catalog_dir=args.catalog_dir,
+                                   artist_first_letter=args.artist_first_letter)
+    else:
+        label_lyrics(args.csv_input, args.csv_output, args.artist_first_letter, args.expanded_moods, args.tag_graph,
+                     args.resume, args.checkpoint_every, args.catalog_dir)
 
     return
 
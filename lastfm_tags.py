@@ -0,0 +1,271 @@
+"""
+Use this script to export the Last.fm sqlite database into a compact, memory-mapped
+tag graph that label_lyrics.py and the tag analysis notebooks can read without
+running sqlite joins.
+
+The tag data never changes, so the export only needs to be run once. The graph is
+stored in CSR (compressed sparse row) layout as plain numpy files:
+
+    tids.npy         sorted track ids (MSD ids), one per track
+    indptr.npy       offsets into tag_ids/vals; track i owns [indptr[i], indptr[i+1])
+    tag_ids.npy      int32 ids into the tag string table
+    vals.npy         float32 Last.fm tag weights (the tid_tag.val column)
+    tag_offsets.npy  offsets into tag_bytes; tag j is tag_bytes[tag_offsets[j]:tag_offsets[j+1]]
+    tag_bytes.npy    utf-8 encoded tag strings, concatenated
+
+Every file is opened with mmap_mode='r' so looking up a track's tags is a binary
+search plus zero-copy slicing.
+
+Recommended Command:
+
+    python lastfm_tags.py
+
+Output: data/lastfm_tags_csr/*.npy
+"""
+# project imports
+from download_data import DATA_DIR
+from utils import configure_logging, logger, full_elapsed_time_str
+
+# python and package imports
+import numpy as np
+import argparse
+import sqlite3
+import time
+import os
+
+
+LASTFM_TAGS_DB = os.path.join(DATA_DIR, 'lastfm_tags.db')
+LASTFM_TAG_GRAPH_DIR = os.path.join(DATA_DIR, 'lastfm_tags_csr')
+FETCH_SIZE = 1000000
+
+
+def _npy_path(graph_dir, name):
+    return os.path.join(graph_dir, '{0}.npy'.format(name))
+
+
+def _positions(pos, rowids):
+    """
+    Maps sqlite rowids to positions through pos; rowids pos has no position for map to -1
+
+    Returns: np.array of int32
+    """
+    positions = np.full(len(rowids), -1, dtype=np.int32)
+    in_range = (rowids >= 0) & (rowids < len(pos))
+    positions[in_range] = pos[rowids[in_range]]
+    return positions
+
+
+def export_tag_graph(dbfile=LASTFM_TAGS_DB, graph_dir=LASTFM_TAG_GRAPH_DIR):
+    """
+    Exports the Last.fm sqlite tag database into CSR numpy files
+
+    tid_tag rows whose tid or tag is not in the tids or tags table are dropped.
+
+    Args:
+        dbfile: str, path to lastfm_tags.db
+        graph_dir: str, directory to write the numpy files to
+
+    Returns: None
+    """
+    if not os.path.isfile(dbfile):
+        logger.error('db file {0} does not exist? Try running download_data.py!'.format(dbfile))
+        return
+
+    logger.info('Exporting {0} to {1}'.format(dbfile, graph_dir))
+    start = time.time()
+    os.makedirs(graph_dir, exist_ok=True)
+    conn = sqlite3.connect(dbfile)
+
+    # tracks: sort by msd id so lookups can binary search
+    rows = conn.execute('SELECT ROWID, tid FROM tids').fetchall()
+    tid_rowids = np.array([r[0] for r in rows], dtype=np.int64)
+    tids = np.array([r[1] for r in rows], dtype=bytes)
+    del rows
+    track_order = np.argsort(tids, kind='mergesort')
+    tids = tids[track_order]
+    track_pos = np.full(tid_rowids.max() + 1, -1, dtype=np.int32)
+    track_pos[tid_rowids[track_order]] = np.arange(len(tids), dtype=np.int32)
+    logger.info('{0} tracks'.format(len(tids)))
+
+    # tags: one string table, indexed by position
+    rows = conn.execute('SELECT ROWID, tag FROM tags').fetchall()
+    tag_rowids = np.array([r[0] for r in rows], dtype=np.int64)
+    encoded_tags = [r[1].encode('utf-8') for r in rows]
+    del rows
+    tag_pos = np.full(tag_rowids.max() + 1, -1, dtype=np.int32)
+    tag_pos[tag_rowids] = np.arange(len(tag_rowids), dtype=np.int32)
+    tag_offsets = np.zeros(len(encoded_tags) + 1, dtype=np.int64)
+    tag_offsets[1:] = np.cumsum([len(t) for t in encoded_tags])
+    tag_bytes = np.frombuffer(b''.join(encoded_tags), dtype=np.uint8)
+    del encoded_tags
+    logger.info('{0} tags'.format(len(tag_rowids)))
+
+    # edges: stream the join table in chunks to keep sqlite's result sets small
+    edge_tracks = list()
+    edge_tags = list()
+    edge_vals = list()
+    dropped = 0
+    cursor = conn.execute('SELECT tid, tag, val FROM tid_tag')
+    while True:
+        chunk = cursor.fetchmany(FETCH_SIZE)
+        if not chunk:
+            break
+        chunk = np.array(chunk, dtype=np.float64)
+        tracks = _positions(track_pos, chunk[:, 0].astype(np.int64))
+        tags = _positions(tag_pos, chunk[:, 1].astype(np.int64))
+        keep = (tracks >= 0) & (tags >= 0)
+        dropped += len(keep) - keep.sum()
+        edge_tracks.append(tracks[keep])
+        edge_tags.append(tags[keep])
+        edge_vals.append(chunk[keep, 2].astype(np.float32))
+        logger.debug('read {0} tid_tag rows'.format(sum(len(e) for e in edge_tracks)))
+    conn.close()
+    if dropped:
+        logger.warning('dropped {0} tid_tag rows with an unknown tid or tag'.format(dropped))
+
+    edge_tracks = np.concatenate(edge_tracks) if edge_tracks else np.zeros(0, dtype=np.int32)
+    edge_tags = np.concatenate(edge_tags) if edge_tags else np.zeros(0, dtype=np.int32)
+    edge_vals = np.concatenate(edge_vals) if edge_vals else np.zeros(0, dtype=np.float32)
+
+    # group edges by track, keeping the db order of tags within each track
+    edge_order = np.argsort(edge_tracks, kind='mergesort')
+    counts = np.bincount(edge_tracks, minlength=len(tids))
+    indptr = np.zeros(len(tids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+
+    np.save(_npy_path(graph_dir, 'tids'), tids)
+    np.save(_npy_path(graph_dir, 'indptr'), indptr)
+    np.save(_npy_path(graph_dir, 'tag_ids'), edge_tags[edge_order])
+    np.save(_npy_path(graph_dir, 'vals'), edge_vals[edge_order])
+    np.save(_npy_path(graph_dir, 'tag_offsets'), tag_offsets)
+    np.save(_npy_path(graph_dir, 'tag_bytes'), tag_bytes)
+
+    logger.info('Exported {0} track-tag pairs'.format(len(edge_tags)))
+    logger.info(full_elapsed_time_str(start))
+    return
+
+
+class LastfmTagGraph(object):
+    """
+    Read-only, memory-mapped view of the Last.fm tag graph produced by export_tag_graph
+    """
+
+    def __init__(self, graph_dir=LASTFM_TAG_GRAPH_DIR):
+        """
+        Args:
+            graph_dir: str, directory containing the exported numpy files
+        """
+        self.graph_dir = graph_dir
+        self.tids = np.load(_npy_path(graph_dir, 'tids'), mmap_mode='r')
+        self.indptr = np.load(_npy_path(graph_dir, 'indptr'), mmap_mode='r')
+        self.tag_ids = np.load(_npy_path(graph_dir, 'tag_ids'), mmap_mode='r')
+        self.vals = np.load(_npy_path(graph_dir, 'vals'), mmap_mode='r')
+        self.tag_offsets = np.load(_npy_path(graph_dir, 'tag_offsets'), mmap_mode='r')
+        self.tag_bytes = np.load(_npy_path(graph_dir, 'tag_bytes'), mmap_mode='r')
+        return
+
+    @staticmethod
+    def exists(graph_dir=LASTFM_TAG_GRAPH_DIR):
+        return os.path.exists(_npy_path(graph_dir, 'tag_bytes'))
+
+    @property
+    def num_tags(self):
+        return len(self.tag_offsets) - 1
+
+    def track_index(self, msd_id):
+        """
+        Returns: int, row of msd_id in the graph or -1 if the track has no entry
+        """
+        key = str(msd_id).encode('utf-8')
+        i = int(np.searchsorted(self.tids, key))
+        if i < len(self.tids) and self.tids[i] == key:
+            return i
+        return -1
+
+    def tag_ids_for_track(self, msd_id):
+        """
+        Zero-copy lookup of a track's tags
+
+        Returns:
+            tag_ids: np.array of int32 (a view into the memory map)
+            vals: np.array of float32 (a view into the memory map)
+        """
+        i = self.track_index(msd_id)
+        if i < 0:
+            return self.tag_ids[:0], self.vals[:0]
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.tag_ids[start:end], self.vals[start:end]
+
+    def tag(self, tag_id):
+        """
+        Returns: str, the tag string for tag_id
+        """
+        start, end = self.tag_offsets[tag_id], self.tag_offsets[tag_id + 1]
+        return self.tag_bytes[start:end].tobytes().decode('utf-8')
+
+    def tag_strings(self):
+        """
+        Decodes the whole tag string table
+
+        Returns: list of str, indexed by tag id
+        """
+        return [self.tag(t) for t in range(self.num_tags)]
+
+    def msd_id(self, track_index):
+        return self.tids[track_index].decode('utf-8')
+
+    def tracks_with_any_tag(self, tag_ids):
+        """
+        Finds every track tagged with at least one of tag_ids
+
+        Args:
+            tag_ids: array-like of int, tag ids to search for
+
+        Returns: np.array of int, sorted track indices
+        """
+        edges = np.flatnonzero(np.isin(self.tag_ids, np.asarray(tag_ids, dtype=np.int32)))
+        # each edge belongs to the track whose [indptr[i], indptr[i+1]) range contains it
+        return np.unique(np.searchsorted(self.indptr, edges, side='right') - 1)
+
+    def tags_for_track(self, msd_id):
+        """
+        Returns: list of str, the tags of msd_id in db order
+        """
+        tag_ids, _ = self.tag_ids_for_track(msd_id)
+        return [self.tag(t) for t in tag_ids]
+
+    def __len__(self):
+        return len(self.tids)
+
+    def __contains__(self, msd_id):
+        return self.track_index(msd_id) >= 0
+
+    def __repr__(self):
+        return '<LastfmTagGraph(tracks={0}, tags={1})>'.format(len(self), self.num_tags)
+
+
+def parse_args():
+
+    # parse args
+    parser = argparse.ArgumentParser()
+
+    # universal args
+    parser.add_argument('-d', '--db', action='store', required=False, default=LASTFM_TAGS_DB, help='Last.fm sqlite tags db to export')
+    parser.add_argument('-o', '--output-dir', action='store', required=False, default=LASTFM_TAG_GRAPH_DIR, help='dir to write the tag graph to (WARNING: will overwite)')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    configure_logging(logname='lastfm_tags')
+    args = parse_args()
+    export_tag_graph(args.db, args.output_dir)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
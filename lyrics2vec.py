@@ -11,6 +11,7 @@ Please see mood_classification.py for how lyrics2vec is used.
 # project imports
 from utils import read_file_contents, configure_logging, logger, picklify, unpicklify
 from scrape_lyrics import LYRICS_TXT_DIR
+from ragged_tokens import RaggedTokens
 
 
 # python and package imports
@@ -20,9 +21,11 @@ import tensorflow as tf
 import pandas as pd
 import numpy as np
 import collections
+import itertools
 import pickle
 import string
 import random
+import array
 import time
 import math
 import os
@@ -36,6 +39,7 @@ import matplotlib.pyplot as plt
 
 
 UNKNOWN_TAG = 'UNK'
+PAD_TAG = '<PAD>'
 LOGS_TF_DIR = 'logs/tf'
 LYRICS2VEC_DIR = os.path.join(LOGS_TF_DIR, 'lyrics2vec_expanded')
 VOCABULARY_FILE = os.path.join(LYRICS2VEC_DIR, 'vocabulary.txt')
@@ -44,6 +48,32 @@ LYRICS2VEC_COUNT_PICKLE = os.path.join(LYRICS2VEC_DIR, 'lyrics2vec_count.pickle'
 LYRICS2VEC_DICT_PICKLE = os.path.join(LYRICS2VEC_DIR, 'lyrics2vec_dict.pickle')
 LYRICS2VEC_REVDICT_PICKLE = os.path.join(LYRICS2VEC_DIR, 'lyrics2vec_revdict.pickle')
 LYRICS2VEC_EMBEDDINGS_PICKLE = os.path.join(LYRICS2VEC_DIR, 'lyrics2vec_embeddings.pickle')
+# token ids searched for first occurrences at once by _build_dataset_from_tokens
+FIRST_OCCURRENCE_CHUNK = 2 ** 22
+
+
+class LyricsCorpus(object):
+    """
+    Streams the words of a collection of tokenized songs without concatenating them
+
+    Iterating yields every word of every song in order, skipping '<PAD>' tokens. Each
+    iteration starts over, so build_dataset can make its two passes over the corpus.
+    """
+
+    def __init__(self, songs):
+        """
+        Args:
+            songs: re-iterable (list, pd.Series, ...) of list of str, the tokens of each
+                song; empty songs and None are skipped
+        """
+        self.songs = songs
+        return
+
+    def __iter__(self):
+        # padding is rare in the unpadded lyrics, so only those songs are filtered word by word
+        return itertools.chain.from_iterable(
+            song if PAD_TAG not in song else [word for word in song if word != PAD_TAG]
+            for song in self.songs if song)
 
 
 class lyrics2vec(object):
@@ -92,32 +122,86 @@ class lyrics2vec(object):
         Process raw inputs into a dataset.
         
         Args:
-          words: list of str, raw inputs
+          words: re-iterable of str, raw inputs (e.g. a list or a LyricsCorpus); it is read
+              twice, once to count words and once to assign ids. A RaggedTokens is counted
+              and mapped with numpy instead (see _build_dataset_from_tokens)
         
         Initializes the following class data members:
         * count: dict, maps each unique token to its int num of occurences in the dataset
         * dictionary: dict, maps each token to its int id
         * reversed_dictionary: dict, maps each int id to its token
-        * data: list, int ids in order for all tokens in dataset
+        * data: np.array of int32, ids in order for all tokens in dataset
         
         Returns: None
         """
         logger.info('building lyrics2vec dataset')
+        if isinstance(words, RaggedTokens):
+            return self._build_dataset_from_tokens(words)
         self.count = [[UNKNOWN_TAG, -1]]
         self.count.extend(collections.Counter(words).most_common(self.vocab_size - 1))
         self.dictionary = dict()
         for word, _ in self.count:
             self.dictionary[word] = len(self.dictionary)
-        self.data = list()
-        unk_count = 0
-        for word in words:
-            if word in self.dictionary:
-                index = self.dictionary[word]
-            else:
-                index = 0  # dictionary[UNKNOWN_TAG]
-                unk_count += 1
-            self.data.append(index)
-        self.count[0][1] = unk_count
+        # words outside of the vocabulary map to dictionary[UNKNOWN_TAG] (0); the ids grow
+        # in a typed array, a chunk at a time, instead of a list of python ints
+        data = array.array('i')
+        words_iter = iter(words)
+        while True:
+            chunk = list(map(self.dictionary.get, itertools.islice(words_iter, 65536), itertools.repeat(0)))
+            if not chunk:
+                break
+            data.fromlist(chunk)
+        self.data = np.array(data, dtype=np.int32)
+        del data
+        self.count[0][1] = int(np.count_nonzero(self.data == 0))
+        self.reversed_dictionary = dict(zip(self.dictionary.values(), self.dictionary.keys()))
+        return
+
+    def _build_dataset_from_tokens(self, tokens):
+        """
+        build_dataset for a ragged_tokens.RaggedTokens: words are counted with np.unique over
+        their ids and data is a lookup of those ids. Ties in the counts are broken by first
+        occurrence, as collections.Counter.most_common does, so the vocabulary is the same.
+
+        The ids are read FIRST_OCCURRENCE_CHUNK at a time, twice, so the ids of a memory-mapped
+        container (see RaggedTokens.load) are never all in memory; only data is.
+        """
+        vocab = tokens.vocab
+        ids = tokens.flat_ids()
+        pad_id = vocab.index(PAD_TAG) if PAD_TAG in vocab else -1
+        chunks = lambda: (np.asarray(ids[start:start + FIRST_OCCURRENCE_CHUNK])
+                          for start in range(0, len(ids), FIRST_OCCURRENCE_CHUNK))
+        # positions of first occurrences count the padding too, which keeps their order
+        counts = np.zeros(len(vocab), dtype=np.int64)
+        first = np.full(len(vocab), len(ids), dtype=np.int64)
+        start = 0
+        for chunk in chunks():
+            chunk_seen, chunk_first, chunk_counts = np.unique(chunk, return_index=True, return_counts=True)
+            counts[chunk_seen] += chunk_counts
+            new = first[chunk_seen] == len(ids)
+            first[chunk_seen[new]] = start + chunk_first[new]
+            start += len(chunk)
+        if pad_id >= 0:
+            counts[pad_id] = 0
+        seen = np.flatnonzero(counts)
+        first = first[seen]
+        top = seen[np.lexsort((first, -counts[seen]))][:self.vocab_size - 1]
+        self.count = [[UNKNOWN_TAG, -1]]
+        self.count.extend((vocab[i], int(counts[i])) for i in top)
+        self.dictionary = dict()
+        for word, _ in self.count:
+            self.dictionary[word] = len(self.dictionary)
+        # words outside of the vocabulary map to dictionary[UNKNOWN_TAG] (0)
+        lookup = np.zeros(len(vocab), dtype=np.int32)
+        lookup[top] = [self.dictionary[vocab[i]] for i in top]
+        self.data = np.empty(int(counts.sum()), dtype=np.int32)
+        start = 0
+        for chunk in chunks():
+            if pad_id >= 0:
+                chunk = chunk[chunk != pad_id]
+            self.data[start:start + len(chunk)] = lookup[chunk]
+            start += len(chunk)
+        self.count[0][1] = int(np.count_nonzero(self.data == 0))
         self.reversed_dictionary = dict(zip(self.dictionary.values(), self.dictionary.keys()))
         return
     
@@ -136,6 +220,28 @@ class lyrics2vec(object):
             #print('{0} -> {1}'.format(word, lyric_ids[-1]))
         return lyric_ids
 
+    def transform_batch(self, songs, cutoff=None, out=None):
+        """
+        Batch version of transform that also truncates or pads each song to cutoff
+
+        Every distinct token of songs is looked up in the dictionary once, through the
+        vocabulary of a RaggedTokens; the songs are then mapped and padded with numpy,
+        straight into the rows of out.
+
+        Args:
+          songs: ragged_tokens.RaggedTokens, or list of list of strs (padded or not)
+          cutoff: int, length of each output row (default: out.shape[1])
+          out: np.array of int32 of shape (len(songs), cutoff), e.g. rows of a training matrix
+              (default: a new one)
+
+        Returns: np.array of int32 of shape (len(songs), cutoff), out if given
+        """
+        if not isinstance(songs, RaggedTokens):
+            songs = RaggedTokens.from_lists(songs)
+        lookup = np.fromiter((self.dictionary.get(word, 0) for word in songs.vocab), dtype=np.int32,
+                             count=len(songs.vocab))
+        return songs.pad(cutoff, lookup, pad_id=self.dictionary.get(PAD_TAG, 0), out=out)
+
     def _build_lyrics2vec_dir(self):
         d = 'lyrics2vec_V-{0}_Wt-{1}'.format(self.vocab_size, self.word_tokenizer_id)
         d = os.path.join(LYRICS2VEC_DIR, d)
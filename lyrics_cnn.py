@@ -16,6 +16,7 @@ from lyrics2vec import LOGS_TF_DIR, lyrics2vec
 from label_lyrics import CSV_LABELED_LYRICS
 from scrape_lyrics import LYRICS_TXT_DIR
 from download_data import DATA_DIR
+from tensor_store import load_tensors, X_Y_NAMES
 
 
 # python and package imports
@@ -37,6 +38,9 @@ LYRICS_CNN_DIR = os.path.join(LOGS_TF_DIR, 'lyrics_cnn')
 LYRICS_CNN_DF_TRAIN_PICKLE = os.path.join(LYRICS_CNN_DIR, 'lyrics_cnn_df_train.pickle')
 LYRICS_CNN_DF_DEV_PICKLE = os.path.join(LYRICS_CNN_DIR, 'lyrics_cnn_df_dev.pickle')
 LYRICS_CNN_DF_TEST_PICKLE = os.path.join(LYRICS_CNN_DIR, 'lyrics_cnn_df_test.pickle')
+# examples sorted by length together when bucketing, in batches
+BUCKET_POOL_BATCHES = 50
+SEQUENCE_LENGTHS_CHUNK_ROWS = 65536
 
 # thank you: https://github.com/datasci-w266/2018-fall-main/blob/012607b576bb6b96182f819773f3b50155f31876/assignment/a3/lstm/rnnlm.py
 # Decorator-foo to avoid indentation hell.
@@ -79,6 +83,154 @@ def get_pretrained_embeddings():
     return lyrics_vectorizer.final_embeddings
 
 
+def oversample_plan(labels, rs):
+    """
+    Plans how to oversample each label up to the size of the largest: the label's rows are
+    repeated as many whole times as fit and the remainder is sampled without replacement
+    (so no song gets more copies than another by more than one)
+
+    Args:
+        labels: np.array, label of each row
+        rs: np.random.RandomState
+
+    Returns: np.array of int, positions of the rows to copy
+    """
+    labels = np.asarray(labels)
+    values, counts = np.unique(labels, return_counts=True)
+    target_value = counts.max() if len(counts) else 0
+    plan = [np.zeros(0, dtype=np.int64)]
+    for value, current_value in zip(values, counts):
+        rows = np.flatnonzero(labels == value)
+        loop, n = divmod(target_value - current_value, current_value)
+        plan.append(np.tile(rows, loop))
+        plan.append(rs.choice(rows, n, replace=False))
+    return np.concatenate(plan).astype(np.int64)
+
+
+def confusion_matrix(labels, predictions, num_classes):
+    """
+    Counts each (label, prediction) pair with one np.bincount
+
+    Args:
+        labels: np.array of int, class id of each example
+        predictions: np.array of int, predicted class id of each example
+        num_classes: int
+
+    Returns: np.array of int64 of shape (num_classes, num_classes), rows are labels and columns predictions
+    """
+    pairs = np.asarray(labels, dtype=np.int64) * num_classes + np.asarray(predictions, dtype=np.int64)
+    return np.bincount(pairs, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def sequence_lengths(x, pad_id=0, chunk_rows=SEQUENCE_LENGTHS_CHUNK_ROWS):
+    """
+    Finds the true length of each padded row: the position after its last non-pad id
+
+    Args:
+        x: np.array of shape (num_rows, cutoff), rows padded at the end (an np.memmap is read
+            chunk_rows at a time)
+        pad_id: int, id of the padding
+        chunk_rows: int, rows compared at once
+
+    Returns: np.array of int64, length of each row
+    """
+    lengths = np.zeros(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_rows):
+        tokens = np.asarray(x[start:start + chunk_rows]) != pad_id
+        # argmax finds the first token from the end; rows of only padding have length 0
+        last = np.argmax(tokens[:, ::-1], axis=1)
+        lengths[start:start + len(tokens)] = np.where(tokens.any(axis=1), tokens.shape[1] - last, 0)
+    return lengths
+
+
+def length_buckets(lengths, batch_size, rs, pool_batches=BUCKET_POOL_BATCHES):
+    """
+    Groups examples of similar length into batches
+
+    The examples are taken in order in pools of pool_batches batches; each pool is sorted
+    by length and cut into batches, and the batches of all pools are shuffled. A batch
+    therefore only needs padding to the longest of its members, while which examples share
+    a pool (and the order of the batches) still follow the order given.
+
+    Args:
+        lengths: np.array of int, true length of each example in the order of the epoch
+        batch_size: int
+        rs: np.random.RandomState (or np.random), shuffles the batches
+        pool_batches: int, batches sorted together
+
+    Returns: list of np.array of int, positions in lengths of the examples of each batch
+    """
+    lengths = np.asarray(lengths)
+    pool_size = batch_size * pool_batches
+    batches = list()
+    for start in range(0, len(lengths), pool_size):
+        pool = start + np.argsort(lengths[start:start + pool_size], kind='mergesort')
+        batches.extend(pool[i:i + batch_size] for i in range(0, len(pool), batch_size))
+    return [batches[i] for i in rs.permutation(len(batches))]
+
+
+class BatchPolicy(object):
+    """
+    Chooses the training examples of each epoch for LyricsCNN._batch_iter
+
+    The default policy uses every example once per epoch in a random order.
+    """
+
+    def __init__(self, seed=None):
+        self.rs = np.random.RandomState(seed) if seed is not None else np.random
+        return
+
+    def epoch(self, labels):
+        """
+        Args:
+            labels: np.array of int, class of each training example
+
+        Returns:
+            indices: np.array of int, the training examples of the epoch in order
+            copies: np.array of bool, True where indices holds an extra copy of an example
+        """
+        return self.rs.permutation(len(labels)), np.zeros(len(labels), dtype=bool)
+
+    def augment(self, indices):
+        """
+        Returns: list of inputs to train on in place of the copies of these examples
+            (None to train on the copies unchanged)
+        """
+        return None
+
+
+class BalancedBatchPolicy(BatchPolicy):
+    """
+    Class-balanced epochs drawn from the unpadded training set
+
+    Each epoch holds every training example once plus the copies that oversample
+    every class up to the largest one (see oversample_plan). Copies are only made
+    as their batch is drawn, and augmenter (if given) turns each into a fresh
+    variation, e.g. mood_classification.LineShuffleAugmenter. This replaces padding
+    the training set with pad_data: memory stays at the size of the raw data.
+    """
+
+    def __init__(self, augmenter=None, seed=None):
+        """
+        Args:
+            augmenter: callable, takes an np.array of training example positions and
+                returns the augmented input of each
+            seed: int, seed of the epoch plans (default: numpy's global random state)
+        """
+        super(BalancedBatchPolicy, self).__init__(seed)
+        self.augmenter = augmenter
+        return
+
+    def epoch(self, labels):
+        indices = np.concatenate([np.arange(len(labels)), oversample_plan(labels, self.rs)])
+        copies = np.arange(len(indices)) >= len(labels)
+        order = self.rs.permutation(len(indices))
+        return indices[order], copies[order]
+
+    def augment(self, indices):
+        return self.augmenter(indices) if self.augmenter else None
+
+
 class LyricsCNN(object):
     """
     A CNN for mood classification of lyrics
@@ -90,7 +242,8 @@ class LyricsCNN(object):
     def __init__(self, batch_size, num_epochs, sequence_length, num_classes, vocab_size, embedding_size, 
                  filter_sizes, num_filters, l2_reg_lambda=0.0, dropout=0.5, pretrained_embeddings=None, 
                  train_embeddings=False, use_timestamp=False, output_dir=None, evaluate_every=100, 
-                 checkpoint_every=100, num_checkpoints=5, graph=None, name=None):
+                 checkpoint_every=100, num_checkpoints=5, graph=None, name=None, sparse_labels=False,
+                 bucket_batches=False, pad_id=0, eval_batch_size=None):
         """
         Initializes class. Creates experiment_name. Initializes TF variables.
         
@@ -117,6 +270,14 @@ class LyricsCNN(object):
             num_checkpoints: int, total number of checkpoints to save
             graph: tf graph, initialized and ready to go tf graph
             name: str, extra name to add to end of experiment string
+            sparse_labels: bool, labels are int class ids (e.g. mood_cats) rather than one-hot
+                rows; they are fed as is to a sparse softmax loss
+            bucket_batches: bool, batch training examples of similar length together and pad each
+                batch only to its longest member (at least the largest filter size) instead of
+                feeding every batch at sequence_length (see length_buckets)
+            pad_id: int, id of the padding after each song in the inputs (lyrics2vec pads with 0)
+            eval_batch_size: int, evaluate dev and test this many examples at a time instead of all
+                at once, so their embedded inputs need not fit in memory together (optional)
 
         Returns: one LyricsCNN
         """
@@ -135,6 +296,10 @@ class LyricsCNN(object):
         self.evaluate_every = evaluate_every
         self.checkpoint_every = checkpoint_every
         self.num_checkpoints = num_checkpoints
+        self.sparse_labels = sparse_labels
+        self.bucket_batches = bucket_batches
+        self.pad_id = pad_id
+        self.eval_batch_size = eval_batch_size
         
         self.experiment_name = self._build_experiment_name(timestamp=use_timestamp)
         if name:
@@ -167,6 +332,9 @@ class LyricsCNN(object):
                 'evaluate_every': self.evaluate_every,
                 'checkpoint_every': self.checkpoint_every,
                 'num_checkpoints': self.num_checkpoints,
+                'sparse_labels': self.sparse_labels,
+                'bucket_batches': self.bucket_batches,
+                'eval_batch_size': self.eval_batch_size,
             }
             json.dump(model_params, outfile, sort_keys=True)
         return
@@ -229,8 +397,13 @@ class LyricsCNN(object):
         """
 
         # Placeholders for input, output and dropout
-        self.input_x = tf.placeholder(tf.int32, [None, self.sequence_length], name="input_x")
-        self.input_y = tf.placeholder(tf.float32, [None, self.num_classes], name="input_y")
+        # bucketed batches are only as long as their longest song, so the time dimension varies
+        input_length = None if self.bucket_batches else self.sequence_length
+        self.input_x = tf.placeholder(tf.int32, [None, input_length], name="input_x")
+        if self.sparse_labels:
+            self.input_y = tf.placeholder(tf.int32, [None], name="input_y")
+        else:
+            self.input_y = tf.placeholder(tf.float32, [None, self.num_classes], name="input_y")
         self.dropout_keep_prob = tf.placeholder(tf.float32, name="dropout_keep_prob")
 
         # Keeping track of l2 regularization loss (optional)
@@ -278,13 +451,9 @@ class LyricsCNN(object):
                     name="conv")
                 # Apply nonlinearity
                 h = tf.nn.relu(tf.nn.bias_add(conv, b), name="relu")
-                # Maxpooling over the outputs
-                pooled = tf.nn.max_pool(
-                    h,
-                    ksize=[1, self.sequence_length - self.filter_size + 1, 1, 1],
-                    strides=[1, 1, 1, 1],
-                    padding='VALID',
-                    name="pool")
+                # Maxpooling over the outputs; a max over the time dimension of h is the same
+                # as a max_pool with ksize sequence_length - filter_size + 1, for any length
+                pooled = tf.reduce_max(h, axis=1, keepdims=True, name="pool")
                 pooled_outputs.append(pooled)
 
         # Combine all the pooled features
@@ -310,46 +479,92 @@ class LyricsCNN(object):
 
         # Calculate mean cross-entropy loss
         with tf.name_scope("loss"):
-            losses = tf.nn.softmax_cross_entropy_with_logits(logits=self.scores, labels=self.input_y)
+            if self.sparse_labels:
+                losses = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=self.scores, labels=self.input_y)
+            else:
+                losses = tf.nn.softmax_cross_entropy_with_logits(logits=self.scores, labels=self.input_y)
             self.loss = tf.reduce_mean(losses) + self.l2_reg_lambda * l2_loss
 
         # Accuracy
         with tf.name_scope("accuracy"):
-            correct_predictions = tf.equal(self.predictions, tf.argmax(self.input_y, 1))
+            if self.sparse_labels:
+                correct_predictions = tf.equal(self.predictions, tf.cast(self.input_y, tf.int64))
+            else:
+                correct_predictions = tf.equal(self.predictions, tf.argmax(self.input_y, 1))
             self.accuracy = tf.reduce_mean(tf.cast(correct_predictions, "float"), name="accuracy")
             
         return
 
-    def _batch_iter(self, data, shuffle=True):
+    def _batch_iter(self, x, y, shuffle=True, policy=None):
         """
         Generates a batch iterator for the provided dataset
         
         Args:
-            data: nparray, dataset
+            x: nparray, inputs (an np.memmap works too; only the rows of each batch are read)
+            y: nparray, one-hot labels (or int class ids if sparse_labels)
             shuffle: bool, shuffle data or not for each epoch
+            policy: BatchPolicy, chooses (and may augment) the examples of each epoch in place
+                of shuffle (optional)
             
-        Returns: batch iterator
+        Returns: batch iterator of (x_batch, y_batch); if bucket_batches, x_batch is cut to
+            the longest song of the batch (but no shorter than the largest filter size)
         """
-        data = np.array(data)
-        data_size = len(data)
-        self.num_batches_per_epoch = int((len(data) - 1) / self.batch_size) + 1
+        data_size = len(x)
+        if policy:
+            labels = self._class_ids(y)
+            indices, copies = policy.epoch(labels)
+            data_size = len(indices)
+        if self.bucket_batches:
+            lengths = sequence_lengths(x, self.pad_id)
+            rs = policy.rs if policy else np.random
+        self.num_batches_per_epoch = int((data_size - 1) / self.batch_size) + 1
         logger.info('num_batches_per_epoch = {0}'.format(self.num_batches_per_epoch))
         for epoch in range(self.num_epochs):
             logger.info('***********************************************')
             logger.info('Epoch {0}/{1}\n'.format(epoch, self.num_epochs))
             # Shuffle the data at each epoch
-            if shuffle:
-                shuffle_indices = np.random.permutation(np.arange(data_size))
-                shuffled_data = data[shuffle_indices]
+            if policy:
+                if epoch:
+                    indices, copies = policy.epoch(labels)
+            elif shuffle:
+                indices = np.random.permutation(np.arange(data_size))
+            else:
+                indices = np.arange(data_size)
+            if self.bucket_batches:
+                batches = length_buckets(lengths[indices], self.batch_size, rs)
             else:
-                shuffled_data = data
-            for batch_num in range(self.num_batches_per_epoch):
+                batches = [np.arange(start, min(start + self.batch_size, data_size))
+                           for start in range(0, data_size, self.batch_size)]
+            for batch_num, positions in enumerate(batches):
                 logger.info('-----------------------------------------------')
-                start_index = batch_num * self.batch_size
-                end_index = min((batch_num + 1) * self.batch_size, data_size)
-                logger.info('Epoch {0}/{1}, Batch {2}/{3} (start={4}, end={5})'.format(
-                    epoch, self.num_epochs, batch_num, self.num_batches_per_epoch, start_index, end_index))
-                yield shuffled_data[start_index:end_index]
+                logger.info('Epoch {0}/{1}, Batch {2}/{3} (size={4})'.format(
+                    epoch, self.num_epochs, batch_num, self.num_batches_per_epoch, len(positions)))
+                batch_indices = indices[positions]
+                x_batch = np.array(x[batch_indices])
+                y_batch = np.array(y[batch_indices])
+                if policy:
+                    # copies are augmented as they are drawn
+                    copy_pos = np.flatnonzero(copies[positions])
+                    augmented = policy.augment(batch_indices[copy_pos]) if len(copy_pos) else None
+                    if augmented is not None:
+                        x_batch[copy_pos] = augmented
+                if self.bucket_batches:
+                    # measured after augmenting: a copy may come out longer than its original
+                    x_batch = self._trim_batch(x_batch)
+                yield x_batch, y_batch
+
+    def _trim_batch(self, x_batch):
+        """
+        Returns: np.array, x_batch cut to its longest song (but no shorter than the largest filter size)
+        """
+        width = max(min(max(self.filter_sizes), x_batch.shape[1]), sequence_lengths(x_batch, self.pad_id).max())
+        return np.ascontiguousarray(x_batch[:, :width])
+
+    def _class_ids(self, y):
+        """
+        Returns: np.array of int, the class id of each label in y
+        """
+        return np.asarray(y) if self.sparse_labels else np.argmax(y, axis=1)
 
     def _cnn_step(self, sess, x_batch, y_batch, global_step, summary_op, train_op=None, summary_writer=None, step_writer=None):
         """
@@ -358,7 +573,7 @@ class LyricsCNN(object):
         Args:
             sess: tf session, currently execution session
             x_batch: ndarray, inputs
-            y_batch: ndarray, classes
+            y_batch: ndarray, classes (one-hot or int class ids, see sparse_labels)
             global_step: tf variable, stores the step count
             summary_op: tf summary op
             train_op: tf training operation (optional: if None, will not train model)
@@ -383,16 +598,18 @@ class LyricsCNN(object):
                 feed_dict)
         else:
             logger.info('Validation Step')
-            step, summaries, loss, accuracy, preds = sess.run(
-                [global_step, summary_op, self.loss, self.accuracy, self.predictions],
-                feed_dict)
+            if self.eval_batch_size:
+                step, loss, accuracy, preds = self._eval_in_batches(sess, x_batch, y_batch, global_step)
+                # the merged summary ops only see one batch, so the summary is built from the means
+                summaries = tf.Summary(value=[tf.Summary.Value(tag='loss', simple_value=loss),
+                                              tf.Summary.Value(tag='accuracy', simple_value=accuracy)])
+            else:
+                step, summaries, loss, accuracy, preds = sess.run(
+                    [global_step, summary_op, self.loss, self.accuracy, self.predictions],
+                    feed_dict)
             ### Create and Save Confusion Matrix
-            # https://stackoverflow.com/questions/38334296/reversing-one-hot-encoding-in-pandas
-            # https://stackoverflow.com/questions/43051687/how-to-create-confusion-matrix-for-classification-in-tensorflow
-            confusion = tf.confusion_matrix(
-                labels=pd.DataFrame(y_batch).idxmax(axis=1),
-                predictions=preds,
-                num_classes=self.num_classes).eval()
+            # counted in numpy; a tf.confusion_matrix op here would add new ops to the graph on every validation
+            confusion = confusion_matrix(self._class_ids(y_batch), preds, self.num_classes)
             conf_output = os.path.join(self.output_dir, '{0}_confusion.csv'.format(step))
             pd.DataFrame(confusion).to_csv(conf_output)
             logger.info('confusion matrix saved to {}'.format(conf_output))
@@ -403,8 +620,37 @@ class LyricsCNN(object):
             step_writer.writerow(['train' if train_op else 'dev', time_str, step, loss, accuracy])
         return time_str, step, loss, accuracy
 
+    def _eval_in_batches(self, sess, x, y, global_step):
+        """
+        Evaluates x eval_batch_size examples at a time
+
+        Returns:
+            step: int, step number from tf
+            loss: float, mean loss over all of x
+            accuracy: float, accuracy over all of x
+            preds: np.array of int, prediction for each example of x
+        """
+        losses, accuracies, sizes, preds = list(), list(), list(), list()
+        for start in range(0, len(x), self.eval_batch_size):
+            x_batch = np.array(x[start:start + self.eval_batch_size])
+            if self.bucket_batches:
+                x_batch = self._trim_batch(x_batch)
+            feed_dict = {
+                self.input_x: x_batch,
+                self.input_y: np.array(y[start:start + self.eval_batch_size]),
+                self.dropout_keep_prob: 1.0
+            }
+            loss, accuracy, batch_preds = sess.run([self.loss, self.accuracy, self.predictions], feed_dict)
+            losses.append(loss)
+            accuracies.append(accuracy)
+            sizes.append(len(x_batch))
+            preds.append(batch_preds)
+        step = tf.train.global_step(sess, global_step)
+        return step, float(np.average(losses, weights=sizes)), float(np.average(accuracies, weights=sizes)), \
+            np.concatenate(preds)
+
     @with_self_graph
-    def train(self, x_train, y_train, x_dev, y_dev, x_test, y_test):
+    def train(self, x_train, y_train, x_dev, y_dev, x_test, y_test, batch_policy=None):
         """
         Defines the TF graph for training the CNN
         
@@ -415,6 +661,8 @@ class LyricsCNN(object):
             y_dev: ndarray, validation dev labels
             x_test: ndarray, validation test input
             y_test: ndarray, validation test labels
+            batch_policy: BatchPolicy, chooses the training examples of each epoch (optional:
+                default is every example once, shuffled)
             
         Returns: None
         """
@@ -477,10 +725,9 @@ class LyricsCNN(object):
             sess.run(tf.global_variables_initializer())
 
             # Generate batches
-            batches = self._batch_iter(list(zip(x_train, y_train)))
+            batches = self._batch_iter(x_train, y_train, policy=batch_policy)
             # Training loop
-            for batch in batches:
-                x_batch, y_batch = zip(*batch)
+            for x_batch, y_batch in batches:
                 # train for batch
                 self._cnn_step(sess, x_batch, y_batch, global_step, summary_op=test_summary_op, 
                                summary_writer=train_summary_writer, step_writer=csvwriter,
@@ -504,6 +751,22 @@ class LyricsCNN(object):
         return
 
 
+    def train_from_store(self, store_dir, batch_policy=None, **expected):
+        """
+        Trains on the inputs of a tensor store (see tensor_store.py), memory-mapped read-only
+        so that startup does not wait on reading them and concurrent runs share one copy
+
+        Args:
+            store_dir: str, dir of the tensor store
+            batch_policy: BatchPolicy, see train
+            expected: manifest values the store must match (e.g. vocab_size=self.vocab_size)
+
+        Returns: None
+        """
+        tensors = load_tensors(store_dir, mmap_mode='r', **expected)
+        return self.train(*[tensors[name] for name in X_Y_NAMES], batch_policy=batch_policy)
+
+
 def parse_args():
 
     parser = argparse.ArgumentParser()
@@ -0,0 +1,218 @@
+"""
+Bulk loading of lyrics txt files.
+
+Reading the lyrics one song at a time (an os.path.exists and up to three opens per
+file, see utils.read_file_contents) leaves the disk idle while each file is decoded
+and the cpu idle while each file is read. load_lyrics reads every file once, as
+bytes, on a bounded pool of threads so the I/O waits overlap, then decodes them the
+way read_file_contents does (default encoding, then utf-8, then utf-16, with
+universal newlines) and packs them into one string with offsets.
+
+Files that are missing or cannot be decoded load as '' and are reported together
+in a single summary instead of one log line each.
+
+Lyrics that must outlive a shard without staying in memory (e.g. the raw training
+lyrics kept for LineShuffleAugmenter) are written to a LyricsStore on disk:
+
+    <store>/lyrics.utf8     the utf-8 bytes of every song back to back
+    <store>/offsets.npy     int64 byte offsets, song i is bytes offsets[i]:offsets[i + 1]
+"""
+# project imports
+from utils import logger
+
+# python and package imports
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import codecs
+import locale
+import time
+import os
+
+
+LOAD_THREADS = 16
+TEXT_FILE = 'lyrics.utf8'
+OFFSETS_FILE = 'offsets.npy'
+ENCODINGS = [locale.getpreferredencoding(False), 'utf-8', 'utf-16']
+SUMMARY_EXAMPLES = 5
+
+
+def _read_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def decode_lyrics(data):
+    """
+    Decodes the bytes of a lyrics file like read_file_contents reads it in text mode
+
+    Returns: str, or None if no encoding fits
+    """
+    for encoding in ENCODINGS:
+        # like a utf-16 text stream, insist on a byte order mark
+        if encoding == 'utf-16' and data[:2] not in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+            continue
+        try:
+            text = data.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+        return text.replace('\r\n', '\n').replace('\r', '\n')
+    return None
+
+
+class LyricsBuffer(object):
+    """
+    The lyrics of many songs in one contiguous string
+
+    Song i is text[offsets[i]:offsets[i + 1]]; missing and undecodable hold the
+    positions of the songs whose file could not be read or decoded (they are '').
+    A song only becomes a str of its own when it is indexed or iterated over; a
+    slice, e.g. buffer[100:200], is a LyricsBuffer of those songs.
+    """
+
+    def __init__(self, text, offsets, missing=None, undecodable=None):
+        self.text = text
+        self.offsets = offsets
+        self.missing = missing if missing is not None else list()
+        self.undecodable = undecodable if undecodable is not None else list()
+        return
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError('LyricsBuffer slices must be contiguous')
+            offsets = self.offsets[start:max(start, stop) + 1]
+            return LyricsBuffer(self.text[offsets[0]:offsets[-1]], offsets - offsets[0],
+                                [p - start for p in self.missing if start <= p < stop],
+                                [p - start for p in self.undecodable if start <= p < stop])
+        return self.text[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        text = self.text
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield text[start:end]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return '<LyricsBuffer(songs={0}, chars={1})>'.format(len(self), len(self.text))
+
+
+class LyricsStore(object):
+    """
+    The lyrics of many songs in a file on disk, written by LyricsStoreWriter
+
+    The bytes are memory-mapped, so a song is only read and decoded when it is indexed.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.offsets = np.load(os.path.join(store_dir, OFFSETS_FILE))
+        text_path = os.path.join(store_dir, TEXT_FILE)
+        # an empty file cannot be memory-mapped
+        if os.path.getsize(text_path):
+            self.text = np.memmap(text_path, dtype=np.uint8, mode='r')
+        else:
+            self.text = np.zeros(0, dtype=np.uint8)
+        return
+
+    def __getitem__(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return '<LyricsStore(dir={0}, songs={1})>'.format(self.store_dir, len(self))
+
+
+class LyricsStoreWriter(object):
+    """
+    Writes a LyricsStore a shard of songs at a time
+    """
+
+    def __init__(self, store_dir):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.text_file = open(os.path.join(store_dir, TEXT_FILE), 'wb')
+        self.lengths = list()
+        return
+
+    def append(self, lyrics):
+        """
+        Args:
+            lyrics: iterable of str (e.g. a LyricsBuffer), the next songs
+        """
+        encoded = [song.encode('utf-8') for song in lyrics]
+        self.text_file.write(b''.join(encoded))
+        self.lengths.append(np.fromiter((len(song) for song in encoded), dtype=np.int64, count=len(encoded)))
+        return
+
+    def close(self):
+        self.text_file.close()
+        lengths = np.concatenate(self.lengths) if self.lengths else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(self.store_dir, OFFSETS_FILE), offsets)
+        return
+
+
+def file_sizes(paths):
+    """
+    Returns: np.array of int64, the size in bytes of each file (0 if it is missing)
+    """
+    sizes = np.zeros(len(paths), dtype=np.int64)
+    for i, path in enumerate(paths):
+        try:
+            sizes[i] = os.path.getsize(path)
+        except OSError:
+            pass
+    return sizes
+
+
+def load_lyrics(paths, num_threads=LOAD_THREADS):
+    """
+    Reads and decodes many lyrics files concurrently
+
+    Args:
+        paths: list of str, lyrics txt files
+        num_threads: int, max number of files being read at once
+
+    Returns: LyricsBuffer, the lyrics in the order of paths
+    """
+    start = time.time()
+    paths = list(paths)
+    missing = list()
+    undecodable = list()
+    texts = list()
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        for i, data in enumerate(executor.map(_read_bytes, paths)):
+            text = None
+            if data is None:
+                missing.append(i)
+            else:
+                text = decode_lyrics(data)
+                if text is None:
+                    undecodable.append(i)
+            texts.append(text or '')
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    buffer = LyricsBuffer(''.join(texts), offsets, missing, undecodable)
+    del texts
+
+    for name, positions in [('missing', missing), ('undecodable', undecodable)]:
+        if positions:
+            logger.warning('{0} of {1} lyrics files {2}, e.g. {3}'.format(
+                len(positions), len(paths), name, [paths[i] for i in positions[:SUMMARY_EXAMPLES]]))
+    logger.info('loaded {0} lyrics files ({1} chars) in {2:.2f}s'.format(len(buffer), len(buffer.text), time.time() - start))
+    return buffer
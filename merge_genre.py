@@ -1,25 +1,130 @@
 import pandas as pd
+import numpy as np
 import os
 import argparse
 import time
 from utils import configure_logging, logger
 from label_lyrics import CSV_LABELED_LYRICS
+from track_catalog import TrackCatalog, KEY_COL, GENRE_GROUP
+from song_registry import SONG_ID_COL, UNKNOWN_SONG_ID
 
 CSV_LABELED_GENRE = 'data/labeled_genre.csv'
 GENRE_FILE = 'data/genres.csv'
-
-def merge_genres(csv_input, genre_file, csv_output):
+GENRE_COL = 'magd_genre'
+CHUNK_SIZE = 100000
+
+
+def read_genres(genre_file):
+    """
+    Reads the msd_id -> genre tsv with the genre as a categorical
+
+    Returns: pd.Series of category, indexed by msd_id; a track with several genres has one
+        entry per genre
+    """
+    df_genre = pd.read_csv(genre_file, names = [KEY_COL, GENRE_COL], sep = '\t',
+                           dtype = {KEY_COL: str, GENRE_COL: 'category'})
+    logger.debug('{0} genres for {1} tracks'.format(len(df_genre[GENRE_COL].cat.categories), df_genre[KEY_COL].nunique()))
+    return df_genre.set_index(KEY_COL)[GENRE_COL]
+
+
+def merge_genre_chunk(chunk, genres):
+    """
+    Left join of a chunk of the labeled csv with the genre series from read_genres, like
+    pd.merge(chunk, genres, how='left'): a track with several genres gets one row per genre
+
+    Returns: pd.DataFrame
+    """
+    if genres.index.is_unique:
+        chunk[GENRE_COL] = lookup_genres(genres, chunk[KEY_COL])
+        return chunk
+    return chunk.merge(genres.reset_index(), how='left', on=KEY_COL)
+
+
+def first_genres(genres):
+    """
+    Returns: pd.Series, genres with only the first genre of each track
+    """
+    repeated = genres.index.duplicated()
+    if repeated.any():
+        logger.warning('{0} tracks have more than one genre; only the first genre of each is kept'.format(
+            genres.index[repeated].nunique()))
+    return genres[~repeated]
+
+
+def lookup_genres(genres, msd_ids):
+    """
+    Hash join of msd_ids against a genre series with one genre per track (see first_genres)
+
+    Returns: pd.Categorical, NaN where a track has no genre
+    """
+    rows = genres.index.get_indexer(msd_ids)
+    found = rows >= 0
+    codes = np.full(len(rows), -1, dtype=np.int64)
+    codes[found] = genres.cat.codes.values[rows[found]]
+    return pd.Categorical.from_codes(codes, categories=genres.cat.categories)
+
+
+def merge_genres(csv_input, genre_file, csv_output, genre_only=False):
+    """
+    Adds the genre column to the labeled csv. The csv is streamed in chunks of
+    CHUNK_SIZE rows so memory stays bounded no matter how large it is. A track with
+    several genres gets one row per genre.
+
+    Args:
+        csv_input: str, labeled csv
+        genre_file: str, tab delimited msd_id, genre file
+        csv_output: str, csv to write
+        genre_only: bool, if True, only read msd_id and write msd_id and magd_genre
+            instead of the whole labeled csv plus genre
+    """
     start = time.time()
 
     logger.debug('Reading genre file...')
-    df_genre = pd.read_csv(genre_file, names = ['msd_id', 'magd_genre'], sep = '\t')
+    genres = read_genres(genre_file)
+
+    logger.debug('Merging lyrics file in chunks...')
+    usecols = [KEY_COL] if genre_only else None
+    rows = 0
+    header = True
+    # like the other stages, read the strings as strings so every chunk writes them the same way
+    dtype = {KEY_COL: str, 'msd_artist': str, 'msd_title': str}
+    for chunk in pd.read_csv(csv_input, usecols=usecols, dtype=dtype, chunksize=CHUNK_SIZE):
+        chunk = merge_genre_chunk(chunk, genres)
+        chunk.to_csv(csv_output, encoding='utf-8', index=False, header=header, mode='w' if header else 'a')
+        header = False
+        rows += len(chunk)
+        logger.debug('merged {0} rows'.format(rows))
+
+    elapsed_time = time.time() - start
+    logger.debug('Elapsted Time: {0} minutes'.format(elapsed_time / 60))
 
-    logger.debug('Reading lyrics file...')
-    df_labeled = pd.read_csv(csv_input)
 
-    logger.debug('Merging.')
-    final_df = pd.merge(df_labeled, df_genre, how = 'left', on='msd_id')
-    final_df.to_csv(csv_output, encoding='utf-8', index=False)
+def merge_genres_into_catalog(catalog_dir, genre_file):
+    """
+    Writes the genre column group of the track catalog; no other group is read or rewritten.
+    The join is done one artist partition at a time on the catalog's int song ids.
+
+    The catalog holds one row per song, so a track with several genres keeps only its first
+    (merge_genres writes a row per genre instead).
+    """
+    start = time.time()
+
+    logger.debug('Reading genre file...')
+    genres = first_genres(read_genres(genre_file))
+
+    catalog = TrackCatalog(catalog_dir)
+    # direct-address table: genre code of every song id, -1 if the song has no genre
+    song_ids = catalog.registry.encode(genres.index)
+    known = song_ids != UNKNOWN_SONG_ID
+    genre_codes = np.full(len(catalog.registry), -1, dtype=genres.cat.codes.dtype)
+    genre_codes[song_ids[known]] = genres.cat.codes.values[known]
+
+    anchor = catalog.groups()[0]
+    for partition in catalog.partitions(anchor):
+        keys = catalog.read_group(anchor, [], partitions=[partition])
+        keys[GENRE_COL] = pd.Categorical.from_codes(genre_codes[keys[SONG_ID_COL].values],
+                                                    categories=genres.cat.categories)
+        catalog.write_group(GENRE_GROUP, keys, replace=False)
 
     elapsed_time = time.time() - start
     logger.debug('Elapsted Time: {0} minutes'.format(elapsed_time / 60))
@@ -34,11 +139,13 @@ def parse_args():
     parser.add_argument('-g', '--genre_file', action='store', required=False, default=GENRE_FILE, help='File with msd_id, genre tab delimited')
     parser.add_argument('-i', '--csv-input', action='store', required=False, default=CSV_LABELED_LYRICS, help='Artist-Song mapping csv with lyric file paths')
     parser.add_argument('-o', '--csv-output', action='store', required=False, default=CSV_LABELED_GENRE, help='csv to write to (WARNING: will overwite)')
+    parser.add_argument('-G', '--genre-only', action='store_true', required=False, default=False, help='only write msd_id and genre to the output csv')
+    parser.add_argument('-c', '--catalog-dir', action='store', required=False, default=None, help='write the genre column group to this track catalog instead of csvs')
 
     args = parser.parse_args()
 
     # simple arg sanity check
-    if os.path.exists(args.csv_output):
+    if not args.catalog_dir and os.path.exists(args.csv_output):
         logger.warning('Output CSV "{0}" will be overwritten'.format(args.csv_output))
         while True:
             response = input('Is this okay? Please enter Y/N:').lower()
@@ -57,7 +164,10 @@ def main():
 
     configure_logging(logname='merge_genres')
     args = parse_args()
-    merge_genres(args.csv_input, args.genre_file, args.csv_output)
+    if args.catalog_dir:
+        merge_genres_into_catalog(args.catalog_dir, args.genre_file)
+    else:
+        merge_genres(args.csv_input, args.genre_file, args.csv_output, args.genre_only)
 
     return
 
@@ -10,17 +10,30 @@ For an example of how to use the pipeline, please see the main function.
 
 # project imports
 from utils import read_file_contents, full_elapsed_time_str, configure_logging, logger, picklify, unpicklify
-from lyrics2vec import lyrics2vec, LOGS_TF_DIR
+from lyrics2vec import lyrics2vec, LyricsCorpus, LOGS_TF_DIR
 from scrape_lyrics import LYRICS_TXT_DIR
-from lyrics_cnn import LyricsCNN
+from track_catalog import TrackCatalog, CATALOG_MANIFEST
+from song_registry import SongRegistry, SONG_ID_COL, UNKNOWN_SONG_ID
+from token_cache import TokenCache, TOKEN_CACHE_DIR
+from ragged_tokens import RaggedTokens, RaggedTokensWriter
+from lyrics_loader import load_lyrics, file_sizes, LyricsStore, LyricsStoreWriter, LOAD_THREADS
+from stage_cache import StageCache, STAGE_CACHE_DIR, stage_key, file_hash
+from tensor_store import save_tensors, write_tensors, load_manifest, load_pickle, extra_dir, has_tensors, X_Y_NAMES
+from lyrics_cnn import LyricsCNN, BalancedBatchPolicy, oversample_plan
+from run_stats import RunStats, RUN_STATS_FILE
 
 # python and package imports
+from pandas.api.types import union_categoricals
 import pandas as pd
 import numpy as np
+import multiprocessing
 import subprocess
+import functools
 import string
 import shutil
+import json
 import time
+import re
 import os
 
 
@@ -34,20 +47,62 @@ MOOD_CLASSIFICATION_DIR = os.path.join(LOGS_TF_DIR, 'mood_classification')
 os.makedirs(MOOD_CLASSIFICATION_DIR, exist_ok=True)
 MOODS_AND_LYRICS_PICKLE = os.path.join(MOOD_CLASSIFICATION_DIR, 'moods_and_lyrics.pickle')
 VECTORIZED_LYRICS_PICKLE = os.path.join(MOOD_CLASSIFICATION_DIR, 'vectorized_lyrics.pickle')
+MOODS_AND_LYRICS_DIR = os.path.join(MOOD_CLASSIFICATION_DIR, 'moods_and_lyrics')
 X_Y_PICKLE = os.path.join(MOOD_CLASSIFICATION_DIR, 'x_y.pickle')
+X_Y_DIR = os.path.join(MOOD_CLASSIFICATION_DIR, 'x_y')
+LYRICS_CSV = 'data/labeled_lyrics_expanded.csv'
+LYRICS2VEC_STAGE_ATTRS = ['count', 'data', 'dictionary', 'reversed_dictionary']
 LYRICS_CSV_KEEP_COLS = ['msd_id', 'msd_artist', 'msd_title', 'is_english', 'lyrics_available',
                             'wordcount', 'lyrics_filename', 'mood', 'matched_mood']
 LYRICS_CSV_DTYPES = {'msd_id': str, 'msd_artist': str, 'msd_title': str, 'is_english': int, 'lyrics_available': int, 'wordcount': int, 'lyrics_filename': str, 'mood': str, 'matched_mood': int} 
+LYRICS_CSV_FILTER_COLS = ['is_english', 'lyrics_available', 'matched_mood']
+LYRICS_CSV_CHUNK_SIZE = 100000
+# the mood quadrant of each mood; moods mapped to None fit no quadrant and are dropped
+MOOD_QUADRANTS = {
+    'aggression': 'anger', 'angst': 'anger', 'anger': 'anger',
+    'excitement': 'happy', 'upbeat': 'happy', 'cheerful': 'happy', 'happy': 'happy',
+    'depressed': 'sad', 'sad': 'sad', 'grief': 'sad',
+    'calm': 'calm', 'confident': 'calm',
+    'dreamy': None, 'desire': None, 'earnest': None, 'pessimism': None, 'romantic': None, 'brooding': None,
+}
+# approximates word_tokenize (treebank rules) with one compiled regex and no sentence splitting
+FAST_TOKEN_RE = re.compile(r"""
+    \d+(?:[:.,]\d+)+                           # times and numbers: 10:30, 3.5
+    |(?<=\w)n't\b|\w+(?=n't\b)                  # negations: do n't
+    |(?<=\w)'(?:s|re|m|ll|ve|d)\b               # clitics: they 're
+    |\b(?:gon|wan)(?=na\b)|\bgot(?=ta\b)         # gon na, wan na, got ta
+    |\w+(?:(?:'(?!(?:s|re|m|ll|ve|d)\b)|[-/.\x92])\w+)*-?   # words: o'clock, well-known
+    |\.\.\.
+    |[^\w\s]
+""", re.VERBOSE)
+
+
+def regex_tokenize(text):
+    """
+    Fast tokenizer that agrees with word_tokenize on ~99% of tokens in our lyrics
+    (see tokenizer_benchmark.py)
+
+    Returns: list of str
+    """
+    return FAST_TOKEN_RE.findall(text)
+
+
 word_tokenizers = {
     None: 0,
     word_tokenize: 1,
-    WordPunctTokenizer().tokenize: 2
+    WordPunctTokenizer().tokenize: 2,
+    regex_tokenize: 3
 }
 # thank you: https://stackoverflow.com/questions/483666/python-reverse-invert-a-mapping
 word_tokenizers_ids = {v: k for k, v in word_tokenizers.items()}
-COL_PRE_AND_PADDED_LYRICS = 'preprocessed_lyrics_padded'
 COL_VECTORIZED_LYRICS = 'vectorized_lyrics'
-COL_PREPROCESSED_LYRICS = 'preprocessed_lyrics'
+COL_RAW_LYRICS = 'raw_lyrics'
+PARALLEL_CHUNK_SIZE = 500
+PAD_DATA_SEED = 12
+# bytes of lyrics files read at once, and of vectorized rows written at once, in low memory mode
+LOW_MEMORY_SHARD_BYTES = 256 * 2 ** 20
+SPLIT_NAMES = ['train', 'dev', 'test']
+DATASET_MANIFEST = 'dataset.json'
 
 
 def build_tensorboard_cmd(experiments):
@@ -128,31 +183,159 @@ def preprocess_lyrics(lyrics, word_tokenizer, remove_stop=True, remove_punc=True
         list of str: words processed
     """
     # https://stackoverflow.com/questions/17390326/getting-rid-of-stop-words-and-document-tokenization-using-nltk
-    # tokenization
-    stop = []
-    if remove_stop:
-        stop += stopwords.words('english')
-    if remove_punc:
-        stop += list(string.punctuation)
-    tokens = [i for i in word_tokenizer(lyrics.lower()) if i not in stop]
-    # padding
+    preprocessor = get_lyrics_preprocessor(word_tokenizer, remove_stop, remove_punc)
+    tokens = preprocessor.tokenize(lyrics)
     if do_padding:
-        if len(tokens) > cutoff:
-            tokens = tokens[:cutoff]
-        else:
-            tokens += ['<PAD>'] * (int(cutoff) - int(len(tokens)))
+        tokens = preprocessor.pad(tokens, cutoff)
     return tokens
+
+
+class LyricsPreprocessor(object):
+    """
+    Tokenizes lyrics and removes stop words and punctuation
+
+    The stop list is built once, as a frozenset, when the preprocessor is created
+    instead of on every call.
+    """
+
+    def __init__(self, word_tokenizer=regex_tokenize, remove_stop=True, remove_punc=True):
+        """
+        Args:
+            word_tokenizer: func, tokenization function (see word_tokenizers)
+            remove_stop: bool, if True, removes stopwords; Otherwise, does not
+            remove_punc: bool, if True, removes punctuation; Otherwise, does not
+        """
+        self.word_tokenizer = word_tokenizer
+        self.remove_stop = remove_stop
+        self.remove_punc = remove_punc
+        stop = set()
+        if remove_stop:
+            stop.update(stopwords.words('english'))
+        if remove_punc:
+            stop.update(string.punctuation)
+        self.stop = frozenset(stop)
+        return
+
+    def tokenize(self, lyrics):
+        """
+        Returns: list of str, tokens of lyrics without stop words and punctuation
+        """
+        stop = self.stop
+        return [t for t in self.word_tokenizer(lyrics.lower()) if t not in stop]
+
+    def process(self, lyrics_list, do_padding=False, cutoff=None):
+        """
+        Batch version of tokenize
+
+        Args:
+            lyrics_list: iterable of str
+            do_padding: bool, if True, pads (or truncates) each result to <cutoff>
+            cutoff: int, pad limit
+
+        Returns: list of list of str
+        """
+        tokenize = self.tokenize
+        if do_padding:
+            return [self.pad(tokenize(lyrics), cutoff) for lyrics in lyrics_list]
+        return [tokenize(lyrics) for lyrics in lyrics_list]
+
+    @staticmethod
+    def pad(tokens, cutoff):
+        """
+        Truncates tokens to cutoff or pads the end with '<PAD>' up to cutoff
+
+        Returns: list of str
+        """
+        cutoff = int(cutoff)
+        if len(tokens) > cutoff:
+            return tokens[:cutoff]
+        return tokens + ['<PAD>'] * (cutoff - len(tokens))
+
+    def close(self):
+        return
+
+
+@functools.lru_cache(maxsize=None)
+def get_lyrics_preprocessor(word_tokenizer, remove_stop=True, remove_punc=True):
+    """
+    Returns: LyricsPreprocessor, shared by every call with the same arguments
+    """
+    return LyricsPreprocessor(word_tokenizer, remove_stop, remove_punc)
+
+
+# state of a pool worker, set once by the pool initializer
+_worker_state = dict()
+
+
+def _init_preprocess_worker(word_tokenizer, remove_stop, remove_punc):
+    _worker_state['preprocessor'] = LyricsPreprocessor(word_tokenizer, remove_stop, remove_punc)
+
+
+def _preprocess_chunk(lyrics_chunk):
+    return _worker_state['preprocessor'].process(lyrics_chunk)
+
+
+def map_chunks(pool, func, items, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    Runs func over consecutive chunks of items in pool
+
+    Lists and lyrics_loader.LyricsBuffers are sliced as they are, so each chunk of a
+    buffer is sent to its worker as one string.
+
+    Returns: list, the concatenated results in the same order as items
+    """
+    if not hasattr(items, '__getitem__'):
+        items = list(items)
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    return [result for chunk in pool.map(func, chunks) for result in chunk]
+
+
+class ParallelLyricsPreprocessor(LyricsPreprocessor):
+    """
+    LyricsPreprocessor whose batch process() runs in a pool of worker processes
+
+    The tokenizer and stop list are sent to each worker once, when the pool starts.
+    Results come back in input order. Call close() to shut the pool down.
+    """
+
+    def __init__(self, word_tokenizer=regex_tokenize, remove_stop=True, remove_punc=True, num_workers=None):
+        """
+        Args:
+            num_workers: int, number of worker processes (default: one per cpu)
+        """
+        super(ParallelLyricsPreprocessor, self).__init__(word_tokenizer, remove_stop, remove_punc)
+        self.num_workers = num_workers if num_workers else multiprocessing.cpu_count()
+        self._pool = None
+        return
+
+    def process(self, lyrics_list, do_padding=False, cutoff=None):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.num_workers, _init_preprocess_worker,
+                                              (self.word_tokenizer, self.remove_stop, self.remove_punc))
+        tokens = map_chunks(self._pool, _preprocess_chunk, lyrics_list)
+        if do_padding:
+            return [self.pad(t, cutoff) for t in tokens]
+        return tokens
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return
     
 
 def import_lyrics_data(csv_path, usecols=None, dtype=None):
     """
     Imports data from the provided path
     
-    Assumes csv is a csv produced by label_lyrics.py
+    Assumes csv is a csv produced by label_lyrics.py or a track catalog dir
+    (see track_catalog.py) with the index and label column groups
     
     Args:
-        csv_path: str, path to csv to import data from
+        csv_path: str, path to csv or track catalog dir to import data from
         usecols: list, cols to import (optional)
+        dtype: dict, dtypes of cols (optional; ignored for a track catalog as it stores typed columns)
     """
     logger.info('Importing data from {0}'.format(csv_path))
     
@@ -161,13 +344,99 @@ def import_lyrics_data(csv_path, usecols=None, dtype=None):
         # as they are unneeded for the cnn
         usecols = LYRICS_CSV_KEEP_COLS
         dtype = LYRICS_CSV_DTYPES
-    df = pd.read_csv(csv_path, usecols=usecols, dtype=dtype)
+    if os.path.isdir(csv_path):
+        df = TrackCatalog(csv_path).read(usecols)
+    else:
+        df = pd.read_csv(csv_path, usecols=usecols, dtype=dtype)
     
     logger.info('imported data shape: {0}'.format(df.shape))
     
     return df
 
     
+def recode_moods(mood, recode):
+    """
+    Maps the categories of a categorical mood column in one pass over its codes
+
+    Args:
+        mood: pd.Series of category dtype
+        recode: dict of str to str or None, new mood of each mood; None drops the mood's rows
+            and moods that are not in recode are kept as they are
+
+    Returns: pd.Series of category dtype (categories sorted), without the rows of dropped moods
+    """
+    new_moods = [recode.get(m, m) for m in mood.cat.categories]
+    categories = sorted(set(m for m in new_moods if m is not None))
+    position = dict((m, i) for i, m in enumerate(categories))
+    # dropped moods become -2; the extra last slot keeps missing values (code -1) missing
+    code_map = np.array([position[m] if m is not None else -2 for m in new_moods] + [-1], dtype=np.int64)
+    codes = code_map[np.asarray(mood.cat.codes)]
+    keep = codes != -2
+    return pd.Series(pd.Categorical.from_codes(codes[keep], categories), index=mood.index[keep], name=mood.name)
+
+
+def _filter_lyrics_chunk(df, drop, quadrants):
+    df = df[(df.is_english == 1) & (df.lyrics_available == 1) & (df.matched_mood == 1)]
+    if drop:
+        df = df.drop(LYRICS_CSV_FILTER_COLS, axis=1)
+    mood = df.mood if str(df.mood.dtype) == 'category' else df.mood.astype('category')
+    mood = recode_moods(mood, MOOD_QUADRANTS if quadrants else dict())
+    return df.loc[mood.index].assign(mood=mood)
+
+
+def load_lyrics_data(csv_path, quadrants=True, drop=True, chunksize=LYRICS_CSV_CHUNK_SIZE, run_stats=None):
+    """
+    import_lyrics_data and filter_lyrics_data in one pass, a chunk at a time
+
+    Each chunk (csv_path rows or a track catalog partition) is filtered down to the english,
+    lyrics available, mood matched rows as soon as it is read and its mood column, read
+    as a categorical, is recoded to quadrants through MOOD_QUADRANTS. Only the filtered
+    chunks are kept, so memory peaks at the size of the result rather than of the csv.
+
+    Args:
+        csv_path: str, path to csv or track catalog dir to import data from
+        quadrants: bool, flag to group moods into quadrants or not
+        drop: bool, flag to drop the filter cols or not to save memory
+        chunksize: int, number of csv rows read at once
+        run_stats: RunStats, to measure the read and filter stages in (optional)
+
+    Returns: pd.DataFrame with a categorical mood column
+    """
+    logger.info('Importing and filtering data from {0}'.format(csv_path))
+    run_stats = run_stats if run_stats is not None else RunStats()
+    if os.path.isdir(csv_path):
+        catalog = TrackCatalog(csv_path)
+        groups = set(catalog.group_of(col) for col in LYRICS_CSV_KEEP_COLS if col != 'msd_id')
+        partitions = sorted(set(p for group in groups for p in catalog.partitions(group)))
+        chunks = (catalog.read(LYRICS_CSV_KEEP_COLS, partitions=[p]) for p in partitions)
+    else:
+        chunks = pd.read_csv(csv_path, usecols=LYRICS_CSV_KEEP_COLS, dtype=dict(LYRICS_CSV_DTYPES, mood='category'),
+                             chunksize=chunksize)
+    chunks = iter(chunks)
+    rows = 0
+    frames = list()
+    while True:
+        with run_stats.stage('read') as stage:
+            chunk = next(chunks, None)
+            stage['rows'] = len(chunk) if chunk is not None else 0
+        if chunk is None:
+            break
+        rows += len(chunk)
+        with run_stats.stage('filter') as stage:
+            frames.append(_filter_lyrics_chunk(chunk, drop, quadrants))
+            stage['rows'] = len(frames[-1])
+    if not frames:
+        error = 'no lyrics data found in {0}'.format(csv_path)
+        logger.error(error)
+        raise Exception(error)
+    # each chunk has its own mood categories, so they are unioned rather than concatenated as strings
+    mood = union_categoricals([frame.mood for frame in frames], sort_categories=True).remove_unused_categories()
+    df = pd.concat([frame.drop('mood', axis=1) for frame in frames], ignore_index=True)
+    df.insert(list(frames[0].columns).index('mood'), 'mood', mood)
+    logger.info('Kept {0} of {1} rows; data shape after filtering: {2}'.format(len(df), rows, df.shape))
+    return df
+
+
 def filter_lyrics_data(df, drop=True, quadrants=True):
     """
     Removes rows of data not applicable to this project's analysis
@@ -277,26 +546,16 @@ def extract_lyrics_from_file(lyrics_filepath):
 
 def extract_words_from_lyrics(lyrics_series):
     """
-    Concatenates all elements of lyrics_series and creates a list where
-    each element is a single word.
+    Streams all elements of lyrics_series as one sequence of words,
+    leaving out '<PAD>' tokens.
     
     Args:
         words_series: pd.Series, series of song lyrics
         
-    Returns: list
+    Returns: lyrics2vec.LyricsCorpus
     """
-    words = list()
-    listoflists = lyrics_series.tolist()
-    for singlelist in listoflists:
-        if '<PAD>' in singlelist:
-            singlelist = singlelist.remove('<PAD>')
-        if singlelist:
-            words += singlelist
-    #words = ' '.join(lyrics_series)
-    logger.debug('num words = {0}'.format(len(words)))
-    logger.debug('words[:10] = {0}'.format(words[:10]))
-
-    return words
+    logger.debug('num songs = {0}'.format(len(lyrics_series)))
+    return LyricsCorpus(lyrics_series)
 
                  
 def make_lyrics_txt_path(lyrics_filename, lyrics_dir=LYRICS_TXT_DIR):
@@ -332,147 +591,459 @@ def compute_lyrics_cutoff(df):
     return cutoff
 
 
-def pad_data(df):
+def pad_data(df, seed=PAD_DATA_SEED):
     """
     Pads a dataframe so that all moods are equally represented by shuffling the lines of lyrics in the dataframe.
     The strategy employed first duplicates the songs with shuffled lyrics. 
     The fractional value required to make all the categories equal is sampled randomly.
     We do not just sample randomly because then we may get an unequal distribution of padding (certain songs may be selected more than others).
+
+    The plan of which songs to copy is built as an index array and the lines of every copy are
+    shuffled with one permutation over all of their line offsets, so the padded rows are made in
+    a single pass instead of one DataFrame.append per copy.
     
     Args:
-        A dataframe with 'mood', 'lyrics'
+        df: pd.DataFrame with 'mood', 'lyrics'
+        seed: int, seed of the sampling and line shuffling (None for a different padding each call)
     
     Returns:
         A padded dataframe in which each mood has equal size.
-        
-    
     """
-    from functools import reduce
-    from random import shuffle
-    import math
-    
-    def randomize_lyrics(row):
-        song = row.lyrics.split('\n')
-        shuffle(song)
-        row.lyrics = reduce((lambda x,y: x+'\n'+y) ,song)
-        return row
+    rs = np.random.RandomState(seed)
+    plan = oversample_plan(df.mood.values, rs)
+    df_pad = df.iloc[plan].reset_index(drop=True)
+    df_pad['lyrics'] = shuffle_lines(df.lyrics.values, plan, rs)
+    return pd.concat([df, df_pad], ignore_index=True)
 
-    df_pad = pd.DataFrame(columns = df.columns)
-    
-    # Let's first try a strategy where we make all the groups as big as the biggest...
-    target_value = max(df.groupby('mood').agg('count').msd_id)
 
-    for mood in set(df.mood):
-        #first we copy each song so that they're all equally represented
-        current_value = df[df.mood==mood].shape[0]
-        loop = int(math.floor((target_value-current_value)/current_value))
-        for i in range(loop):
-            df_pad = df_pad.append(df[df.mood==mood].apply(randomize_lyrics, axis=1), ignore_index=True) 
+def shuffle_lines(lyrics, plan, rs):
+    """
+    Makes a line-shuffled copy of lyrics[i] for every i in plan
 
-        # now sample to fill in to hit the target_value - current_value
-        n = target_value - current_value - df_pad[df_pad.mood == mood].shape[0]
-        df_pad = df_pad.append(df[df.mood==mood].sample(n).apply(randomize_lyrics, axis=1), ignore_index=True)
-        
-    return df.append(df_pad, ignore_index=True)
+    Args:
+        lyrics: array-like of str
+        plan: np.array of int, positions in lyrics to copy (may repeat)
+        rs: np.random.RandomState
+
+    Returns: list of str
+    """
+    # split each source song once; copies index into its lines
+    lines = [song.split('\n') for song in lyrics]
+    num_lines = np.array([len(song) for song in lines], dtype=np.int64)
+    all_lines = np.empty(num_lines.sum(), dtype=object)
+    all_lines[:] = [line for song in lines for line in song]
+    starts = np.cumsum(num_lines) - num_lines
+
+    counts = num_lines[plan]
+    ends = np.cumsum(counts)
+    owner = np.repeat(np.arange(len(plan)), counts)
+    line_idx = starts[plan][owner] + np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+    # sorting by copy, then by a random key, permutes the lines within each copy
+    line_idx = line_idx[np.lexsort((rs.random_sample(len(line_idx)), owner))]
+    shuffled = all_lines[line_idx]
+    return ['\n'.join(shuffled[end - count:end]) for end, count in zip(ends, counts)]
+
+
+class LineShuffleAugmenter(object):
+    """
+    Makes line-shuffled, vectorized copies of training songs on demand
+
+    The lazy counterpart of pad_data for lyrics_cnn.BalancedBatchPolicy: only the raw
+    training lyrics are kept and each requested copy is shuffled, tokenized, padded,
+    and vectorized when its batch is drawn.
+    """
+
+    def __init__(self, lyrics, preprocessor, lyrics_vectorizer, cutoff, seed=PAD_DATA_SEED):
+        """
+        Args:
+            lyrics: array-like of str (or a lyrics_loader.LyricsStore), raw lyrics of the
+                training set in x_train order
+            preprocessor: LyricsPreprocessor, the one the training set was tokenized with
+            lyrics_vectorizer: lyrics2vec, with the vocabulary the training set was vectorized with
+            cutoff: int, length of each vectorized song
+            seed: int, seed of the line shuffling
+        """
+        self.lyrics = lyrics
+        self.preprocessor = preprocessor
+        self.lyrics_vectorizer = lyrics_vectorizer
+        self.cutoff = cutoff
+        self.rs = np.random.RandomState(seed)
+        return
+
+    def __call__(self, indices):
+        """
+        Returns: np.array of int, one vectorized line-shuffled copy of lyrics[i] per i in indices
+        """
+        # only the songs drawn are read and split into lines; the copies come out the same
+        sources, plan = np.unique(np.asarray(indices, dtype=np.int64), return_inverse=True)
+        shuffled = shuffle_lines([self.lyrics[i] for i in sources], plan.ravel(), self.rs)
+        return self.lyrics_vectorizer.transform_batch(self.preprocessor.process(shuffled), self.cutoff)
+
+
+def shard_bounds(sizes, max_bytes):
+    """
+    Cuts a run of items into consecutive shards of at most max_bytes; an item larger than
+    max_bytes makes a shard of its own
+
+    Args:
+        sizes: np.array of int, bytes of each item
+        max_bytes: int, budget of a shard
+
+    Returns: list of (start, stop)
+    """
+    ends = np.cumsum(sizes)
+    bounds = list()
+    start = 0
+    while start < len(ends):
+        budget = (ends[start - 1] if start else 0) + max_bytes
+        stop = max(int(np.searchsorted(ends, budget, side='right')), start + 1)
+        bounds.append((start, stop))
+        start = stop
+    return bounds
+
+
+def iter_lyrics_shards(df, plan, rs, shard_bytes=None, load_threads=LOAD_THREADS, run_stats=None):
+    """
+    Reads the lyrics of the songs of df, then makes a line-shuffled copy of df's song at each
+    position in plan, a shard at a time
+
+    The copies are the ones pad_data makes: shuffle_lines takes its random numbers from rs in
+    order, so shuffling the plan a shard at a time draws the same numbers as shuffling it at once.
+    Shards hold up to shard_bytes of lyrics files (by their size on disk); when df is read in more
+    than one shard, the songs of each shard of copies are read again. The songs of df stay in the
+    lyrics_loader.LyricsBuffer they were read into; each song becomes a str of its own only when
+    it is tokenized or copied.
+
+    Args:
+        df: pd.DataFrame with a lyrics_filename col
+        plan: np.array of int, positions in df of the songs to copy (see oversample_plan)
+        rs: np.random.RandomState, the one plan was drawn with (None if plan is empty)
+        shard_bytes: int, max bytes of lyrics files read at once (default: all of df's, and
+            as many copies as df has songs)
+        load_threads: int, number of lyrics files read at once
+        run_stats: RunStats, to measure the read_lyrics and pad stages in (optional)
+
+    Returns: iterator of (LyricsBuffer or list of str, bool), the lyrics of a shard and
+        whether they are the songs of df (True, a LyricsBuffer) or copies (False)
+    """
+    run_stats = run_stats if run_stats is not None else RunStats()
+    paths = [make_lyrics_txt_path(x) for x in df.lyrics_filename]
+    if shard_bytes:
+        sizes = file_sizes(paths)
+        bounds = shard_bounds(sizes, shard_bytes)
+        copy_bounds = shard_bounds(sizes[plan], shard_bytes)
+    else:
+        step = max(len(paths), 1)
+        bounds = [(start, min(start + step, len(paths))) for start in range(0, len(paths), step)]
+        copy_bounds = [(start, min(start + step, len(plan))) for start in range(0, len(plan), step)]
+    lyrics = list()
+    for start, stop in bounds:
+        with run_stats.stage('read_lyrics') as stage:
+            lyrics = load_lyrics(paths[start:stop], load_threads)
+            stage['rows'] = len(lyrics)
+        yield lyrics, True
+    for start, stop in copy_bounds:
+        sources = plan[start:stop]
+        if len(bounds) > 1:
+            with run_stats.stage('read_lyrics') as stage:
+                source_lyrics = load_lyrics([paths[i] for i in sources], load_threads)
+                stage['rows'] = len(sources)
+            sources = np.arange(len(sources))
+        else:
+            source_lyrics = lyrics
+        with run_stats.stage('pad') as stage:
+            copies = shuffle_lines(source_lyrics, sources, rs)
+            stage['rows'] = len(copies)
+        del source_lyrics
+        yield copies, False
+
+
+def encode_song_ids(df, registry=None):
+    """
+    Adds the int32 song_id col of each track and drops the msd_artist and msd_title string cols
+
+    The registry is only read: it is extended by the track catalog import (see track_catalog.py)
+    alone. Tracks it does not know get UNKNOWN_SONG_ID, so msd_id is kept next to song_id
+    for output.
+
+    Args:
+        df: pd.DataFrame, with a msd_id col (and optionally a song_id col from a track catalog)
+        registry: SongRegistry, registry to encode with (default: the default track catalog's)
+
+    Returns: pd.DataFrame
+    """
+    if SONG_ID_COL not in df.columns:
+        registry = registry if registry else SongRegistry()
+        df[SONG_ID_COL] = registry.encode(df.msd_id)
+        unknown = (df[SONG_ID_COL] == UNKNOWN_SONG_ID).sum()
+        if unknown:
+            logger.info('{0} of {1} tracks are not in the song registry at {2}; run track_catalog.py to register them'.format(
+                unknown, len(df), registry.registry_dir))
+    return df.drop([c for c in ['msd_artist', 'msd_title'] if c in df.columns], axis=1)
 
 
 def build_lyrics_dataset(lyrics_csv, word_tokenizer, quadrants, pad_data_flag, pad_train_only,
-                         preprocess_col=COL_PREPROCESSED_LYRICS,
-                         preprocess_padded_col=COL_PRE_AND_PADDED_LYRICS):
+                         token_cache_dir=TOKEN_CACHE_DIR, num_workers=1, pad_seed=PAD_DATA_SEED,
+                         keep_train_lyrics=False, load_threads=LOAD_THREADS, shard_bytes=None, run_stats=None,
+                         store_dir=None):
     """
     Imports csv, filters unneeded data, and imports lyrics into a dataframe
     
     Assumes csv is from csv produced by label_lyrics.py
 
+    The lyrics are read, padded (see pad_data), and tokenized a shard at a time, one split
+    after the other, so only the raw lyrics of one shard are in memory at once. With a
+    store_dir, the tokens (and raw training lyrics) of each shard are also written to disk
+    as soon as they are made instead of being gathered in memory, and each split's df is
+    pickled on its own:
+
+        <store>/dataset.json              cutoff and number of songs of each split
+        <store>/train.pickle, dev.pickle, test.pickle
+        <store>/ids.int32, offsets.npy, vocab.pickle    tokens of every split (see RaggedTokensWriter)
+        <store>/raw_lyrics/               raw training lyrics (see lyrics_loader.LyricsStore)
+
     Args:
         lyrics_csv: str, path to lyrics csv file
         word_tokenizer: func, function to tokenize words with
         quadrants: bool, flag to group moods into quadrants or not
         pad_data_flag: bool, flag to equalize mood distributions or not
         pad_train_only: bool, equalize mood label counts for only the training data set and not dev and test
-        preprocess_col: str, df column to save preprocessed lyrics to
-        preprocess_padded_col: str, df column to save preprocessed padded lyrics to
+        token_cache_dir: str, dir of the token cache (see token_cache.py) or None to always tokenize
+        num_workers: int, number of processes to tokenize with
+        pad_seed: int, seed of pad_data
+        keep_train_lyrics: bool, leave the training set unpadded and keep its raw lyrics in
+            COL_RAW_LYRICS, for balancing it batch by batch with LineShuffleAugmenter
+        load_threads: int, number of lyrics files read at once
+        shard_bytes: int, max bytes of lyrics files read at once (default: a whole split;
+            see iter_lyrics_shards)
+        run_stats: RunStats, to measure the load, categorize, split, read_lyrics, pad, and
+            tokenize stages in (optional)
+        store_dir: str, dir to write the dataset to (it is only created once complete);
+            read it back with load_lyrics_dataset
         
-    Returns: list of train pd.DataFrame, dev pd.DataFrame, test pd.DataFrame
+    Returns:
+        list of train pd.DataFrame, dev pd.DataFrame, test pd.DataFrame,
+        list of the ragged_tokens.RaggedTokens of train, dev, and test (views of one container),
+        int, the cutoff to pad the tokens to
+        (None with a store_dir)
     """
+    run_stats = run_stats if run_stats is not None else RunStats()
     # import, filter, and categorize the data
-    df = import_lyrics_data(lyrics_csv)
-    df = filter_lyrics_data(df, drop=True, quadrants=quadrants)
-    df = categorize_lyrics_data(df)
-
-    # import the lyrics into the dataframe
-    # here we make use of panda's apply function to parallelize the IO operation
-    df['lyrics'] = df.lyrics_filename.apply(lambda x: extract_lyrics_from_file(make_lyrics_txt_path(x)))
-    logger.info('Data shape after lyrics addition: {0}'.format(df.shape))
-    logger.info('Df head:\n{0}'.format(df.lyrics.head()))
+    with run_stats.stage('load') as stage:
+        df = load_lyrics_data(lyrics_csv, quadrants=quadrants, run_stats=run_stats)
+        stage['rows'] = len(df)
+    with run_stats.stage('categorize') as stage:
+        df = categorize_lyrics_data(df)
+        df = encode_song_ids(df)
+        stage['rows'] = len(df)
+    logger.info('Data shape before lyrics addition: {0}'.format(df.shape))
     
     cutoff = compute_lyrics_cutoff(df)
     
     logger.info('Splitting data into train, dev, and test')
-    df_train, df_dev, df_test = split_data(df)
-
-    if pad_data:
+    with run_stats.stage('split') as stage:
+        dfs = list(split_data(df))
+        stage['rows'] = len(df)
+    del df
+
+    # the copies that pad each split are planned here and only made as their shard is read
+    plans = [np.zeros(0, dtype=np.int64)] * 3
+    pad_rs = [None] * 3
+    if pad_data_flag:
         logger.info('Sampling and Padding data to balance data.')
-        df_train = pad_data(df_train)
+        padded = [not keep_train_lyrics, not pad_train_only, not pad_train_only]
+        if keep_train_lyrics:
+            logger.info('Leaving train to be balanced during training')
         if not pad_train_only:
-            logger.info('Did not pad dev and test')
-            df_dev = pad_data(df_dev)
-            df_test = pad_data(df_test)
-        print('df_train shape = {}'.format(df_train.shape))
-        print('df_dev shape = {}'.format(df_dev.shape))
-        print('df_test shape = {}'.format(df_test.shape))
-            
-    dfs = [df_train, df_dev, df_test]
+            logger.info('Padding dev and test')
+        for i in np.flatnonzero(padded):
+            pad_rs[i] = np.random.RandomState(pad_seed)
+            plans[i] = oversample_plan(dfs[i].mood.values, pad_rs[i])
+        print('df_train shape = {}'.format((len(dfs[0]) + len(plans[0]), dfs[0].shape[1])))
+        print('df_dev shape = {}'.format((len(dfs[1]) + len(plans[1]), dfs[1].shape[1])))
+        print('df_test shape = {}'.format((len(dfs[2]) + len(plans[2]), dfs[2].shape[1])))
         
-    # preprocess the lyrics
+    # preprocess the lyrics of all three splits into one ragged container
     logger.info('Beginning Preprocessing of Lyrics... this might take a couple minutes)')
     start = time.time()
+    if num_workers > 1:
+        preprocessor = ParallelLyricsPreprocessor(word_tokenizer, num_workers=num_workers)
+    else:
+        preprocessor = get_lyrics_preprocessor(word_tokenizer)
+    token_cache = None
+    if token_cache_dir and word_tokenizer in word_tokenizers:
+        token_cache = TokenCache(word_tokenizers[word_tokenizer], preprocessor.remove_stop,
+                                 preprocessor.remove_punc, token_cache_dir)
+    vocab = list()
+    parts = list()
+    train_lyrics = list()
+    writer, lyrics_writer = None, None
+    if store_dir:
+        # runs sharing a stage cache may write the same store at once
+        tmp_dir = '{0}.{1}.tmp'.format(store_dir.rstrip(os.sep), os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        writer = RaggedTokensWriter(tmp_dir)
+        if keep_train_lyrics:
+            lyrics_writer = LyricsStoreWriter(os.path.join(tmp_dir, COL_RAW_LYRICS))
     for i, df in enumerate(dfs):
-        logger.info('Preprocess for DF {0}'.format(i))
-        df[preprocess_col] = df.lyrics.apply(
-            lambda x: preprocess_lyrics(x, word_tokenizer, do_padding=False, cutoff=cutoff)) 
-        df[preprocess_padded_col] = df.lyrics.apply(
-            lambda x: preprocess_lyrics(x, word_tokenizer, do_padding=True, cutoff=cutoff)) 
-        logger.info('Preprocessing completed')
-        logger.info('dropping df.lyrics')
-        df.drop('lyrics', axis=1)
-        logger.info(full_elapsed_time_str(start))
+        for lyrics, real in iter_lyrics_shards(df, plans[i], pad_rs[i], shard_bytes, load_threads, run_stats):
+            if keep_train_lyrics and i == 0:
+                if lyrics_writer:
+                    lyrics_writer.append(lyrics)
+                else:
+                    train_lyrics.extend(lyrics)
+            with run_stats.stage('tokenize') as stage:
+                if token_cache:
+                    # only the real lyrics are worth caching, not the line-shuffled copies
+                    part = token_cache.process_ragged(preprocessor, lyrics, None if real else set())
+                else:
+                    part = RaggedTokens.from_lists(preprocessor.process(lyrics), vocab)
+                if writer:
+                    writer.append(part)
+                else:
+                    parts.append(part)
+                stage['rows'] = len(lyrics)
+                stage['tokens'] = len(part.flat_ids())
+            del lyrics, part
+    preprocessor.close()
+    if token_cache:
+        token_cache.save()
+    if writer:
+        writer.close()
+        logger.info('Preprocessing completed: {0}'.format(writer))
+    else:
+        tokens = RaggedTokens.concat(parts) if parts else RaggedTokens.from_lists(list())
+        del parts
+        logger.info('Preprocessing completed: {0} ({1} MB)'.format(tokens, tokens.nbytes / 2 ** 20))
+    logger.info(full_elapsed_time_str(start))
+
+    for i, df in enumerate(dfs):
+        df = df.drop('lyrics_filename', axis=1)
+        if len(plans[i]):
+            df = pd.concat([df, df.iloc[plans[i]].reset_index(drop=True)], ignore_index=True)
+        dfs[i] = df
+    if keep_train_lyrics and not lyrics_writer:
+        dfs[0][COL_RAW_LYRICS] = pd.Series(train_lyrics, index=dfs[0].index, dtype=object)
+
+    if store_dir:
+        if lyrics_writer:
+            lyrics_writer.close()
+        for name, df in zip(SPLIT_NAMES, dfs):
+            picklify(df, os.path.join(tmp_dir, '{0}.pickle'.format(name)))
+        with open(os.path.join(tmp_dir, DATASET_MANIFEST), 'w') as f:
+            json.dump({'cutoff': int(cutoff), 'splits': [len(df) for df in dfs]}, f, indent=4, sort_keys=True)
+        # the manifest marks a complete store, so swap the whole dir in at once
+        if os.path.exists(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(tmp_dir, store_dir)
+        logger.info('saved lyrics dataset to {0}'.format(store_dir))
+        return None
     
-    return dfs
+    return dfs, tokens.split([len(df) for df in dfs]), cutoff
 
 
-def vectorize_lyrics_dataset(dfs, lyrics_vectorizer, lyrics_col=COL_PRE_AND_PADDED_LYRICS, 
-                             output_col=COL_VECTORIZED_LYRICS):
+def load_lyrics_dataset(store_dir):
     """
-    Adds a 'vectorized_lyrics' column to the provided dataframe.
-    
-    Column is the integer and processed vector representation of
-    the lyrics column.
+    Reads a dataset written by build_lyrics_dataset(store_dir=...); the tokens stay memory-mapped
+
+    Returns: same as build_lyrics_dataset; the raw training lyrics are not in the train df
+        but in the LyricsStore at raw_lyrics_dir(store_dir)
+    """
+    with open(os.path.join(store_dir, DATASET_MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    dfs = [unpicklify(os.path.join(store_dir, '{0}.pickle'.format(name))) for name in SPLIT_NAMES]
+    return dfs, RaggedTokens.load(store_dir).split(manifest['splits']), manifest['cutoff']
+
+
+def raw_lyrics_dir(store_dir):
+    """
+    Returns: str, the LyricsStore of the raw training lyrics of a dataset written by
+        build_lyrics_dataset(store_dir=...), or None if it kept none
+    """
+    path = os.path.join(store_dir, COL_RAW_LYRICS)
+    return path if os.path.isdir(path) else None
+
+
+def vectorize_lyrics_dataset(tokens, cutoff, lyrics_vectorizer, shard_bytes=None, out=None):
+    """
+    Vectorizes the lyrics of train, dev, and test into int32 matrices
+
+    The splits are vectorized together with lyrics2vec.transform_batch, straight into
+    one preallocated matrix whose rows are in train, dev, test order. With shard_bytes
+    the rows are vectorized that many bytes of rows at a time, which bounds the temporary
+    arrays of transform_batch, and out can hold memory-mapped matrices (see
+    tensor_store.write_tensors). Memory-mapped tokens (see load_lyrics_dataset) are then
+    only read a shard at a time too.
     
     Args:
-        dfs: list of pd.DataFrame, dataframes with <lyrics_col> column to process
+        tokens: list of ragged_tokens.RaggedTokens, the tokens of each df (see build_lyrics_dataset)
+        cutoff: int, length of each vectorized song
         lyrics_vectorizer: lyrics2vec.lyrics2vec, used to vectorize lyrics
-        lyrics_col: str, (optional) column of df to pull lyrics from
-        output_col: str, (optional) column of df to save vectorized lyrics to
+        shard_bytes: int, max bytes of rows vectorized at once (default: all of them)
+        out: list of np.array of int32 of shape (songs, cutoff), the matrix of each df to
+            write to (default: views of one new matrix)
         
     Returns:
-        pd.DataFrame with 'vectorized_lyrics' column
+        list of np.array of int32 of shape (songs, cutoff), the vectorized lyrics of each df
     """
     logger.info("Vectorizing lyrics... (this will take a minute)")
     start = time.time()
 
-    # here we make use of panda's apply function to parallelize the IO operation (again)
-    for i, df in enumerate(dfs):
-        logger.info('Vectorizing DF {0}'.format(i))
-        df[output_col] = df[lyrics_col].apply(lambda x: lyrics_vectorizer.transform(x))
-        logger.info('lyrics vectorized ({0} minutes)'.format((time.time() - start) / 60))
-        logger.debug(df[output_col].head())
-        #logger.info('dropping preprocessed lyrics columns')
-        #df.drop('preprocessed_lyrics', axis=1)
-        #df.drop('preprocessed_lyrics_padded', axis=1)
+    sizes = [len(df_tokens) for df_tokens in tokens]
+    if out is None and not shard_bytes:
+        vectorized = np.empty((sum(sizes), int(cutoff)), dtype=np.int32)
+        lyrics_vectorizer.transform_batch(RaggedTokens.concat(tokens), out=vectorized)
+        out = np.split(vectorized, np.cumsum(sizes)[:-1])
+    else:
+        if out is None:
+            out = np.split(np.empty((sum(sizes), int(cutoff)), dtype=np.int32), np.cumsum(sizes)[:-1])
+        row_bytes = int(cutoff) * np.dtype(np.int32).itemsize
+        for df_tokens, df_out in zip(tokens, out):
+            step = max(shard_bytes // max(row_bytes, 1), 1) if shard_bytes else max(len(df_tokens), 1)
+            for begin in range(0, len(df_tokens), step):
+                end = min(begin + step, len(df_tokens))
+                lyrics_vectorizer.transform_batch(df_tokens.view(begin, end), out=df_out[begin:end])
+    logger.debug(out[0][:5])
 
     logger.info('Elapsed Time: {0} minutes'.format((time.time() - start) / 60))
-    return dfs
+    return out
+
+
+def save_vectorized_lyrics(store_dir, dfs, tokens, cutoff, lyrics_vectorizer, shard_bytes, train_lyrics_dir=None, **meta):
+    """
+    Writes the x_y tensor store of low memory mode straight from the tokens: the lyrics of
+    train, dev, and test are vectorized a shard at a time into the memory-mapped x_train,
+    x_dev, and x_test, next to the class ids of their moods (as split_x_y(sparse_labels=True)
+    makes them), so the vectorized lyrics are written once and never held in memory
+
+    Args:
+        store_dir: str, dir of the store
+        dfs: list of pd.DataFrame with a mood_cats col, train, dev, and test
+        tokens: list of ragged_tokens.RaggedTokens, the tokens of each df
+        cutoff: int, length of each vectorized song
+        lyrics_vectorizer: lyrics2vec.lyrics2vec, used to vectorize lyrics
+        shard_bytes: int, see vectorize_lyrics_dataset
+        train_lyrics_dir: str, a lyrics_loader.LyricsStore of the raw training lyrics to copy
+            into the store as COL_RAW_LYRICS (optional)
+        meta: see tensor_store.save_tensors
+
+    Returns: dict, the manifest of the store
+    """
+    shapes = dict()
+    for name, df_tokens in zip(X_Y_NAMES[::2], tokens):
+        shapes[name] = (len(df_tokens), int(cutoff))
+    for name, df in zip(X_Y_NAMES[1::2], dfs):
+        shapes[name] = (len(df),)
+
+    def fill(out):
+        vectorize_lyrics_dataset(tokens, cutoff, lyrics_vectorizer, shard_bytes, out=[out[name] for name in X_Y_NAMES[::2]])
+        for name, df in zip(X_Y_NAMES[1::2], dfs):
+            out[name][:] = df.mood_cats.values
+
+    num_classes = int(max(df.mood_cats.max() for df in dfs)) + 1
+    dirs = {COL_RAW_LYRICS: train_lyrics_dir} if train_lyrics_dir else None
+    return write_tensors(store_dir, shapes, fill, dirs=dirs, num_classes=num_classes, **meta)
 
 
 def split_data(df):
@@ -489,7 +1060,7 @@ def split_data(df):
     return df_train, df_dev, df_test
 
 
-def split_x_y(df_train, df_dev, df_test, x_col=COL_VECTORIZED_LYRICS, y_col='mood'):
+def split_x_y(df_train, df_dev, df_test, x_col=COL_VECTORIZED_LYRICS, y_col='mood', xs=None, sparse_labels=False):
     """
     Splits the given train, dev, and test dataframes into x and y dataframes.
     
@@ -499,20 +1070,64 @@ def split_x_y(df_train, df_dev, df_test, x_col=COL_VECTORIZED_LYRICS, y_col='moo
         df_test: pd.DataFrame
         x_col: str, column to take x data from
         y_col: str, column to take y labels from
+        xs: list of np.array, x data of train, dev, and test to use as is instead of x_col
+            (see vectorize_lyrics_dataset)
+        sparse_labels: bool, take each y as the int class ids of the <y_col>_cats column
+            (e.g. mood_cats, see categorize_lyrics_data) instead of a one-hot matrix
 
     Returns:
         x_train, y_train, x_dev, y_dev, x_test, y_test np.array objects
     """
-    x_train = np.array(list(df_train[x_col]))
-    y_train = pd.get_dummies(df_train[y_col]).values
-    x_dev = np.array(list(df_dev[x_col]))
-    y_dev = pd.get_dummies(df_dev[y_col]).values
-    x_test = np.array(list(df_test[x_col]))
-    y_test = pd.get_dummies(df_test[y_col]).values
+    if xs is not None:
+        x_train, x_dev, x_test = xs
+    else:
+        x_train = np.array(list(df_train[x_col]))
+        x_dev = np.array(list(df_dev[x_col]))
+        x_test = np.array(list(df_test[x_col]))
+    if sparse_labels:
+        cats_col = '{0}_cats'.format(y_col)
+        y_train, y_dev, y_test = [df[cats_col].values for df in [df_train, df_dev, df_test]]
+    else:
+        y_train = pd.get_dummies(df_train[y_col]).values
+        y_dev = pd.get_dummies(df_dev[y_col]).values
+        y_test = pd.get_dummies(df_test[y_col]).values
   
     return x_train, y_train, x_dev, y_dev, x_test, y_test 
 
 
+def pipeline_stage_keys(lyrics_csv, word_tokenizer_id, quadrants, pad_data_flag, pad_train_only,
+                        keep_train_lyrics, vocab_size, embeddings_train_data_only, low_memory_mode=False):
+    """
+    Computes the stage cache key of each cached stage of mood_classification
+
+    A stage's key covers its own parameters and the key of every stage it reads from. The
+    dataset also depends on the song registry its song ids come from (see encode_song_ids).
+    When lyrics_csv is a track catalog dir, its manifest, which every write to the catalog
+    rewrites, stands in for the csv. Low memory mode stores the dataset as a dir and
+    vectorizes it straight into the x_y store, so it has no vectorized stage.
+
+    Returns: list of (stage, key) in pipeline order
+    """
+    if os.path.isdir(lyrics_csv):
+        data = file_hash(os.path.join(lyrics_csv, CATALOG_MANIFEST))
+        registry = TrackCatalog(lyrics_csv).registry
+    else:
+        data = file_hash(lyrics_csv)
+        registry = SongRegistry()
+    dataset = stage_key('dataset', csv=data, tokenizer=word_tokenizer_id, quadrants=quadrants,
+                        pad_data=pad_data_flag, pad_train_only=pad_train_only, pad_seed=PAD_DATA_SEED,
+                        keep_train_lyrics=keep_train_lyrics, song_registry=registry.fingerprint(),
+                        low_memory=low_memory_mode)
+    vocab = stage_key('lyrics2vec', dataset=dataset, vocab_size=vocab_size,
+                      train_data_only=embeddings_train_data_only)
+    if low_memory_mode:
+        x_y = stage_key('x_y', dataset=dataset, lyrics2vec=vocab)
+        return [('dataset', dataset), ('lyrics2vec', vocab), ('x_y', x_y)]
+    vectorized = stage_key('vectorized', dataset=dataset, lyrics2vec=vocab)
+    x_y = stage_key('x_y', vectorized=vectorized)
+    return [('dataset', dataset), ('lyrics2vec', vocab), ('vectorized', vectorized), ('x_y', x_y)]
+
+
 def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyrics,
                         use_pretrained_embeddings, regen_pretrained_embeddings, 
                         cnn_train_embeddings, embeddings_train_data_only, word_tokenizer,
@@ -520,7 +1135,8 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
                         l2_reg_lambda, batch_size, num_epochs, skip_to_training, quadrants,
                         pad_data_flag, pad_train_only, low_memory_mode, evaluate_every,
                         checkpoint_every, num_checkpoints, launch_tensorboard=False, name=None,
-                        best_model=None):
+                        best_model=None, num_workers=1, balance_batches=False, stage_cache_dir=None,
+                        bucket_batches=False):
     """
     Our Lyric Mood Classification Pipeline.
     
@@ -534,6 +1150,9 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
 
     The options allow for configuration of the pipeline to manipulate or skip stages of the pipe. Note
     that skipping stages assumes that you've run them once before and saved the associated pickle.
+
+    The wall time, cpu time, peak memory, and row counts of each step and its main sub-steps are
+    written to run_stats.json next to the model's model_params.json (see run_stats.py).
     
     Args for Pipeline Control:
 
@@ -549,9 +1168,22 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
         quadrants: bool, group moods into quadrants or not
         pad_data_flag: bool, equalize mood label counts by oversampling and shuffling lyrics
         pad_train_only: bool, equalize mood label counts for only the training data set and not dev and test
-        low_memory_mode: bool, activate low memory mode or not (useful if pad_data_flag is on)
+        low_memory_mode: bool, activate low memory mode or not (useful if pad_data_flag is on): lyrics are
+            read, padded, and tokenized LOW_MEMORY_SHARD_BYTES of lyrics files at a time and each shard's
+            tokens are written to a MOODS_AND_LYRICS_DIR dataset store (or cache dir) instead of a pickle;
+            lyrics2vec and step 3 read the tokens memory-mapped, step 3 vectorizes them a shard at a time
+            straight into the x_y tensor store (there is no separate vectorized stage), and dev and test
+            are evaluated a batch at a time
         launch_tensorboard: bool, launch tensorboard during training (default: False)
         best_model: (str, str), name of best model and path to model's summary dir for tensorboard visualization
+        num_workers: int, processes to tokenize lyrics with in step 1 (default: 1)
+        balance_batches: bool, instead of padding the training set, draw class-balanced epochs from it
+            and line-shuffle the extra copies as they are drawn (default: False)
+        stage_cache_dir: str, keep the outputs of steps 1, 3, and 4 in a StageCache here instead of the
+            fixed pickles (default: None). Each stage is reused while its inputs and parameters are
+            unchanged and recomputed otherwise, so skip_to_training is not needed; the regen_dataset,
+            regen_lyrics2vec_dataset, and revectorize_lyrics flags force a stage (and those after it)
+            to be recomputed.
 
     Args for Model Hyperparameters:
    
@@ -568,6 +1200,8 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
         evaluate_every: int, interval of steps model reports accuracy on dev set
         checkpoint_every: int, interval of steps model saves a checkpoint
         num_checkpoints: int, total number of checkpoints to save
+        bucket_batches: bool, train on batches of songs of similar length, each padded only to its
+            longest song instead of the lyrics cutoff (default: False)
 
     Args for Embeddings Parameters:
 
@@ -577,52 +1211,112 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
     Returns: None
     """
     mood_classification_time = time.time()
+    # timings, peak memory, and row counts of each step, saved next to the model's params
+    run_stats = RunStats()
     
+    shard_bytes = None
     if low_memory_mode:
+        # lyrics are read and vectorized a shard at a time, the tokens and vectorized lyrics go
+        # to disk, and dev and test are evaluated in batches
         logger.info('Engaging Low Memory Mode')
-        col_preprocessed_lyrics = 'lyricsp'    # needs to be separate as this is input into embeddings
-        col_pre_and_padded_lyrics = 'lyrics' # and this is input into CNN
-        col_vectorized_lyrics = 'lyrics'
-    else:
-        col_pre_and_padded_lyrics = COL_PRE_AND_PADDED_LYRICS
-        col_vectorized_lyrics = COL_VECTORIZED_LYRICS
-        col_preprocessed_lyrics = COL_PREPROCESSED_LYRICS
+        shard_bytes = LOW_MEMORY_SHARD_BYTES
+    tensor_meta = {'vocab_size': vocab_size, 'word_tokenizer': word_tokenizers[word_tokenizer]}
     
-    if not skip_to_training:
+    stage_cache = None
+    stale = set()
+    if stage_cache_dir:
+        # stages are looked up by what they depend on; forced stages and all that follow are recomputed
+        stage_cache = StageCache(stage_cache_dir)
+        stage_keys = pipeline_stage_keys(LYRICS_CSV, word_tokenizers[word_tokenizer], quadrants,
+                                         pad_data_flag, pad_train_only, balance_batches,
+                                         vocab_size, embeddings_train_data_only, low_memory_mode)
+        # low memory mode vectorizes straight into the x_y stage
+        vectorized_stage = 'x_y' if low_memory_mode else 'vectorized'
+        forced = set(stage for stage, force in [('dataset', regen_dataset), ('lyrics2vec', regen_lyrics2vec_dataset),
+                                                (vectorized_stage, revectorize_lyrics)] if force)
+        stale = stage_cache.stale_stages(stage_keys, forced)
+        stage_keys = dict(stage_keys)
+        logger.info('stages to compute: {0}'.format(sorted(stale)))
+
+    if stage_cache or not skip_to_training:
 
         # -------------------------------------------------------
         logger.info('Step 1: Load Lyrics and Build Dataset')
         step_time = time.time()
-
-        if regen_dataset:
+        run_stats.begin('dataset')
+
+        dfs, tokens, cutoff = None, None, None
+        dataset_dir = None
+        if stage_cache and 'dataset' not in stale:
+            # the dataset is only read if a later stage needs to be computed from it
+            if stale & set(['lyrics2vec', vectorized_stage]):
+                if low_memory_mode:
+                    dataset_dir = stage_cache.load_dir('dataset', stage_keys['dataset'])
+                    dfs, tokens, cutoff = load_lyrics_dataset(dataset_dir)
+                else:
+                    dfs, tokens, cutoff = stage_cache.load('dataset', stage_keys['dataset'])
+        elif stage_cache or regen_dataset:
             logger.info('building lyrics dataset')
-            dfs = build_lyrics_dataset('data/labeled_lyrics_expanded.csv',
-                                       word_tokenizer, quadrants,
-                                       pad_data_flag, pad_train_only,
-                                       preprocess_col=col_preprocessed_lyrics,
-                                       preprocess_padded_col=col_pre_and_padded_lyrics)
-            # some columns are lists so must use pickle not df.to_csv
-            #df.to_csv(MOODS_AND_LYRICS_CSV, encoding='utf-8')
-            picklify(dfs, MOODS_AND_LYRICS_PICKLE)
+            build = functools.partial(build_lyrics_dataset, LYRICS_CSV,
+                                      word_tokenizer, quadrants,
+                                      pad_data_flag, pad_train_only,
+                                      num_workers=num_workers,
+                                      keep_train_lyrics=balance_batches,
+                                      shard_bytes=shard_bytes, run_stats=run_stats)
+            if low_memory_mode:
+                # written to disk a shard at a time and read back memory-mapped
+                if stage_cache:
+                    dataset_dir = stage_cache.save_dir('dataset', stage_keys['dataset'],
+                                                       lambda path: build(store_dir=path))
+                else:
+                    dataset_dir = MOODS_AND_LYRICS_DIR
+                    build(store_dir=dataset_dir)
+                dfs, tokens, cutoff = load_lyrics_dataset(dataset_dir)
+            else:
+                dfs, tokens, cutoff = build()
+                # the tokens are not a df column so must use pickle not df.to_csv
+                #df.to_csv(MOODS_AND_LYRICS_CSV, encoding='utf-8')
+                if stage_cache:
+                    stage_cache.save('dataset', stage_keys['dataset'], [dfs, tokens, cutoff])
+                else:
+                    picklify([dfs, tokens, cutoff], MOODS_AND_LYRICS_PICKLE)
+        elif low_memory_mode:
+            logger.info('reading dataset from {0}'.format(MOODS_AND_LYRICS_DIR))
+            dataset_dir = MOODS_AND_LYRICS_DIR
+            dfs, tokens, cutoff = load_lyrics_dataset(dataset_dir)
         else:
             logger.info('reading dataset from {0}'.format(MOODS_AND_LYRICS_PICKLE))
             #df = pd.read_csv(MOODS_AND_LYRICS_CSV, encoding='utf-8')
-            dfs = unpicklify(MOODS_AND_LYRICS_PICKLE)
+            dfs, tokens, cutoff = unpicklify(MOODS_AND_LYRICS_PICKLE)
            
         #df = df[df.wordcount > 10]
 
-        lyrics2vec_input_df = dfs[0] if embeddings_train_data_only else pd.concat(dfs)
-        lyrics_vectorizer = lyrics2vec.init_from_lyrics(
-            vocab_size,
-            extract_words_from_lyrics(lyrics2vec_input_df[col_preprocessed_lyrics]),
-            word_tokenizers[word_tokenizer],
-            unpickle=not regen_lyrics2vec_dataset)
-
+        if stage_cache and 'lyrics2vec' not in stale:
+            lyrics_vectorizer = lyrics2vec(vocab_size, word_tokenizers[word_tokenizer])
+            for attr, value in stage_cache.load('lyrics2vec', stage_keys['lyrics2vec']).items():
+                setattr(lyrics_vectorizer, attr, value)
+        else:
+            # the splits are adjacent views of one container, so joining them copies nothing
+            lyrics2vec_input = tokens[0] if embeddings_train_data_only else RaggedTokens.concat(tokens)
+            with run_stats.stage('lyrics2vec') as stage:
+                lyrics_vectorizer = lyrics2vec.init_from_lyrics(
+                    vocab_size,
+                    lyrics2vec_input,
+                    word_tokenizers[word_tokenizer],
+                    unpickle=not regen_lyrics2vec_dataset and not stage_cache)
+                stage['rows'] = len(lyrics2vec_input)
+            del lyrics2vec_input
+            if stage_cache:
+                stage_cache.save('lyrics2vec', stage_keys['lyrics2vec'],
+                                 dict((attr, getattr(lyrics_vectorizer, attr)) for attr in LYRICS2VEC_STAGE_ATTRS))
+
+        run_stats.end()
         logger.info('Step 1 {0}'.format(full_elapsed_time_str(step_time)))
         logger.info('Mood Classification {0}'.format(full_elapsed_time_str(mood_classification_time)))
         # -------------------------------------------------------
         logger.info('Step 2: Train Embeddings (Optionally)')
         step_time = time.time()
+        run_stats.begin('embeddings')
 
         if regen_pretrained_embeddings:
             logger.info('regenerating pretrained embeddings')
@@ -634,19 +1328,39 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
             lyrics_vectorizer.load_embeddings()
             logger.info('embeddings shape: {0}'.format(lyrics_vectorizer.final_embeddings.shape))
 
+        run_stats.end()
         logger.info('Step 2 {0}'.format(full_elapsed_time_str(step_time)))
         logger.info('Mood Classification {0}'.format(full_elapsed_time_str(mood_classification_time)))
         # -------------------------------------------------------
         logger.info('Step 3: Vectorize Lyrics')
         step_time = time.time()
-
-        if revectorize_lyrics:
-            dfs = vectorize_lyrics_dataset(dfs, lyrics_vectorizer,
-                                         lyrics_col=col_pre_and_padded_lyrics, 
-                                         output_col=col_vectorized_lyrics)
-            picklify(dfs, VECTORIZED_LYRICS_PICKLE)
+        vectorize_stage = run_stats.begin('vectorize')
+
+        xs = None
+        x_y_dir = None
+        if low_memory_mode:
+            if (stage_cache and 'x_y' in stale) or (not stage_cache and revectorize_lyrics):
+                # vectorized a shard at a time straight into the x_y store that step 4 uses as is
+                write = lambda path: save_vectorized_lyrics(path, dfs, tokens, cutoff, lyrics_vectorizer, shard_bytes,
+                                                            raw_lyrics_dir(dataset_dir), **tensor_meta)
+                if stage_cache:
+                    x_y_dir = stage_cache.save_dir('x_y', stage_keys['x_y'], write)
+                else:
+                    x_y_dir = X_Y_DIR
+                    write(x_y_dir)
+                vectorize_stage['rows'] = sum(len(df_tokens) for df_tokens in tokens)
+        elif stage_cache and 'vectorized' not in stale:
+            if 'x_y' in stale:
+                dfs, xs = stage_cache.load('vectorized', stage_keys['vectorized'])
+        elif stage_cache or revectorize_lyrics:
+            xs = vectorize_lyrics_dataset(tokens, cutoff, lyrics_vectorizer)
+            if stage_cache:
+                stage_cache.save('vectorized', stage_keys['vectorized'], [dfs, xs])
+            else:
+                picklify([dfs, xs], VECTORIZED_LYRICS_PICKLE)
         else:
-            dfs = unpicklify(VECTORIZED_LYRICS_PICKLE)
+            dfs, xs = unpicklify(VECTORIZED_LYRICS_PICKLE)
+        tokens = None
 
         # drop half of calm
         if False:
@@ -664,29 +1378,82 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
         #logger.info('Example preprocessed lyrics: {0}'.format(df.preprocessed_lyrics_padded.iloc[0]))
         #logger.info('Example vectorized lyrics: {0}'.format(df.vectorized_lyrics.iloc[0]))
 
+        if xs is not None:
+            vectorize_stage['rows'] = sum(len(x) for x in xs)
+        run_stats.end()
         logger.info('Step 3 {0}'.format(full_elapsed_time_str(step_time)))
         logger.info('Mood Classification {0}'.format(full_elapsed_time_str(mood_classification_time)))
 
     # -------------------------------------------------------
     logger.info('Step 4: Prepare to Train the CNN')
     step_time = time.time()
-
-    if not skip_to_training:
+    run_stats.begin('prepare')
+
+    if stage_cache and 'x_y' not in stale:
+        x_y_dir = stage_cache.load_dir('x_y', stage_keys['x_y'])
+    elif low_memory_mode and (stage_cache or not skip_to_training):
+        # step 3 wrote the x_y store, labels included (or left the last one in place)
+        x_y_dir = x_y_dir or X_Y_DIR
+    elif stage_cache or not skip_to_training:
         # make inputs and labels
         logger.info("split train, dev, and test into x and y inputs and labels")
-        x_train, y_train, x_dev, y_dev, x_test, y_test = split_x_y(dfs[0], dfs[1], dfs[2], 
-                                                                   x_col=col_vectorized_lyrics)
-        picklify([x_train, y_train, x_dev, y_dev, x_test, y_test], X_Y_PICKLE)
+        with run_stats.stage('split_x_y') as stage:
+            x_y = split_x_y(dfs[0], dfs[1], dfs[2], xs=xs, sparse_labels=True)
+            stage['rows'] = sum(len(x) for x in x_y[::2])
+        num_classes = int(max(df.mood_cats.max() for df in dfs)) + 1
+        pickles = dict()
+        if COL_RAW_LYRICS in dfs[0]:
+            pickles[COL_RAW_LYRICS] = dfs[0][COL_RAW_LYRICS].values
+        write = lambda path: save_tensors(path, dict(zip(X_Y_NAMES, x_y)), pickles, num_classes=num_classes,
+                                          **tensor_meta)
+        if stage_cache:
+            x_y_dir = stage_cache.save_dir('x_y', stage_keys['x_y'], write)
+        else:
+            x_y_dir = X_Y_DIR
+            write(x_y_dir)
+        # training reads the inputs back from the memory-mapped store
+        del x_y, pickles
 
     else:
-        x_train, y_train, x_dev, y_dev, x_test, y_test = unpicklify(X_Y_PICKLE)
+        x_y_dir = X_Y_DIR
+        if not has_tensors(x_y_dir) and os.path.exists(X_Y_PICKLE):
+            logger.info('converting {0} to a tensor store in {1}'.format(X_Y_PICKLE, x_y_dir))
+            x_y = list(unpicklify(X_Y_PICKLE))
+            num_classes = x_y[1].shape[1]
+            # the pickled labels are one-hot; store their class ids
+            for i in [1, 3, 5]:
+                x_y[i] = np.argmax(x_y[i], axis=1)
+            save_tensors(x_y_dir, dict(zip(X_Y_NAMES, x_y)), num_classes=num_classes, **tensor_meta)
+            del x_y
         lyrics_vectorizer = lyrics2vec(vocab_size, word_tokenizers[word_tokenizer])
         lyrics_vectorizer.load_embeddings()
+        if balance_batches:
+            lyrics_vectorizer.load_dataset()
+    dfs, xs = None, None
+    manifest = load_manifest(x_y_dir)
+    x_y_shapes = dict((name, array['shape']) for name, array in manifest['arrays'].items())
+    # stores written before integer labels hold one-hot y matrices
+    sparse_labels = len(x_y_shapes['y_train']) == 1
+
+    batch_policy = None
+    if balance_batches:
+        logger.info('balancing training batches with line-shuffled copies')
+        train_lyrics = load_pickle(x_y_dir, COL_RAW_LYRICS)
+        if train_lyrics is None and extra_dir(x_y_dir, COL_RAW_LYRICS):
+            # low memory mode copies in the raw lyrics as a store read song by song
+            train_lyrics = LyricsStore(extra_dir(x_y_dir, COL_RAW_LYRICS))
+        if train_lyrics is None:
+            error = 'dataset has no raw training lyrics to balance; rebuild it with regen_dataset'
+            logger.error(error)
+            raise Exception(error)
+        augmenter = LineShuffleAugmenter(train_lyrics, get_lyrics_preprocessor(word_tokenizer),
+                                         lyrics_vectorizer, x_y_shapes['x_train'][1])
+        batch_policy = BalancedBatchPolicy(augmenter, seed=PAD_DATA_SEED)
         
     cnn = LyricsCNN(
         # Data parameters
-        sequence_length=x_train.shape[1],
-        num_classes=y_train.shape[1],
+        sequence_length=x_y_shapes['x_train'][1],
+        num_classes=manifest['num_classes'] if sparse_labels else x_y_shapes['y_train'][1],
         vocab_size=vocab_size,
         # Model Hyperparameters
         embedding_size=embedding_size,
@@ -702,7 +1469,10 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
         num_checkpoints=num_checkpoints,
         pretrained_embeddings=None if not use_pretrained_embeddings else lyrics_vectorizer.final_embeddings,
         train_embeddings=cnn_train_embeddings,
-        name=name)
+        name=name,
+        sparse_labels=sparse_labels,
+        bucket_batches=bucket_batches,
+        eval_batch_size=batch_size if low_memory_mode else None)
     
     logger.info('Checking for prexisting data...')
     # check for prexisting data; we don't want to overwrite something on accident!
@@ -738,6 +1508,7 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
         # launch
         tb_proc = subprocess.Popen(tb_cmd.split())
     
+    run_stats.end()
     logger.info('Step 4 {0}'.format(full_elapsed_time_str(step_time)))
     logger.info('Mood Classification {0}'.format(full_elapsed_time_str(mood_classification_time)))
     # -------------------------------------------------------
@@ -745,13 +1516,9 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
     step_time = time.time()
 
     try:
-        cnn.train(
-            x_train,
-            y_train,
-            x_dev,
-            y_dev,
-            x_test,
-            y_test)
+        with run_stats.stage('train') as stage:
+            stage['rows'] = x_y_shapes['x_train'][0]
+            cnn.train_from_store(x_y_dir, batch_policy=batch_policy, **tensor_meta)
     except Exception as e:
         logger.info('we had a problem...')
         logger.error(str(e))
@@ -769,6 +1536,7 @@ def mood_classification(regen_dataset, regen_lyrics2vec_dataset, revectorize_lyr
    
     logger.info('Step 5 {0}'.format(full_elapsed_time_str(step_time)))
     logger.info('Mood Classification {0}'.format(full_elapsed_time_str(mood_classification_time)))
+    run_stats.save(os.path.join(cnn.output_dir, RUN_STATS_FILE))
      
     return
 
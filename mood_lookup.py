@@ -0,0 +1,304 @@
+"""
+Point lookups of mood labels without loading the labeled csv into pandas.
+
+Building the index scans the labeled csv once and records the byte offset of every
+row. Rows are indexed by msd_id and by artist/title (normalized the same way as
+lyrics filenames, see scrape_lyrics.make_lyric_file_name). Each key is hashed to 64
+bits and the hashes are stored sorted, so a lookup is a binary search over a
+memory-mapped array followed by a seek and a single-line read of the csv:
+
+    <csv>.index/msd_hashes.npy     sorted uint64 hashes of msd_id
+    <csv>.index/msd_rows.npy       row of each msd hash
+    <csv>.index/song_hashes.npy    sorted uint64 hashes of artist/title
+    <csv>.index/song_rows.npy      row of each song hash
+    <csv>.index/row_offsets.npy    byte offset of each row in the csv
+    <csv>.index/meta.json          size and mtime of the csv the index was built from
+
+The index is rebuilt automatically when the csv changes.
+
+Recommended Command:
+
+    python mood_lookup.py -i data/labeled_lyrics_expanded.csv
+
+Output: data/labeled_lyrics_expanded.csv.index
+"""
+# project imports
+from label_lyrics import CSV_LABELED_LYRICS_EXPANDED, MOOD_CATEGORIES_EXPANDED
+from scrape_lyrics import make_lyric_file_name
+from utils import configure_logging, logger, full_elapsed_time_str
+
+# python and package imports
+import numpy as np
+import argparse
+import hashlib
+import json
+import time
+import csv
+import io
+import os
+
+
+INDEX_ARRAYS = ['msd_hashes', 'msd_rows', 'song_hashes', 'song_rows', 'row_offsets']
+INT_COLS = ['found_tags', 'matched_mood']
+
+
+def index_dir_for(labeled_csv):
+    return labeled_csv + '.index'
+
+
+def key_hash(key):
+    """
+    Returns: int, stable 64 bit hash of key
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def song_key(artist, title):
+    """
+    Normalizes an artist/title pair so lookups ignore case, spacing, and punctuation
+    """
+    return make_lyric_file_name(artist, title).lower()
+
+
+def _csv_stamp(labeled_csv):
+    stat = os.stat(labeled_csv)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _iter_rows(f):
+    """
+    Yields (byte offset, raw bytes) of each csv record, keeping quoted newlines in their record
+    """
+    offset = f.tell()
+    record = b''
+    for line in f:
+        if not record:
+            start = offset
+        record += line
+        offset += len(line)
+        if record.count(b'"') % 2 == 0:
+            yield start, record
+            record = b''
+    if record:
+        yield start, record
+
+
+def _parse_record(record):
+    return next(csv.reader(io.StringIO(record.decode('utf-8'))))
+
+
+def build_index(labeled_csv=CSV_LABELED_LYRICS_EXPANDED, index_dir=None):
+    """
+    Scans labeled_csv once and writes its lookup index
+
+    Args:
+        labeled_csv: str, csv produced by label_lyrics.py
+        index_dir: str, where to write the index (default: <csv>.index)
+
+    Returns: None
+    """
+    index_dir = index_dir if index_dir else index_dir_for(labeled_csv)
+    logger.info('Building mood lookup index for {0} in {1}'.format(labeled_csv, index_dir))
+    start = time.time()
+
+    offsets = list()
+    msd_hashes = list()
+    song_hashes = list()
+    with open(labeled_csv, 'rb') as f:
+        rows = _iter_rows(f)
+        _, header = next(rows)
+        header = _parse_record(header)
+        msd_col, artist_col, title_col = [header.index(c) for c in ['msd_id', 'msd_artist', 'msd_title']]
+        for offset, record in rows:
+            values = _parse_record(record)
+            offsets.append(offset)
+            msd_hashes.append(key_hash(values[msd_col]))
+            song_hashes.append(key_hash(song_key(values[artist_col], values[title_col])))
+
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {'row_offsets': np.array(offsets, dtype=np.int64)}
+    for name, hashes in [('msd', msd_hashes), ('song', song_hashes)]:
+        hashes = np.array(hashes, dtype=np.uint64)
+        order = np.argsort(hashes, kind='mergesort')
+        arrays['{0}_hashes'.format(name)] = hashes[order]
+        arrays['{0}_rows'.format(name)] = order.astype(np.int32)
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(index_dir, '{0}.npy'.format(name)), arrays[name])
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(_csv_stamp(labeled_csv), header=header), f, indent=4)
+
+    logger.info('Indexed {0} rows'.format(len(offsets)))
+    logger.info(full_elapsed_time_str(start))
+    return
+
+
+class MoodLookup(object):
+    """
+    Read-only mood label lookups over a labeled csv
+
+    Nothing is read until the first lookup; the index arrays are memory-mapped and
+    only the matching csv lines are read.
+    """
+
+    def __init__(self, labeled_csv=CSV_LABELED_LYRICS_EXPANDED, index_dir=None):
+        """
+        Args:
+            labeled_csv: str, csv produced by label_lyrics.py
+            index_dir: str, location of the index (default: <csv>.index)
+        """
+        self.labeled_csv = labeled_csv
+        self.index_dir = index_dir if index_dir else index_dir_for(labeled_csv)
+        self._arrays = None
+        self._csv = None
+        self.header = None
+        return
+
+    def _open(self):
+        meta_path = os.path.join(self.index_dir, 'meta.json')
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        stamp = _csv_stamp(self.labeled_csv)
+        if not meta or meta['size'] != stamp['size'] or meta['mtime'] != stamp['mtime']:
+            build_index(self.labeled_csv, self.index_dir)
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        self.header = meta['header']
+        self._scoreboard_cols = [c for c in self.header if c in MOOD_CATEGORIES_EXPANDED]
+        self._arrays = dict((name, np.load(os.path.join(self.index_dir, '{0}.npy'.format(name)), mmap_mode='r'))
+                            for name in INDEX_ARRAYS)
+        self._csv = open(self.labeled_csv, 'rb')
+        return
+
+    def close(self):
+        if self._csv:
+            self._csv.close()
+        self._csv = None
+        self._arrays = None
+        return
+
+    def _candidate_rows(self, name, key):
+        hashes = self._arrays['{0}_hashes'.format(name)]
+        h = np.uint64(key_hash(key))
+        lo = np.searchsorted(hashes, h, side='left')
+        hi = np.searchsorted(hashes, h, side='right')
+        return self._arrays['{0}_rows'.format(name)][lo:hi]
+
+    def _read_row(self, row):
+        self._csv.seek(int(self._arrays['row_offsets'][row]))
+        # a record may span lines if a quoted field holds a newline
+        _, record = next(_iter_rows(self._csv))
+        return self._make_result(_parse_record(record))
+
+    def _make_result(self, values):
+        row = dict(zip(self.header, values))
+        result = dict((c, row.get(c)) for c in ['msd_id', 'msd_artist', 'msd_title', 'mood'])
+        for col in INT_COLS:
+            result[col] = int(float(row[col])) if row.get(col) else None
+        result['scoreboard'] = dict((c, int(float(row[c]))) for c in self._scoreboard_cols if row[c])
+        return result
+
+    def _lookup(self, name, key, matches):
+        if self._arrays is None:
+            self._open()
+        results = list()
+        for row in sorted(self._candidate_rows(name, key)):
+            result = self._read_row(row)
+            # guard against 64 bit hash collisions
+            if matches(result):
+                results.append(result)
+        return results
+
+    def lookup(self, msd_id):
+        """
+        Returns: dict with the track's msd_id, artist, title, mood, found_tags,
+            matched_mood, and mood scoreboard, or None if msd_id was not labeled
+        """
+        results = self._lookup('msd', msd_id, lambda r: r['msd_id'] == msd_id)
+        return results[-1] if results else None
+
+    def lookup_song(self, artist, title):
+        """
+        Returns: list of dict (see lookup), every labeled track with this artist/title
+        """
+        key = song_key(artist, title)
+        return self._lookup('song', key, lambda r: song_key(r['msd_artist'], r['msd_title']) == key)
+
+    def lookup_many(self, msd_ids):
+        """
+        Batch version of lookup; rows are read in file order
+
+        Returns: list of dict or None, in the order of msd_ids
+        """
+        if self._arrays is None:
+            self._open()
+        hashes = self._arrays['msd_hashes']
+        keys = np.array([key_hash(m) for m in msd_ids], dtype=np.uint64)
+        pos = np.searchsorted(hashes, keys)
+        found = pos < len(hashes)
+        found[found] = hashes[pos[found]] == keys[found]
+        results = [None] * len(keys)
+        hits = np.flatnonzero(found)
+        offsets = self._arrays['row_offsets'][self._arrays['msd_rows'][pos[hits]]]
+        # seek forward through the csv rather than in hash order
+        for i in hits[np.argsort(offsets, kind='mergesort')]:
+            # duplicate hashes (repeated rows, collisions) go through the slow path
+            if pos[i] + 1 < len(hashes) and hashes[pos[i] + 1] == keys[i]:
+                results[i] = self.lookup(msd_ids[i])
+                continue
+            result = self._read_row(self._arrays['msd_rows'][pos[i]])
+            results[i] = result if result['msd_id'] == msd_ids[i] else None
+        return results
+
+    def lookup_songs(self, songs):
+        """
+        Batch version of lookup_song
+
+        Args:
+            songs: list of (artist, title) tuples
+
+        Returns: list of list of dict
+        """
+        return [self.lookup_song(artist, title) for artist, title in songs]
+
+    def __len__(self):
+        if self._arrays is None:
+            self._open()
+        return len(self._arrays['row_offsets'])
+
+    def __repr__(self):
+        return '<MoodLookup(csv={0})>'.format(self.labeled_csv)
+
+
+def parse_args():
+
+    # parse args
+    parser = argparse.ArgumentParser()
+
+    # universal args
+    parser.add_argument('-i', '--csv-input', action='store', required=False, default=CSV_LABELED_LYRICS_EXPANDED, help='labeled csv to index')
+    parser.add_argument('-m', '--msd-id', action='append', required=False, default=None, help='print the label of this msd_id (can be repeated)')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    configure_logging(logname='mood_lookup')
+    args = parse_args()
+    if args.msd_id:
+        lookup = MoodLookup(args.csv_input)
+        for msd_id, result in zip(args.msd_id, lookup.lookup_many(args.msd_id)):
+            print(msd_id, result)
+        lookup.close()
+    else:
+        build_index(args.csv_input)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
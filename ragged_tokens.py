@@ -0,0 +1,270 @@
+"""
+Contains the RaggedTokens class, the tokens of many songs in flat int32 arrays.
+
+A DataFrame column of token lists costs a list plus an 8 byte pointer per token for
+every song (and the padded copy of each list costs as much again). RaggedTokens keeps
+one vocabulary of distinct tokens, the token ids of every song back to back in one
+int32 array, and an int64 offsets array:
+
+    song i = [vocab[t] for t in ids[offsets[i]:offsets[i + 1]]]
+
+Offsets index into the shared ids array, so split() can hand out per-split views
+without copying any ids.
+
+A container too large for memory is built on disk a part at a time with
+RaggedTokensWriter and opened with its ids memory-mapped by RaggedTokens.load:
+
+    <store>/ids.int32       token ids of every song back to back (raw int32)
+    <store>/offsets.npy     int64 offsets
+    <store>/vocab.pickle    the vocabulary
+"""
+# project imports
+from utils import logger, picklify, unpicklify
+
+# python and package imports
+import numpy as np
+import os
+
+
+IDS_FILE = 'ids.int32'
+OFFSETS_FILE = 'offsets.npy'
+VOCAB_FILE = 'vocab.pickle'
+
+
+class RaggedTokens(object):
+    """
+    Token ids of many songs plus the vocabulary they index
+    """
+
+    def __init__(self, vocab, ids, offsets):
+        """
+        Args:
+            vocab: list of str, a token's id is its position
+            ids: np.array of int32, token ids of every song back to back
+            offsets: np.array of int64, song i is ids[offsets[i]:offsets[i + 1]] (offsets[0] need not be 0)
+        """
+        self.vocab = vocab
+        self.ids = ids
+        self.offsets = offsets
+        return
+
+    @classmethod
+    def from_lists(cls, token_lists, vocab=None):
+        """
+        Interns a list of token lists
+
+        Args:
+            token_lists: iterable of list of str
+            vocab: list of str, vocabulary to extend (default: a new one)
+
+        Returns: RaggedTokens
+        """
+        vocab = vocab if vocab is not None else list()
+        word_ids = dict((w, i) for i, w in enumerate(vocab))
+        arrays = list()
+        for tokens in token_lists:
+            ids = np.empty(len(tokens), dtype=np.int32)
+            for i, token in enumerate(tokens):
+                token_id = word_ids.get(token)
+                if token_id is None:
+                    token_id = len(vocab)
+                    word_ids[token] = token_id
+                    vocab.append(token)
+                ids[i] = token_id
+            arrays.append(ids)
+        return cls.from_arrays(vocab, arrays)
+
+    @classmethod
+    def from_arrays(cls, vocab, arrays):
+        """
+        Args:
+            vocab: list of str
+            arrays: list of array-like of int, the token ids of each song
+
+        Returns: RaggedTokens
+        """
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in arrays], out=offsets[1:])
+        ids = np.concatenate(arrays).astype(np.int32, copy=False) if arrays else np.empty(0, dtype=np.int32)
+        return cls(vocab, ids, offsets)
+
+    @classmethod
+    def concat(cls, parts):
+        """
+        Joins RaggedTokens that share a vocabulary; adjacent views of one container are
+        joined without copying. A vocabulary may also be a prefix of another (e.g. copies
+        of a TokenCache's vocab taken as it grew), then the longest one is kept.
+
+        Returns: RaggedTokens
+        """
+        first = parts[0]
+        if all(part.ids is first.ids for part in parts) and \
+                all(a.offsets[-1] == b.offsets[0] for a, b in zip(parts[:-1], parts[1:])):
+            offsets = np.concatenate([first.offsets] + [part.offsets[1:] for part in parts[1:]])
+            return cls(first.vocab, first.ids, offsets)
+        vocab = max((part.vocab for part in parts), key=len)
+        if any(part.vocab is not vocab and part.vocab != vocab[:len(part.vocab)] for part in parts):
+            error = 'cannot concat RaggedTokens with different vocabularies'
+            logger.error(error)
+            raise Exception(error)
+        ids = np.concatenate([part.flat_ids() for part in parts])
+        offsets = np.zeros(sum(len(part) for part in parts) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate([part.lengths() for part in parts]), out=offsets[1:])
+        return cls(vocab, ids, offsets)
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        """
+        Opens a container written by RaggedTokensWriter
+
+        Args:
+            store_dir: str, dir of the container
+            mmap_mode: str, mode to memory-map the ids with (None reads them into memory)
+
+        Returns: RaggedTokens
+        """
+        ids_path = os.path.join(store_dir, IDS_FILE)
+        # an empty file cannot be memory-mapped
+        if mmap_mode is None or not os.path.getsize(ids_path):
+            ids = np.fromfile(ids_path, dtype=np.int32)
+        else:
+            ids = np.memmap(ids_path, dtype=np.int32, mode=mmap_mode)
+        return cls(unpicklify(os.path.join(store_dir, VOCAB_FILE)), ids,
+                   np.load(os.path.join(store_dir, OFFSETS_FILE)))
+
+    def split(self, sizes):
+        """
+        Args:
+            sizes: list of int, number of songs in each part (summing to len(self))
+
+        Returns: list of RaggedTokens, views that share vocab and ids with self
+        """
+        bounds = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        if bounds[-1] != len(self):
+            error = 'split sizes {0} do not add up to {1} songs'.format(list(sizes), len(self))
+            logger.error(error)
+            raise Exception(error)
+        return [self.view(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def view(self, start, stop):
+        """
+        Returns: RaggedTokens, songs start to stop (exclusive) as a view that shares vocab and ids with self
+        """
+        return RaggedTokens(self.vocab, self.ids, self.offsets[start:stop + 1])
+
+    def flat_ids(self):
+        """
+        Returns: np.array of int32, the token ids of the songs of self back to back (a view)
+        """
+        return self.ids[self.offsets[0]:self.offsets[-1]]
+
+    def lengths(self):
+        """
+        Returns: np.array of int64, number of tokens of each song
+        """
+        return np.diff(self.offsets)
+
+    def song_ids(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def pad(self, cutoff=None, lookup=None, pad_id=0, out=None):
+        """
+        Truncates or pads every song to cutoff ids, like LyricsPreprocessor.pad does to tokens
+
+        Args:
+            cutoff: int, length of each row (default: out.shape[1])
+            lookup: np.array of int, maps each vocab id to its output id (default: vocab ids)
+            pad_id: int, id of the padding after short songs
+            out: np.array of shape (len(self), cutoff) to write the rows to (default: a new int32 array)
+
+        Returns: np.array of shape (len(self), cutoff), out if given
+        """
+        cutoff = int(cutoff) if cutoff is not None else out.shape[1]
+        if out is not None and out.shape != (len(self), cutoff):
+            error = 'cannot pad {0} songs to {1} ids into an array of shape {2}'.format(len(self), cutoff, out.shape)
+            logger.error(error)
+            raise Exception(error)
+        lengths = np.minimum(self.lengths(), cutoff)
+        padded = out if out is not None else np.empty((len(self), cutoff), dtype=np.int32)
+        padded.fill(pad_id)
+        # row-major positions of the kept tokens are exactly the ones before each row's length
+        keep = np.arange(cutoff) < lengths[:, None]
+        starts = np.repeat(self.offsets[:-1], lengths)
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        ids = self.ids[starts + within]
+        padded[keep] = lookup[ids] if lookup is not None else ids
+        return padded
+
+    @property
+    def nbytes(self):
+        return self.flat_ids().nbytes + self.offsets.nbytes
+
+    def __getitem__(self, i):
+        vocab = self.vocab
+        return [vocab[t] for t in self.song_ids(i).tolist()]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return '<RaggedTokens(songs={0}, tokens={1}, vocab={2})>'.format(
+            len(self), len(self.flat_ids()), len(self.vocab))
+
+
+class RaggedTokensWriter(object):
+    """
+    Builds a RaggedTokens on disk a part at a time
+
+    The ids of each part are appended to the ids file as it comes, so only the song
+    lengths and the vocabulary are held until close. Parts must share a vocabulary or
+    extend the one before them, as for RaggedTokens.concat.
+    """
+
+    def __init__(self, store_dir):
+        """
+        Args:
+            store_dir: str, dir to write the container to
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.ids_file = open(os.path.join(store_dir, IDS_FILE), 'wb')
+        self.lengths = list()
+        self.vocab = list()
+        self.num_ids = 0
+        return
+
+    def append(self, tokens):
+        """
+        Args:
+            tokens: RaggedTokens, the next songs
+        """
+        longer, shorter = sorted([self.vocab, tokens.vocab], key=len, reverse=True)
+        if longer is not shorter and longer[:len(shorter)] != shorter:
+            error = 'cannot append RaggedTokens with a different vocabulary to {0}'.format(self.store_dir)
+            logger.error(error)
+            raise Exception(error)
+        self.vocab = longer
+        np.ascontiguousarray(tokens.flat_ids(), dtype=np.int32).tofile(self.ids_file)
+        self.lengths.append(tokens.lengths())
+        self.num_ids += len(tokens.flat_ids())
+        return
+
+    def close(self):
+        """
+        Writes the offsets and vocabulary; the container is complete once this returns
+        """
+        self.ids_file.close()
+        lengths = np.concatenate(self.lengths) if self.lengths else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(self.store_dir, OFFSETS_FILE), offsets)
+        picklify(self.vocab, os.path.join(self.store_dir, VOCAB_FILE))
+        return
+
+    def __repr__(self):
+        return '<RaggedTokensWriter(dir={0}, songs={1}, tokens={2}, vocab={3})>'.format(
+            self.store_dir, sum(len(lengths) for lengths in self.lengths), self.num_ids, len(self.vocab))
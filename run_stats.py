@@ -0,0 +1,166 @@
+"""
+Contains the RunStats class, which measures the stages of a pipeline run.
+
+Each stage records its wall time, cpu time (including that of finished child processes,
+e.g. tokenizing workers), peak resident memory, and whatever counts the stage reports
+(rows, tokens, ...). Stages nest, and a stage entered again under the same parent (e.g.
+once per shard) adds to its record:
+
+    run_stats = RunStats()
+    with run_stats.stage('dataset'):
+        for shard in shards:
+            with run_stats.stage('tokenize') as stage:
+                ...
+                stage['rows'] = len(shard)
+
+    run_stats.save('<run dir>/run_stats.json')    # one record per stage, e.g. 'dataset/tokenize'
+
+On Linux the peak of each stage is its own: the kernel's high water mark of the process
+(VmHWM) is reset as each stage starts. Where it cannot be reset, peak_rss_mb is the peak
+of the process so far.
+"""
+# project imports
+from utils import logger
+
+# python and package imports
+import collections
+import contextlib
+import json
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+
+RUN_STATS_FILE = 'run_stats.json'
+PROC_STATUS = '/proc/self/status'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+
+def cpu_time():
+    """
+    Returns: float, user and system seconds of this process and its waited-for children
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def peak_rss():
+    """
+    Returns: int, peak resident memory in bytes since the last reset_peak_rss (or since the
+        process started), or None if it cannot be read
+    """
+    try:
+        with open(PROC_STATUS, 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def reset_peak_rss():
+    """
+    Resets the peak that peak_rss reports to the current resident memory (Linux only)
+
+    Returns: bool, True if it was reset
+    """
+    try:
+        with open(PROC_CLEAR_REFS, 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class RunStats(object):
+    """
+    Wall time, cpu time, peak resident memory, and counts of the stages of a run
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.peak_per_stage = True
+        self._open = list()
+        return
+
+    def begin(self, name):
+        """
+        Starts measuring stage name, nested under the innermost open stage
+
+        Returns: dict, counts to report for the stage (see stage)
+        """
+        path = '/'.join([entry['path'] for entry in self._open[-1:]] + [name])
+        peak = self._sample_peak()
+        if self._open:
+            self._open[-1]['peak'] = max(self._open[-1]['peak'], peak)
+        # what was measured so far belongs to the open stages, so the new stage starts from here
+        if not reset_peak_rss():
+            self.peak_per_stage = False
+        self._open.append({'path': path, 'counts': dict(), 'peak': self._sample_peak(),
+                           'wall': time.time(), 'cpu': cpu_time()})
+        return self._open[-1]['counts']
+
+    def end(self):
+        """
+        Stops measuring the innermost open stage and adds the measurements to its record
+
+        Returns: dict, the record of the stage
+        """
+        entry = self._open.pop()
+        wall = time.time() - entry['wall']
+        cpu = cpu_time() - entry['cpu']
+        peak = max(entry['peak'], self._sample_peak())
+        if self._open:
+            self._open[-1]['peak'] = max(self._open[-1]['peak'], peak)
+        record = self.stages.setdefault(entry['path'], collections.OrderedDict(
+            [('stage', entry['path']), ('calls', 0), ('wall_s', 0.0), ('cpu_s', 0.0), ('peak_rss_mb', 0.0)]))
+        record['calls'] += 1
+        record['wall_s'] += wall
+        record['cpu_s'] += cpu
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak / 2 ** 20)
+        for key, value in entry['counts'].items():
+            record[key] = record.get(key, 0) + value
+        logger.info('stage {0}: {1:.2f}s wall, {2:.2f}s cpu, {3:.0f} MB peak rss{4}'.format(
+            entry['path'], wall, cpu, peak / 2 ** 20,
+            ''.join(', {0} {1}'.format(value, key) for key, value in sorted(entry['counts'].items()))))
+        return record
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measures the with block as stage name (see begin and end)
+
+        Yields: dict, set counts on it to record them, e.g. stage['rows'] = len(df)
+        """
+        counts = self.begin(name)
+        try:
+            yield counts
+        finally:
+            self.end()
+
+    def _sample_peak(self):
+        peak = peak_rss()
+        return peak if peak is not None else 0
+
+    def save(self, path):
+        """
+        Writes the record of every stage to path as json
+        """
+        with open(path, 'w') as f:
+            json.dump({'peak_rss_per_stage': self.peak_per_stage, 'stages': list(self.stages.values())}, f, indent=4)
+        logger.info('run stats saved to {0}'.format(path))
+        return
+
+    def __repr__(self):
+        return '<RunStats(stages={0})>'.format(len(self.stages))
@@ -27,6 +27,7 @@ import csv
 import os
 
 from download_data import DATA_DIR
+from track_catalog import TrackCatalog, artist_partition
 from utils import configure_logging, logger
 
 
@@ -106,7 +107,22 @@ def make_lyric_file_name(artist, track):
     return "".join(c for c in filename if c.isalnum() or c in keepcharacters).rstrip()
 
 
-def scrape_lyrics(artist_name_starts_with):
+def read_musixmatch_mapping(artist_name_starts_with=None, catalog_dir=None):
+    """
+    Reads the musixmatch mapping from the csv or, if catalog_dir is given, from the
+    mxm group of the track catalog. The catalog only loads the artist partition
+    artist_name_starts_with falls in.
+
+    Returns: pd.DataFrame with the CSV_HEADER cols
+    """
+    if not catalog_dir:
+        return pd.read_csv(CSV_MUSIXMATCH_MAPPING, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
+    partitions = [artist_partition(artist_name_starts_with)] if artist_name_starts_with else None
+    df = TrackCatalog(catalog_dir).read(CSV_HEADER, partitions)
+    return df[CSV_HEADER]
+
+
+def scrape_lyrics(artist_name_starts_with, catalog_dir=None):
     """
     Iterate through the musixmatch csv file and attempt to find the lyrics for each
     with the genius api service
@@ -117,12 +133,13 @@ def scrape_lyrics(artist_name_starts_with):
     Args:
         artist_name_starts_with: character or string used to filter which artists we
         attempt to download lyrics for
+        catalog_dir: str, read the musixmatch mapping from this track catalog instead of the csv
     """
 
     start = time.time()
 
     api = genius.Genius(client_access_token=get_api_token(), verbose=False)
-    df = pd.read_csv(CSV_MUSIXMATCH_MAPPING, encoding='utf-8', dtype = {'msd_artist':str, 'msd_title': str})
+    df = read_musixmatch_mapping(artist_name_starts_with, catalog_dir)
     logger.info('{0} songs in mapping file.'.format(len(df)))
     if artist_name_starts_with:
         df = df[df['msd_artist'].str.lower().str.startswith(artist_name_starts_with.lower())]
@@ -222,6 +239,7 @@ def parse_args():
 
     # universal args
     parser.add_argument('-a', '--artist-first-letter', action='store', required=False, default=None, help='Attempt to download lyrics only for artists that start with this letter.')
+    parser.add_argument('-c', '--catalog-dir', action='store', required=False, default=None, help='read the musixmatch mapping from this track catalog instead of the csv')
 
     args = parser.parse_args()
 
@@ -234,7 +252,7 @@ def main():
 
     configure_logging(logname='scrape_lyrics')
     musixmatch_mapping_to_csv()
-    scrape_lyrics(args.artist_first_letter)
+    scrape_lyrics(args.artist_first_letter, args.catalog_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+"""
+Contains the SongRegistry class which assigns every track a dense int32 song id.
+
+Joining and filtering on msd_id strings (and on artist/title pairs) is what fills
+the pipeline's DataFrames with python objects. The registry lets each stage carry
+an int32 song_id column instead and turn it back into an msd_id only for output.
+
+Ids are assigned once and never change; new tracks are appended. The registry is
+stored as a single numpy file of fixed-width msd ids in id order. The default
+registry lives inside the default track catalog so every stage shares one id space:
+
+    data/catalog/song_registry/msd_ids.npy
+"""
+# project imports
+from download_data import DATA_DIR
+from utils import logger
+
+# python and package imports
+import numpy as np
+import hashlib
+import os
+
+
+SONG_REGISTRY_DIR = os.path.join(DATA_DIR, 'catalog', 'song_registry')
+SONG_ID_COL = 'song_id'
+UNKNOWN_SONG_ID = -1
+
+
+class SongRegistry(object):
+    """
+    Bidirectional msd_id <-> song_id mapping
+
+    song_id -> msd_id is an array lookup; msd_id -> song_id is a binary search over
+    a sorted copy of the ids, so both directions are vectorized.
+    """
+
+    def __init__(self, registry_dir=SONG_REGISTRY_DIR):
+        self.registry_dir = registry_dir
+        path = self._path()
+        if os.path.exists(path):
+            self.msd_ids = np.load(path)
+        else:
+            self.msd_ids = np.zeros(0, dtype='S18')
+        self._build_index()
+        return
+
+    def _path(self):
+        return os.path.join(self.registry_dir, 'msd_ids.npy')
+
+    def _build_index(self):
+        self._order = np.argsort(self.msd_ids, kind='mergesort').astype(np.int32)
+        self._sorted = self.msd_ids[self._order]
+        return
+
+    @staticmethod
+    def _to_bytes(msd_ids):
+        return np.asarray(msd_ids, dtype=object).astype(str).astype(bytes)
+
+    def encode(self, msd_ids, register=False):
+        """
+        Maps msd ids to song ids
+
+        Args:
+            msd_ids: array-like of str
+            register: bool, if True, unseen msd ids are given new song ids; otherwise
+                they map to UNKNOWN_SONG_ID
+
+        Returns: np.array of int32
+        """
+        keys = self._to_bytes(msd_ids)
+        song_ids = np.full(len(keys), UNKNOWN_SONG_ID, dtype=np.int32)
+        if len(self._sorted) and len(keys):
+            pos = np.minimum(np.searchsorted(self._sorted, keys), len(self._sorted) - 1)
+            found = self._sorted[pos] == keys
+            song_ids[found] = self._order[pos[found]]
+        missing = song_ids == UNKNOWN_SONG_ID
+        if register and missing.any():
+            new_ids = np.unique(keys[missing])
+            first = len(self.msd_ids)
+            self.msd_ids = np.concatenate([self.msd_ids, new_ids])
+            self._build_index()
+            song_ids[missing] = first + np.searchsorted(new_ids, keys[missing])
+            logger.debug('registered {0} new songs'.format(len(new_ids)))
+        return song_ids
+
+    def decode(self, song_ids):
+        """
+        Maps song ids back to msd ids; UNKNOWN_SONG_ID and any other id the registry has
+        not assigned decode to ''
+
+        Returns: np.array of str
+        """
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        msd_ids = np.zeros(len(song_ids), dtype=self.msd_ids.dtype)
+        known = (song_ids >= 0) & (song_ids < len(self.msd_ids))
+        msd_ids[known] = self.msd_ids[song_ids[known]]
+        return msd_ids.astype(str)
+
+    def save(self):
+        os.makedirs(self.registry_dir, exist_ok=True)
+        tmp = self._path() + '.tmp.npy'
+        np.save(tmp, self.msd_ids)
+        os.replace(tmp, self._path())
+        return
+
+    def fingerprint(self):
+        """
+        Returns: str, sha1 hex digest of the registered msd ids; it changes whenever a track is registered
+        """
+        return hashlib.sha1(np.ascontiguousarray(self.msd_ids).tobytes()).hexdigest()
+
+    def __len__(self):
+        return len(self.msd_ids)
+
+    def __repr__(self):
+        return '<SongRegistry(songs={0})>'.format(len(self))
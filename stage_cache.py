@@ -0,0 +1,213 @@
+"""
+Contains the StageCache class, a content-addressed cache of pipeline stage outputs.
+
+Each stage output is pickled under a key that hashes everything the stage depends
+on: its parameters and the keys of the stages it reads from (the first stage hashes
+the contents of its input csv). Changing a parameter therefore changes the key of
+that stage and of every stage after it, so only those are recomputed, and outputs
+for different parameters live side by side:
+
+    logs/tf/mood_classification/stage_cache/<stage>-<key>.pickle
+    logs/tf/mood_classification/stage_cache/<stage>-<key>/    (outputs stored as a directory)
+
+Loading an entry refreshes its modification time. When the cache grows past
+max_bytes the least recently used entries are deleted.
+
+Runs may share a cache dir. Entries are saved, loaded, and evicted under
+<cache_dir>/cache.lock, and eviction skips every entry touched since the evicting
+cache was opened (by any run), so an entry another run is about to read or has
+memory-mapped is never deleted under it.
+"""
+# project imports
+from lyrics2vec import LOGS_TF_DIR
+from utils import logger, picklify, unpicklify, file_lock
+
+# python and package imports
+import hashlib
+import shutil
+import json
+import time
+import os
+
+
+STAGE_CACHE_DIR = os.path.join(LOGS_TF_DIR, 'mood_classification', 'stage_cache')
+STAGE_CACHE_MAX_BYTES = 20 * 2 ** 30
+# bump to invalidate every cached stage when a stage's code changes its output
+STAGE_CACHE_VERSION = 5
+
+
+def file_hash(path):
+    """
+    Returns: str, sha1 hex digest of the contents of path
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def stage_key(stage, **params):
+    """
+    Returns: str, hash of the stage name and its (json serializable) params
+    """
+    blob = json.dumps([STAGE_CACHE_VERSION, stage, params], sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()[:16]
+
+
+class StageCache(object):
+    """
+    Pickled stage outputs keyed by (stage, key) with LRU eviction by disk size
+    """
+
+    def __init__(self, cache_dir=STAGE_CACHE_DIR, max_bytes=STAGE_CACHE_MAX_BYTES):
+        """
+        Args:
+            cache_dir: str, dir of the cached pickles
+            max_bytes: int, size the cache is trimmed to after each save
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # entries touched since then are in use by this run or another one
+        self.opened = time.time()
+        self._used = set()
+        return
+
+    def _lock(self):
+        return file_lock(os.path.join(self.cache_dir, 'cache.lock'))
+
+    def _touch(self, path):
+        os.utime(path, None)
+        self._used.add(path)
+        return
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, '{0}-{1}.pickle'.format(stage, key))
+
+    def _dir_path(self, stage, key):
+        return os.path.join(self.cache_dir, '{0}-{1}'.format(stage, key))
+
+    def has(self, stage, key):
+        return os.path.exists(self._path(stage, key)) or self.has_dir(stage, key)
+
+    def has_dir(self, stage, key):
+        return os.path.isdir(self._dir_path(stage, key))
+
+    def load(self, stage, key):
+        """
+        Returns: the cached output of stage (marking it as recently used)
+        """
+        path = self._path(stage, key)
+        logger.info('stage cache: loading {0} from {1}'.format(stage, path))
+        with self._lock():
+            value = unpicklify(path)
+            self._touch(path)
+        return value
+
+    def save(self, stage, key, value):
+        """
+        Caches the output of stage and evicts the least recently used entries over max_bytes
+        """
+        path = self._path(stage, key)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        picklify(value, tmp)
+        with self._lock():
+            os.replace(tmp, path)
+            self._touch(path)
+            self._evict()
+        logger.info('stage cache: saved {0} to {1}'.format(stage, path))
+        return
+
+    def load_dir(self, stage, key):
+        """
+        Returns: str, the dir holding the cached output of stage (marking it as recently used)
+        """
+        path = self._dir_path(stage, key)
+        logger.info('stage cache: using {0} in {1}'.format(stage, path))
+        with self._lock():
+            self._touch(path)
+        return path
+
+    def save_dir(self, stage, key, write):
+        """
+        Caches an output that is stored as a directory
+
+        Args:
+            write: callable, writes the output to the dir it is given (it should only
+                create the dir once the output is complete, e.g. tensor_store.save_tensors)
+
+        Returns: str, the dir
+        """
+        path = self._dir_path(stage, key)
+        write(path)
+        with self._lock():
+            self._touch(path)
+            self._evict()
+        logger.info('stage cache: saved {0} to {1}'.format(stage, path))
+        return path
+
+    def stale_stages(self, keys, forced=None):
+        """
+        Finds the stages that must be computed
+
+        Args:
+            keys: list of (stage, key) in pipeline order; each stage depends on those before it
+            forced: set of stages to recompute even if cached
+
+        Returns: set of str, the first uncached (or forced) stage and every stage after it
+        """
+        forced = forced if forced else set()
+        stale = set()
+        with self._lock():
+            for stage, key in keys:
+                if stale or stage in forced or not self.has(stage, key):
+                    stale.add(stage)
+                else:
+                    # the run will load it, so it must outlive evictions until then
+                    self._touch(self._dir_path(stage, key) if self.has_dir(stage, key) else self._path(stage, key))
+        return stale
+
+    def entries(self):
+        """
+        Returns: list of (path, size in bytes, mtime), least recently used first
+        """
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path) and not name.endswith('.tmp'):
+                size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+            elif name.endswith('.pickle'):
+                size = os.path.getsize(path)
+            else:
+                continue
+            entries.append((path, size, os.path.getmtime(path)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the cache fits in max_bytes. Entries touched
+        since this cache was opened are kept.
+        """
+        with self._lock():
+            self._evict()
+        return
+
+    def _evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, mtime in entries:
+            if total <= self.max_bytes:
+                break
+            if path in self._used or mtime >= self.opened:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= size
+            logger.info('stage cache: evicted {0} ({1} bytes)'.format(path, size))
+        return
+
+    def __repr__(self):
+        return '<StageCache(dir={0})>'.format(self.cache_dir)
@@ -0,0 +1,160 @@
+"""
+A directory of .npy arrays plus a json manifest, for the CNN's training inputs.
+
+Pickling x_train/y_train/... means every training run reads and unpickles all of it
+into its own memory. The tensor store keeps the vectorized lyrics as int32 token
+matrices and the labels as int8 class ids (one per song, e.g. mood_cats), each in its
+own .npy file, so they can be opened with mmap_mode='r': opening is instant, batches
+are read from disk as they are drawn, and concurrent training runs share one copy in
+the page cache. Stores written before labels were class ids hold int8 one-hot rows.
+
+    <store>/x_train.npy, y_train.npy, x_dev.npy, y_dev.npy, x_test.npy, y_test.npy
+    <store>/manifest.json    shape and dtype of each array plus the vocab_size and
+                             word tokenizer id the lyrics were vectorized with
+    <store>/<name>.pickle    optional non-numeric extras (e.g. the raw training lyrics)
+    <store>/<name>/          optional extras stored as a dir of their own (e.g. a
+                             lyrics_loader.LyricsStore of the raw training lyrics)
+"""
+# project imports
+from utils import logger, picklify, unpicklify
+
+# python and package imports
+import numpy as np
+import shutil
+import json
+import os
+
+
+X_Y_NAMES = ['x_train', 'y_train', 'x_dev', 'y_dev', 'x_test', 'y_test']
+MANIFEST_FILE = 'manifest.json'
+
+
+def tensor_dtype(name):
+    """
+    Returns: np.dtype, int32 for token matrices (x_*) and int8 for labels (y_*)
+
+    Labels are class ids, which are far fewer than 128 (the moods of label_lyrics.py), so
+    int8 holds them in a quarter of the space of int32; feeding a batch to the CNN casts it
+    to the int32 of its sparse softmax labels. save_tensors refuses labels int8 cannot hold.
+    """
+    return np.int32 if name.startswith('x') else np.int8
+
+
+def has_tensors(store_dir):
+    return os.path.exists(os.path.join(store_dir, MANIFEST_FILE))
+
+
+def save_tensors(store_dir, arrays, pickles=None, **meta):
+    """
+    Writes arrays to store_dir, replacing whatever was there
+
+    Args:
+        store_dir: str, dir of the store
+        arrays: dict of str to array-like, e.g. x_train, y_train, ...
+        pickles: dict of str to any, extras to pickle next to the arrays (optional)
+        meta: json serializable values to record in the manifest (vocab_size, word_tokenizer, ...)
+
+    Returns: dict, the manifest
+    """
+    for name, array in arrays.items():
+        dtype = tensor_dtype(name)
+        if np.size(array) and np.issubdtype(dtype, np.integer) and np.max(array) > np.iinfo(dtype).max:
+            error = '{0} holds values up to {1}, more than {2} can hold'.format(name, np.max(array), np.dtype(dtype).name)
+            logger.error(error)
+            raise Exception(error)
+    arrays = dict((name, np.asarray(array, dtype=tensor_dtype(name))) for name, array in arrays.items())
+
+    def fill(out):
+        for name, array in arrays.items():
+            out[name][...] = array
+
+    return write_tensors(store_dir, dict((name, array.shape) for name, array in arrays.items()), fill,
+                         pickles, **meta)
+
+
+def write_tensors(store_dir, shapes, fill, pickles=None, dirs=None, **meta):
+    """
+    Like save_tensors, but the arrays are filled in place: each is created as a memory-mapped
+    .npy file of its shape and fill writes into them, so they never need to fit in memory
+
+    Args:
+        store_dir: str, dir of the store
+        shapes: dict of str to tuple of int, shape of each array
+        fill: callable, takes a dict of str to np.memmap and writes every array
+        pickles: dict of str to any, see save_tensors
+        dirs: dict of str to str, dirs to copy into the store under these names (optional)
+        meta: see save_tensors
+
+    Returns: dict, the manifest
+    """
+    # runs sharing a stage cache may write the same store at once
+    tmp_dir = '{0}.{1}.tmp'.format(store_dir.rstrip(os.sep), os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    manifest = dict(meta, arrays=dict())
+    out = dict()
+    for name, shape in shapes.items():
+        out[name] = np.lib.format.open_memmap(os.path.join(tmp_dir, '{0}.npy'.format(name)), mode='w+',
+                                              dtype=tensor_dtype(name), shape=tuple(shape))
+        manifest['arrays'][name] = {'shape': list(shape), 'dtype': out[name].dtype.name}
+    fill(out)
+    for array in out.values():
+        array.flush()
+    del out
+    manifest['pickles'] = sorted(pickles) if pickles else list()
+    for name, value in (pickles or dict()).items():
+        picklify(value, os.path.join(tmp_dir, '{0}.pickle'.format(name)))
+    manifest['dirs'] = sorted(dirs) if dirs else list()
+    for name, src in (dirs or dict()).items():
+        shutil.copytree(src, os.path.join(tmp_dir, name))
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    # the manifest marks a complete store, so swap the whole dir in at once
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    logger.info('saved tensors {0} to {1}'.format(sorted(manifest['arrays']), store_dir))
+    return manifest
+
+
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def load_tensors(store_dir, mmap_mode='r', **expected):
+    """
+    Opens the arrays of a store
+
+    Args:
+        store_dir: str, dir of the store
+        mmap_mode: str, passed to np.load (None reads the arrays into memory)
+        expected: manifest values the store must have been saved with (e.g. vocab_size=10000)
+
+    Returns: dict of str to np.array (np.memmap unless mmap_mode is None)
+    """
+    manifest = load_manifest(store_dir)
+    for key, value in expected.items():
+        if manifest.get(key) != value:
+            error = 'tensor store {0} has {1}={2}, expected {3}'.format(store_dir, key, manifest.get(key), value)
+            logger.error(error)
+            raise Exception(error)
+    return dict((name, np.load(os.path.join(store_dir, '{0}.npy'.format(name)), mmap_mode=mmap_mode))
+                for name in manifest['arrays'])
+
+
+def extra_dir(store_dir, name):
+    """
+    Returns: str, a dir copied in with write_tensors(dirs=...), or None if the store has none by that name
+    """
+    path = os.path.join(store_dir, name)
+    return path if os.path.isdir(path) else None
+
+
+def load_pickle(store_dir, name):
+    """
+    Returns: an extra saved with save_tensors(pickles=...), or None if the store has none by that name
+    """
+    path = os.path.join(store_dir, '{0}.pickle'.format(name))
+    return unpicklify(path) if os.path.exists(path) else None
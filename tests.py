@@ -2,6 +2,17 @@
 import mood_classification
 import index_lyrics
 import label_lyrics
+import lastfm_tags
+import track_catalog
+import song_registry
+import mood_lookup
+import merge_genre
+import token_cache
+import ragged_tokens
+import lyrics_loader
+import run_stats
+import stage_cache
+import tensor_store
 import lyrics2vec
 import lyrics_cnn
 import utils
@@ -13,6 +24,7 @@ import tensorflow as tf
 import pandas as pd
 import numpy as np
 import unittest
+import sqlite3
 import shutil
 import json
 import csv
@@ -132,8 +144,1025 @@ class TestLabelLyrics(unittest.TestCase):
         self.assertEqual(expected_mood, actual_mood)
         self.assertEqual(expected_scoreboard, actual_scoreboard)
 
+    def test_changed_moods(self):
+        old = {'a': [['a'], ['a'], []], 'b': [['b'], ['b'], ['bb']], 'c': [['c'], ['c'], []]}
+        new = {'a': [['a', 'x'], ['a'], []], 'b': [['b'], ['b'], ['bbb']], 'd': [['d'], ['d'], []]}
+        # the first list is not used for expanded matching so 'a' is unchanged
+        self.assertEqual(['b', 'c', 'd'], label_lyrics.changed_moods(old, new))
+        self.assertEqual(label_lyrics.taxonomy_hash(old), label_lyrics.taxonomy_hash(dict(old)))
+        self.assertNotEqual(label_lyrics.taxonomy_hash(old), label_lyrics.taxonomy_hash(new))
 
-#class TestLyrics2Vec(unittest.TestCase):   
+
+class TestLabelLyricsCheckpoints(unittest.TestCase):
+
+    ckpt_dir = 'test_checkpoints'
+
+    def tearDown(self):
+        if os.path.exists(self.ckpt_dir):
+            shutil.rmtree(self.ckpt_dir)
+
+    def test_checkpoints(self):
+        self.assertIsNone(label_lyrics.load_checkpoints(self.ckpt_dir))
+        label_lyrics.save_checkpoint(self.ckpt_dir, [
+            {'msd_id': 'TRA', 'found_tags': 3, 'matched_mood': 1, 'mood': 'sad'},
+            {'msd_id': 'TRB', 'found_tags': 0, 'matched_mood': 0, 'mood': 'unknown'}])
+        label_lyrics.save_checkpoint(self.ckpt_dir, [])
+        label_lyrics.save_checkpoint(self.ckpt_dir, [
+            {'msd_id': 'TRB', 'found_tags': 2, 'matched_mood': 1, 'mood': 'happy'}])
+        self.assertEqual(['part-00000-{0}.csv'.format(os.getpid()), 'part-00001-{0}.csv'.format(os.getpid())],
+                         sorted(os.listdir(self.ckpt_dir)))
+        # later partitions win for rows labeled twice
+        actual = label_lyrics.load_checkpoints(self.ckpt_dir).set_index('msd_id')
+        self.assertEqual(['TRA', 'TRB'], sorted(actual.index))
+        self.assertEqual('happy', actual.loc['TRB', 'mood'])
+        self.assertEqual(3, actual.loc['TRA', 'found_tags'])
+        # checkpoints of different taxonomy versions never share a directory
+        self.assertNotEqual(label_lyrics.checkpoint_dir('x.csv', True), label_lyrics.checkpoint_dir('x.csv', False))
+        # nor do shards labeling different artists into the same output
+        shards = [label_lyrics.checkpoint_shard(letter) for letter in [None, 'a', 'B', '/']]
+        self.assertEqual(4, len(set(label_lyrics.checkpoint_dir('x.csv', True, shard) for shard in shards)))
+        self.assertNotEqual(label_lyrics.taxonomy_path('x', shards[1]), label_lyrics.taxonomy_path('x', shards[2]))
+
+    def test_checkpoint_part_names(self):
+        # another writer's partition with the same sequence number is kept, not replaced
+        os.makedirs(self.ckpt_dir)
+        pd.DataFrame([{'msd_id': 'TRA', 'mood': 'sad'}]).to_csv(os.path.join(self.ckpt_dir, 'part-00000-1.csv'), index=False)
+        pd.DataFrame([{'msd_id': 'TRA', 'mood': 'calm'}]).to_csv(os.path.join(self.ckpt_dir, 'part-00001.csv'), index=False)
+        label_lyrics.save_checkpoint(self.ckpt_dir, [{'msd_id': 'TRA', 'mood': 'happy'}])
+        self.assertEqual(3, len(os.listdir(self.ckpt_dir)))
+        self.assertEqual('happy', label_lyrics.load_checkpoints(self.ckpt_dir).set_index('msd_id').loc['TRA', 'mood'])
+
+
+class TestLabelLyricsIncremental(unittest.TestCase):
+
+    test_db = 'test_tags.db'
+    graph_dir = 'test_tag_graph'
+    input_csv = 'test_input.csv'
+    output_csv = 'test_output.csv'
+    catalog_dir = 'test_catalog'
+    track_tags = {
+        'TRA': ['sad', 'sadness', 'happy'],
+        'TRB': ['aggressive', 'brooding'],
+        'TRC': ['rock'],
+    }
+
+    def setUp(self):
+        tags = sorted(set(t for ts in self.track_tags.values() for t in ts))
+        conn = sqlite3.connect(self.test_db)
+        conn.execute('CREATE TABLE tids (tid TEXT)')
+        conn.execute('CREATE TABLE tags (tag TEXT)')
+        conn.execute('CREATE TABLE tid_tag (tid INT, tag INT, val FLOAT)')
+        conn.executemany('INSERT INTO tids VALUES (?)', [(t,) for t in self.track_tags])
+        conn.executemany('INSERT INTO tags VALUES (?)', [(t,) for t in tags])
+        for i, ts in enumerate(self.track_tags.values()):
+            conn.executemany('INSERT INTO tid_tag VALUES (?, ?, ?)', [(i + 1, tags.index(t) + 1, 100) for t in ts])
+        conn.commit()
+        conn.close()
+        lastfm_tags.export_tag_graph(self.test_db, self.graph_dir)
+
+    def tearDown(self):
+        for path in [self.test_db, self.input_csv, self.output_csv,
+                     label_lyrics.taxonomy_path(self.input_csv), label_lyrics.taxonomy_path(self.output_csv)]:
+            if os.path.exists(path):
+                os.remove(path)
+        for path in [self.graph_dir, self.catalog_dir]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def old_labels(self):
+        """
+        Labels every track with a taxonomy that differs from the current one in the "sad" mood
+
+        Returns: tuple of labeled pd.DataFrame and the old taxonomy
+        """
+        old_taxonomy = json.loads(json.dumps(label_lyrics.MOOD_CATEGORIES_EXPANDED))
+        old_taxonomy['sad'][1] = ['nothing matches this']
+        rows = list()
+        for msd_id, tags in self.track_tags.items():
+            row = {'msd_id': msd_id, 'found_tags': len(tags)}
+            for mood, lists in old_taxonomy.items():
+                row[mood] = label_lyrics.score_tags_for_mood(pd.Series(tags), lists)
+            row['mood'] = label_lyrics.pick_mood({m: row[m] for m in old_taxonomy})
+            row['matched_mood'] = int(row['mood'] != label_lyrics.MOOD_UNKNOWN_KEY)
+            rows.append(row)
+        return pd.DataFrame(rows), old_taxonomy
+
+    def save_old_taxonomy(self, labeled_csv, old_taxonomy, shard=None, expanded_moods=True):
+        with open(label_lyrics.taxonomy_path(labeled_csv, shard), 'w') as f:
+            json.dump({'hash': label_lyrics.taxonomy_hash(old_taxonomy), 'expanded_moods': expanded_moods,
+                       'taxonomy': old_taxonomy}, f)
+
+    def assert_relabeled(self, actual, msd_ids):
+        for msd_id in msd_ids:
+            expected_mood, expected_scoreboard = label_lyrics.match_song_tags_to_mood_expanded(
+                pd.Series(self.track_tags[msd_id]))
+            self.assertEqual(expected_mood, actual.loc[msd_id, 'mood'])
+            for mood, score in expected_scoreboard.items():
+                self.assertEqual(score, actual.loc[msd_id, mood])
+
+    def test_relabel_lyrics_incremental(self):
+        new_taxonomy = label_lyrics.MOOD_CATEGORIES_EXPANDED
+        df, old_taxonomy = self.old_labels()
+        df.to_csv(self.input_csv, index=False)
+        self.save_old_taxonomy(self.input_csv, old_taxonomy)
+        # test: incremental output matches labeling from scratch with the new taxonomy
+        label_lyrics.relabel_lyrics_incremental(self.input_csv, self.output_csv, self.graph_dir)
+        actual = pd.read_csv(self.output_csv).set_index('msd_id')
+        self.assert_relabeled(actual, self.track_tags)
+        saved = label_lyrics.load_taxonomy(self.output_csv)
+        self.assertEqual(label_lyrics.taxonomy_hash(new_taxonomy), saved['hash'])
+
+    def test_unsupported_input(self):
+        df, old_taxonomy = self.old_labels()
+        df.to_csv(self.input_csv, index=False)
+        # no taxonomy saved
+        with self.assertRaises(Exception):
+            label_lyrics.relabel_lyrics_incremental(self.input_csv, self.output_csv, self.graph_dir)
+        # labeled with MOOD_CATEGORIES
+        self.save_old_taxonomy(self.input_csv, label_lyrics.MOOD_CATEGORIES, expanded_moods=False)
+        with self.assertRaises(Exception):
+            label_lyrics.relabel_lyrics_incremental(self.input_csv, self.output_csv, self.graph_dir)
+        self.assertFalse(os.path.exists(self.output_csv))
+
+    def test_relabel_catalog_shards(self):
+        new_hash = label_lyrics.taxonomy_hash(label_lyrics.MOOD_CATEGORIES_EXPANDED)
+        df, old_taxonomy = self.old_labels()
+        catalog = track_catalog.TrackCatalog(self.catalog_dir)
+        catalog.write_group('mxm', pd.DataFrame({'msd_id': ['TRA', 'TRB', 'TRC'],
+                                                 'msd_artist': ['ABBA', 'Blur', 'Bauhaus']}))
+        catalog.write_group('label', df)
+        labeled_csv = os.path.join(self.catalog_dir, 'label')
+        for letter in ['a', 'b']:
+            self.save_old_taxonomy(labeled_csv, old_taxonomy, label_lyrics.checkpoint_shard(letter))
+        self.assertEqual(['a', 'b'], label_lyrics.taxonomy_shards(labeled_csv))
+        # test: a single-letter run only relabels its own shard
+        label_lyrics.relabel_lyrics_incremental(None, None, self.graph_dir, self.catalog_dir, 'a')
+        actual = track_catalog.TrackCatalog(self.catalog_dir).read().set_index('msd_id')
+        self.assert_relabeled(actual, ['TRA'])
+        self.assertEqual(new_hash, label_lyrics.load_taxonomy(labeled_csv, label_lyrics.checkpoint_shard('a'))['hash'])
+        self.assertNotEqual(new_hash, label_lyrics.load_taxonomy(labeled_csv, label_lyrics.checkpoint_shard('b'))['hash'])
+        # test: a catalog labeled by shard is relabeled shard by shard
+        label_lyrics.relabel_lyrics_incremental(None, None, self.graph_dir, self.catalog_dir)
+        actual = track_catalog.TrackCatalog(self.catalog_dir).read().set_index('msd_id')
+        self.assert_relabeled(actual, self.track_tags)
+        self.assertEqual(new_hash, label_lyrics.load_taxonomy(labeled_csv, label_lyrics.checkpoint_shard('b'))['hash'])
+        self.assertIsNone(label_lyrics.load_taxonomy(labeled_csv))
+
+
+class TestLastfmTags(unittest.TestCase):
+
+    test_db = 'test_tags.db'
+    graph_dir = 'test_tag_graph'
+
+    def setUp(self):
+        conn = sqlite3.connect(self.test_db)
+        conn.execute('CREATE TABLE tids (tid TEXT)')
+        conn.execute('CREATE TABLE tags (tag TEXT)')
+        conn.execute('CREATE TABLE tid_tag (tid INT, tag INT, val FLOAT)')
+        conn.executemany('INSERT INTO tids VALUES (?)', [('TRB',), ('TRA',), ('TRC',)])
+        conn.executemany('INSERT INTO tags VALUES (?)', [('sad',), ('happy',), ('café',)])
+        conn.executemany('INSERT INTO tid_tag VALUES (?, ?, ?)', [
+            (1, 1, 100), (2, 2, 50), (1, 3, 10), (2, 1, 5)])
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+        if os.path.exists(self.graph_dir):
+            shutil.rmtree(self.graph_dir)
+
+    def test_export_tag_graph(self):
+        lastfm_tags.export_tag_graph(self.test_db, self.graph_dir)
+        graph = lastfm_tags.LastfmTagGraph(self.graph_dir)
+        self.assertEqual(3, len(graph))
+        self.assertEqual(['sad', 'café'], graph.tags_for_track('TRB'))
+        self.assertEqual(['happy', 'sad'], graph.tags_for_track('TRA'))
+        self.assertEqual([], graph.tags_for_track('TRC'))
+        self.assertEqual([], graph.tags_for_track('TRZ'))
+        _, vals = graph.tag_ids_for_track('TRA')
+        self.assertEqual([50, 5], vals.tolist())
+        self.assertTrue('TRA' in graph)
+        self.assertFalse('TRZ' in graph)
+
+    def test_export_dangling_edges(self):
+        conn = sqlite3.connect(self.test_db)
+        # rowid 4 is a gap in tids, rowid 9 is past its end, and tag 7 does not exist
+        conn.execute('INSERT INTO tids (rowid, tid) VALUES (5, ?)', ('TRE',))
+        conn.executemany('INSERT INTO tid_tag VALUES (?, ?, ?)', [(4, 1, 1), (9, 2, 1), (5, 7, 1), (5, 2, 30)])
+        conn.commit()
+        conn.close()
+        lastfm_tags.export_tag_graph(self.test_db, self.graph_dir)
+        graph = lastfm_tags.LastfmTagGraph(self.graph_dir)
+        self.assertEqual(['happy'], graph.tags_for_track('TRE'))
+        self.assertEqual(['happy', 'sad'], graph.tags_for_track('TRA'))
+        self.assertEqual(5, len(graph.tag_ids))
+
+
+class TestTrackCatalog(unittest.TestCase):
+
+    catalog_dir = 'test_catalog'
+
+    def tearDown(self):
+        if os.path.exists(self.catalog_dir):
+            shutil.rmtree(self.catalog_dir)
+
+    def test_write_and_read_groups(self):
+        catalog = track_catalog.TrackCatalog(self.catalog_dir)
+        catalog.write_group('mxm', pd.DataFrame({
+            'msd_id': ['TRA', 'TRB', 'TRC'], 'msd_artist': ['a', 'b', 'c'], 'msd_title': ['x', 'y', 'z']}))
+        catalog.write_group('label', pd.DataFrame({
+            'msd_id': ['TRC', 'TRA'], 'mood': ['sad', 'sad'], 'matched_mood': [1, 0]}))
+        # reopen from disk
+        catalog = track_catalog.TrackCatalog(self.catalog_dir)
+        self.assertEqual(['mxm', 'label'], catalog.groups())
+        self.assertEqual(['msd_artist', 'msd_title', 'mood', 'matched_mood'], catalog.columns())
+        self.assertEqual('label', catalog.group_of('mood'))
+        # only the requested columns come back, joined on song_id
+        actual = catalog.read(['mood', 'msd_artist'])
+        self.assertEqual(['song_id', 'mood', 'msd_artist'], list(actual.columns))
+        self.assertEqual('int32', str(actual.song_id.dtype))
+        actual = catalog.read(['msd_id', 'mood', 'msd_artist'])
+        self.assertEqual(['msd_id', 'song_id', 'mood', 'msd_artist'], list(actual.columns))
+        self.assertEqual(['TRA', 'TRB', 'TRC'], actual.msd_id.tolist())
+        self.assertEqual(['sad', 'b', 'sad'], actual.mood.fillna(actual.msd_artist).tolist())
+        self.assertEqual('int8', str(catalog.read(['matched_mood']).matched_mood.dtype))
+        # partial writes only replace their own rows
+        catalog.write_group('label', pd.DataFrame({'msd_id': ['TRB'], 'mood': ['happy'], 'matched_mood': [1]}),
+                            replace=False)
+        actual = catalog.read(['msd_id', 'mood']).dropna().set_index('msd_id')
+        self.assertEqual({'TRA': 'sad', 'TRB': 'happy', 'TRC': 'sad'}, actual.mood.astype(str).to_dict())
+        with self.assertRaises(KeyError):
+            catalog.read(['not_a_column'])
+
+    def test_artist_partitions(self):
+        self.assertEqual(['a', 'b', '2', '_', '_'], track_catalog.artist_partitions(
+            pd.Series(['ABBA', 'beatles', '2Pac', '!!!', None])).tolist())
+        catalog = track_catalog.TrackCatalog(self.catalog_dir)
+        catalog.write_group('mxm', pd.DataFrame({
+            'msd_id': ['TRA', 'TRB', 'TRC', 'TRD'], 'msd_artist': ['ABBA', 'Beatles', 'Blur', '!!!']}))
+        catalog.write_group('label', pd.DataFrame({'msd_id': ['TRA', 'TRB', 'TRC', 'TRD'], 'mood': ['sad'] * 4}))
+        self.assertEqual(['_', 'a', 'b'], catalog.partitions('label'))
+        # a partition is read without touching any other partition's files
+        shutil.rmtree(os.path.join(self.catalog_dir, 'mxm', 'a'))
+        actual = catalog.read(['msd_id', 'msd_artist', 'mood'], partitions=[track_catalog.artist_partition('b')])
+        self.assertEqual(['TRB', 'TRC'], actual.msd_id.tolist())
+        # a sharded write only rewrites its own partition
+        catalog.write_group('label', pd.DataFrame({'song_id': actual.song_id, 'mood': ['happy', 'happy']}),
+                            replace=False)
+        actual = catalog.read(['msd_id', 'mood'])
+        self.assertEqual({'TRA': 'sad', 'TRB': 'happy', 'TRC': 'happy', 'TRD': 'sad'},
+                         actual.set_index('msd_id').mood.astype(str).to_dict())
+
+    def test_partition_dtypes(self):
+        self.assertEqual('int16', track_catalog.widest_dtype('int8', 'int16'))
+        self.assertEqual('float32', track_catalog.widest_dtype('int8', 'float32'))
+        self.assertEqual('object', track_catalog.widest_dtype('category', 'object'))
+        catalog = track_catalog.TrackCatalog(self.catalog_dir)
+        catalog.write_group('mxm', pd.DataFrame({'msd_id': ['TRA', 'TRB'], 'msd_artist': ['ABBA', 'Blur']}))
+        catalog.write_group('label', pd.DataFrame({'msd_id': ['TRA'], 'found_tags': [-1]}), replace=False)
+        catalog.write_group('label', pd.DataFrame({'msd_id': ['TRB'], 'found_tags': [1000]}), replace=False)
+        # the manifest holds the widest dtype of any partition and every partition is read back in it
+        self.assertEqual('int16', catalog.manifest['groups']['label']['columns']['found_tags'])
+        self.assertEqual('int16', str(catalog.read(['found_tags'], partitions=['a']).found_tags.dtype))
+        # columns that index_lyrics fills in later are not downcast
+        catalog.write_group('index', pd.DataFrame({'msd_id': ['TRA', 'TRB'], 'wordcount': [-1, -1],
+                                                   'lyrics_filename': ['-1', '-1']}))
+        actual = catalog.read(['wordcount', 'lyrics_filename'])
+        self.assertEqual('int64', str(actual.wordcount.dtype))
+        self.assertNotEqual('category', str(actual.lyrics_filename.dtype))
+
+    def test_sharded_writers(self):
+        # two shards opened the catalog before either wrote
+        shard_a = track_catalog.TrackCatalog(self.catalog_dir)
+        shard_b = track_catalog.TrackCatalog(self.catalog_dir)
+        shard_a.write_group('mxm', pd.DataFrame({'msd_id': ['TRA', 'TRB'], 'msd_artist': ['ABBA', 'Air']}), replace=False)
+        shard_b.write_group('mxm', pd.DataFrame({'msd_id': ['TRC'], 'msd_artist': ['Blur']}), replace=False)
+        # neither shard hands out the other's song ids or drops its partitions
+        catalog = track_catalog.TrackCatalog(self.catalog_dir)
+        actual = catalog.read(['msd_id', 'msd_artist']).set_index('msd_id')
+        self.assertEqual(['TRA', 'TRB', 'TRC'], sorted(actual.index))
+        self.assertEqual(3, actual.song_id.nunique())
+        self.assertEqual(['a', 'a', 'b'], catalog.partition_of(actual.song_id.sort_values().values).tolist())
+
+
+class TestMergeGenre(unittest.TestCase):
+
+    input_csv = 'test_input.csv'
+    genre_file = 'test_genres.tsv'
+    output_csv = 'test_output.csv'
+
+    def tearDown(self):
+        for path in [self.input_csv, self.genre_file, self.output_csv]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_merge_genres(self):
+        pd.DataFrame({'msd_id': ['TRA', 'TRB', 'TRC'], 'msd_title': ['1999', None, '1999'],
+                      'mood': ['sad', 'happy', 'sad']}).to_csv(self.input_csv, index=False)
+        with open(self.genre_file, 'w') as f:
+            f.write('TRC\tRock\nTRA\tPop\nTRZ\tJazz\n')
+        orig_chunk_size = merge_genre.CHUNK_SIZE
+        merge_genre.CHUNK_SIZE = 2
+        try:
+            merge_genre.merge_genres(self.input_csv, self.genre_file, self.output_csv)
+            actual = pd.read_csv(self.output_csv, dtype={'msd_title': str})
+            self.assertEqual(['msd_id', 'msd_title', 'mood', 'magd_genre'], list(actual.columns))
+            # a numeric title reads the same in every chunk
+            self.assertEqual(['1999', '', '1999'], actual.msd_title.fillna('').tolist())
+            self.assertEqual(['Pop', 'none', 'Rock'], actual.magd_genre.fillna('none').tolist())
+            merge_genre.merge_genres(self.input_csv, self.genre_file, self.output_csv, genre_only=True)
+            self.assertEqual(['msd_id', 'magd_genre'], list(pd.read_csv(self.output_csv).columns))
+        finally:
+            merge_genre.CHUNK_SIZE = orig_chunk_size
+
+    def test_several_genres(self):
+        pd.DataFrame({'msd_id': ['TRA', 'TRB', 'TRC'], 'mood': ['sad', 'happy', 'sad']}).to_csv(self.input_csv, index=False)
+        with open(self.genre_file, 'w') as f:
+            f.write('TRC\tRock\nTRA\tPop\nTRC\tBlues\n')
+        # the csv gets a row per genre, like a left merge
+        merge_genre.merge_genres(self.input_csv, self.genre_file, self.output_csv)
+        actual = pd.read_csv(self.output_csv)
+        self.assertEqual(['TRA', 'TRB', 'TRC', 'TRC'], actual.msd_id.tolist())
+        self.assertEqual(['Pop', 'none', 'Rock', 'Blues'], actual.magd_genre.fillna('none').tolist())
+        # the catalog holds one genre per song: the first
+        catalog_dir = 'test_genre_catalog'
+        try:
+            track_catalog.TrackCatalog(catalog_dir).write_group('mxm', pd.DataFrame({'msd_id': ['TRA', 'TRC'], 'msd_artist': ['a', 'c']}))
+            merge_genre.merge_genres_into_catalog(catalog_dir, self.genre_file)
+            actual = track_catalog.TrackCatalog(catalog_dir).read(['msd_id', 'magd_genre'])
+            self.assertEqual(['Pop', 'Rock'], actual.magd_genre.astype(str).tolist())
+        finally:
+            shutil.rmtree(catalog_dir)
+
+    def test_empty_genre_file(self):
+        open(self.genre_file, 'w').close()
+        genres = merge_genre.read_genres(self.genre_file)
+        self.assertEqual(2, pd.isnull(merge_genre.lookup_genres(genres, ['TRA', 'TRB'])).sum())
+
+
+class TestMoodLookup(unittest.TestCase):
+
+    labeled_csv = 'test_labeled.csv'
+
+    def tearDown(self):
+        if os.path.exists(self.labeled_csv):
+            os.remove(self.labeled_csv)
+        if os.path.exists(mood_lookup.index_dir_for(self.labeled_csv)):
+            shutil.rmtree(mood_lookup.index_dir_for(self.labeled_csv))
+
+    def test_lookup(self):
+        pd.DataFrame({
+            'msd_id': ['TRA', 'TRB', 'TRC'],
+            'msd_artist': ['The Beatles', 'Blur', 'Blur'],
+            'msd_title': ['Yesterday', 'Song 2', 'Song 2'],
+            'mood': ['sad', 'happy', 'anger'],
+            'found_tags': [1, 1, 1],
+            'matched_mood': [1, 1, 1],
+            'aggression': [0, 0, 2],
+            'anger': [0, 1, 3]}).to_csv(self.labeled_csv, index=False)
+        lookup = mood_lookup.MoodLookup(self.labeled_csv)
+        actual = lookup.lookup('TRC')
+        self.assertEqual('anger', actual['mood'])
+        self.assertEqual({'aggression': 2, 'anger': 3}, actual['scoreboard'])
+        self.assertIsNone(lookup.lookup('TRZ'))
+        self.assertEqual(['happy', None, 'sad'], [r and r['mood'] for r in lookup.lookup_many(['TRB', 'TRZ', 'TRA'])])
+        # batch reads go through the file front to back
+        read_rows = list()
+        read_row = lookup._read_row
+        lookup._read_row = lambda row: read_rows.append(row) or read_row(row)
+        self.assertEqual(['anger', 'sad', 'happy'], [r['mood'] for r in lookup.lookup_many(['TRC', 'TRA', 'TRB'])])
+        self.assertEqual(sorted(read_rows), read_rows)
+        lookup._read_row = read_row
+        # artist/title lookups are normalized and return every match
+        self.assertEqual(['TRB', 'TRC'], [r['msd_id'] for r in lookup.lookup_song('blur', 'song 2')])
+        self.assertEqual([['TRA']], [[r['msd_id'] for r in rs] for rs in lookup.lookup_songs([('the beatles', 'YESTERDAY')])])
+        lookup.close()
+
+
+class TestSongRegistry(unittest.TestCase):
+
+    registry_dir = 'test_song_registry'
+
+    def tearDown(self):
+        if os.path.exists(self.registry_dir):
+            shutil.rmtree(self.registry_dir)
+
+    def test_encode_and_decode(self):
+        registry = song_registry.SongRegistry(self.registry_dir)
+        # unknown ids are only assigned when registering
+        self.assertEqual([-1, -1], registry.encode(['TRB', 'TRA']).tolist())
+        self.assertEqual([1, 0, 1], registry.encode(['TRB', 'TRA', 'TRB'], register=True).tolist())
+        registry.save()
+        # ids survive a reload and new tracks are appended
+        registry = song_registry.SongRegistry(self.registry_dir)
+        actual = registry.encode(['TRC', 'TRA', 'TRLONGERID'], register=True)
+        self.assertEqual('int32', str(actual.dtype))
+        self.assertEqual([2, 0, 3], actual.tolist())
+        self.assertEqual(['TRB', 'TRLONGERID', 'TRA'], registry.decode([1, 3, 0]).tolist())
+        # ids the registry never assigned never decode to another track
+        self.assertEqual(['', 'TRA', ''], registry.decode([song_registry.UNKNOWN_SONG_ID, 0, 4]).tolist())
+        self.assertEqual(4, len(registry))
+
+    def test_encode_song_ids(self):
+        registry = song_registry.SongRegistry(self.registry_dir)
+        registry.encode(['TRB'], register=True)
+        registry.save()
+        df = pd.DataFrame({'msd_id': ['TRA', 'TRB'], 'msd_artist': ['a', 'b'], 'mood': ['sad', 'happy']})
+        fingerprint = song_registry.SongRegistry(self.registry_dir).fingerprint()
+        actual = mood_classification.encode_song_ids(df, song_registry.SongRegistry(self.registry_dir))
+        self.assertEqual(['msd_id', 'mood', 'song_id'], list(actual.columns))
+        # unregistered tracks get no id of their own but keep their msd_id
+        self.assertEqual([-1, 0], actual.song_id.tolist())
+        self.assertEqual(['TRA', 'TRB'], actual.msd_id.tolist())
+        # the shared registry on disk is only read
+        self.assertEqual(fingerprint, song_registry.SongRegistry(self.registry_dir).fingerprint())
+        registry = song_registry.SongRegistry(self.registry_dir)
+        registry.encode(['TRA'], register=True)
+        self.assertNotEqual(fingerprint, registry.fingerprint())
+
+
+class TestStageCache(unittest.TestCase):
+
+    cache_dir = 'test_stage_cache'
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_stage_cache(self):
+        cache = stage_cache.StageCache(self.cache_dir)
+        self.assertEqual(stage_cache.stage_key('a', x=1, y=[2]), stage_cache.stage_key('a', y=[2], x=1))
+        self.assertNotEqual(stage_cache.stage_key('a', x=1), stage_cache.stage_key('a', x=2))
+        keys = [('a', '1'), ('b', '2'), ('c', '3')]
+        self.assertEqual(set(['a', 'b', 'c']), cache.stale_stages(keys))
+        cache.save('a', '1', {'rows': [1, 2]})
+        cache.save('b', '2', 'b output')
+        self.assertEqual(set(['c']), cache.stale_stages(keys))
+        # forcing a stage recomputes the stages after it
+        self.assertEqual(set(['b', 'c']), cache.stale_stages(keys, forced=set(['b'])))
+        self.assertEqual({'rows': [1, 2]}, cache.load('a', '1'))
+
+    def test_evict(self):
+        cache = stage_cache.StageCache(self.cache_dir)
+        for i, key in enumerate(['old', 'used', 'new']):
+            cache.save('a', key, 'x' * 1000)
+            os.utime(cache._path('a', key), (i, i))
+        # a later run
+        cache = stage_cache.StageCache(self.cache_dir)
+        os.utime(cache._path('a', 'used'), (3, 3))
+        size = os.path.getsize(cache._path('a', 'new'))
+        cache.max_bytes = 2 * size
+        cache.evict()
+        # the least recently used entry goes first
+        self.assertEqual([False, True, True], [cache.has('a', key) for key in ['old', 'used', 'new']])
+        # entries used since a run started, by it or by another run, are never evicted
+        other_run = stage_cache.StageCache(self.cache_dir, max_bytes=0)
+        cache.load('a', 'used')
+        other_run.evict()
+        self.assertEqual([True, False], [cache.has('a', key) for key in ['used', 'new']])
+        cache.max_bytes = 0
+        cache.save('b', 'kept', 'y')
+        self.assertEqual(['a-used.pickle', 'b-kept.pickle', 'cache.lock'], sorted(os.listdir(self.cache_dir)))
+
+    def test_dir_entries(self):
+        cache = stage_cache.StageCache(self.cache_dir)
+        path = cache.save_dir('x_y', '1', lambda path: tensor_store.save_tensors(path, {'x_train': [[1, 2]]}))
+        self.assertTrue(cache.has('x_y', '1'))
+        self.assertEqual(path, cache.load_dir('x_y', '1'))
+        self.assertEqual([path], [entry[0] for entry in cache.entries()])
+        os.utime(path, (0, 0))
+        stage_cache.StageCache(self.cache_dir, max_bytes=0).save('b', 'kept', 'y')
+        self.assertFalse(cache.has('x_y', '1'))
+
+
+    def test_pipeline_stage_keys_of_catalog(self):
+        catalog = track_catalog.TrackCatalog(self.cache_dir)
+        catalog.write_group('mxm', pd.DataFrame({'msd_id': ['TRA'], 'msd_artist': ['a']}))
+        keys = lambda: mood_classification.pipeline_stage_keys(self.cache_dir, 3, True, False, False, False, 100, True)
+        before = keys()
+        self.assertEqual(before, keys())
+        # any write to the catalog changes the dataset key and every key after it
+        catalog.write_group('mxm', pd.DataFrame({'msd_id': ['TRB'], 'msd_artist': ['b']}), replace=False)
+        self.assertTrue(all(old != new for old, new in zip(before, keys())))
+        # low memory mode stores the dataset as a dir and vectorizes it straight into x_y
+        low_memory = mood_classification.pipeline_stage_keys(self.cache_dir, 3, True, False, False, False, 100, True,
+                                                             low_memory_mode=True)
+        self.assertEqual(['dataset', 'lyrics2vec', 'x_y'], [stage for stage, _ in low_memory])
+        self.assertNotEqual(keys()[0], low_memory[0])
+
+
+class TestTensorStore(unittest.TestCase):
+
+    store_dir = 'test_tensor_store'
+
+    def tearDown(self):
+        if os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+
+    def test_save_load(self):
+        x_train = np.array([[1, 2, 3], [4, 5, 0]])
+        y_train = np.array([[0, 1], [1, 0]])
+        tensor_store.save_tensors(self.store_dir, {'x_train': x_train, 'y_train': y_train},
+                                  pickles={'raw_lyrics': ['a', 'b']}, vocab_size=10, word_tokenizer=3)
+        self.assertTrue(tensor_store.has_tensors(self.store_dir))
+        tensors = tensor_store.load_tensors(self.store_dir, vocab_size=10, word_tokenizer=3)
+        self.assertIsInstance(tensors['x_train'], np.memmap)
+        self.assertEqual(np.int32, tensors['x_train'].dtype)
+        self.assertEqual(np.int8, tensors['y_train'].dtype)
+        np.testing.assert_array_equal(x_train, tensors['x_train'])
+        np.testing.assert_array_equal(y_train, tensors['y_train'])
+        self.assertEqual([2, 3], tensor_store.load_manifest(self.store_dir)['arrays']['x_train']['shape'])
+        self.assertEqual(['a', 'b'], tensor_store.load_pickle(self.store_dir, 'raw_lyrics'))
+        self.assertIsNone(tensor_store.load_pickle(self.store_dir, 'missing'))
+        # inputs vectorized with a different vocabulary are refused
+        with self.assertRaises(Exception):
+            tensor_store.load_tensors(self.store_dir, vocab_size=20)
+        # class ids that do not fit the label dtype are refused rather than wrapped
+        with self.assertRaises(Exception):
+            tensor_store.save_tensors(self.store_dir, {'y_train': np.array([3, 200])})
+        # saving again replaces the store
+        del tensors
+        tensor_store.save_tensors(self.store_dir, {'x_train': x_train[:1]})
+        self.assertEqual(['x_train'], list(tensor_store.load_tensors(self.store_dir, mmap_mode=None)))
+        self.assertFalse(os.path.exists(self.store_dir + '.tmp'))
+
+    def test_write_tensors(self):
+        def fill(out):
+            self.assertIsInstance(out['x_dev'], np.memmap)
+            for start in range(0, 5, 2):
+                out['x_dev'][start:start + 2] = start
+        extra = self.store_dir + '_extra'
+        os.makedirs(extra)
+        with open(os.path.join(extra, 'a.txt'), 'w') as f:
+            f.write('a')
+        try:
+            tensor_store.write_tensors(self.store_dir, {'x_dev': (5, 3), 'x_test': (0, 3)}, fill,
+                                       dirs={'extra': extra}, vocab_size=10)
+        finally:
+            shutil.rmtree(extra)
+        tensors = tensor_store.load_tensors(self.store_dir, vocab_size=10)
+        self.assertEqual([0, 0, 2, 2, 4], tensors['x_dev'][:, 0].tolist())
+        self.assertEqual(np.int32, tensors['x_dev'].dtype)
+        self.assertEqual((0, 3), tensors['x_test'].shape)
+        # extra dirs are copied in
+        self.assertEqual(['a.txt'], os.listdir(tensor_store.extra_dir(self.store_dir, 'extra')))
+        self.assertIsNone(tensor_store.extra_dir(self.store_dir, 'missing'))
+
+
+class TestRunStats(unittest.TestCase):
+
+    stats_json = 'test_run_stats.json'
+
+    def tearDown(self):
+        if os.path.exists(self.stats_json):
+            os.remove(self.stats_json)
+
+    def test_run_stats(self):
+        stats = run_stats.RunStats()
+        with stats.stage('dataset') as stage:
+            for rows in [3, 4]:
+                with stats.stage('tokenize') as shard:
+                    shard['rows'] = rows
+                    shard['tokens'] = 10 * rows
+            stage['rows'] = 7
+        counts = stats.begin('train')
+        counts['rows'] = 5
+        stats.end()
+        self.assertEqual(['dataset/tokenize', 'dataset', 'train'], list(stats.stages))
+        # entering a stage again adds to its record
+        tokenize = stats.stages['dataset/tokenize']
+        self.assertEqual((2, 7, 70), (tokenize['calls'], tokenize['rows'], tokenize['tokens']))
+        self.assertGreaterEqual(stats.stages['dataset']['wall_s'], tokenize['wall_s'])
+        self.assertGreaterEqual(stats.stages['dataset']['peak_rss_mb'], tokenize['peak_rss_mb'])
+        stats.save(self.stats_json)
+        with open(self.stats_json, 'r') as f:
+            saved = json.load(f)
+        self.assertEqual(['dataset/tokenize', 'dataset', 'train'], [stage['stage'] for stage in saved['stages']])
+        self.assertEqual(5, saved['stages'][2]['rows'])
+        # a stage that raises is still recorded
+        with self.assertRaises(ValueError):
+            with stats.stage('train'):
+                raise ValueError()
+        self.assertEqual(2, stats.stages['train']['calls'])
+
+
+class TestLyricsLoader(unittest.TestCase):
+
+    lyrics_dir = 'test_lyrics_loader'
+
+    def setUp(self):
+        os.makedirs(self.lyrics_dir, exist_ok=True)
+
+    def tearDown(self):
+        if os.path.exists(self.lyrics_dir):
+            shutil.rmtree(self.lyrics_dir)
+
+    def test_load_lyrics(self):
+        files = {
+            'utf8.txt': 'Caf\u00e9 line 1\r\nline 2\n'.encode('utf-8'),
+            'utf16.txt': 'hello\nworld'.encode('utf-16'),
+            'empty.txt': b'',
+            'cp1252.txt': b'It\x92s over',
+        }
+        for name, data in files.items():
+            with open(os.path.join(self.lyrics_dir, name), 'wb') as f:
+                f.write(data)
+        names = ['utf8.txt', 'missing.txt', 'utf16.txt', 'empty.txt', 'cp1252.txt', 'utf8.txt']
+        paths = [os.path.join(self.lyrics_dir, name) for name in names]
+        lyrics = lyrics_loader.load_lyrics(paths, num_threads=3)
+        expected = ['Caf\u00e9 line 1\nline 2\n', '', 'hello\nworld', '', '', 'Caf\u00e9 line 1\nline 2\n']
+        self.assertEqual([len(files[name]) if name in files else 0 for name in names], lyrics_loader.file_sizes(paths).tolist())
+        self.assertEqual(expected, list(lyrics))
+        self.assertEqual(expected[2], lyrics[2])
+        self.assertEqual(len(names), len(lyrics))
+        self.assertEqual([1], lyrics.missing)
+        self.assertEqual([4], lyrics.undecodable)
+        # the same text as reading each file on its own
+        self.assertEqual(utils.read_file_contents(paths[0])[0], lyrics[0])
+        # slices stay buffers
+        part = lyrics[1:4]
+        self.assertIsInstance(part, lyrics_loader.LyricsBuffer)
+        self.assertEqual(expected[1:4], list(part))
+        self.assertEqual([0], part.missing)
+        self.assertEqual([], list(lyrics[5:2]))
+
+    def test_lyrics_store(self):
+        store_dir = os.path.join(self.lyrics_dir, 'store')
+        writer = lyrics_loader.LyricsStoreWriter(store_dir)
+        writer.append(lyrics_loader.LyricsBuffer('Caf\u00e9\nx', np.array([0, 4, 4, 6])))
+        writer.append(['\u2665 line'])
+        writer.close()
+        store = lyrics_loader.LyricsStore(store_dir)
+        self.assertEqual(['Caf\u00e9', '', '\nx', '\u2665 line'], list(store))
+        self.assertEqual('\nx', store[2])
+        lyrics_loader.LyricsStoreWriter(store_dir).close()
+        self.assertEqual(0, len(lyrics_loader.LyricsStore(store_dir)))
+
+
+class TestLyrics2Vec(unittest.TestCase):
+
+    def test_build_dataset(self):
+        songs = pd.Series([['a', 'b', 'a', '<PAD>'], None, ['c', 'a', 'b', 'd']])
+        corpus = mood_classification.extract_words_from_lyrics(songs)
+        # the corpus can be read more than once
+        self.assertEqual(['a', 'b', 'a', 'c', 'a', 'b', 'd'], list(corpus))
+        self.assertEqual(list(corpus), list(corpus))
+        vectorizer = lyrics2vec.lyrics2vec(3, 3)
+        vectorizer.build_dataset(corpus)
+        self.assertEqual({'UNK': 0, 'a': 1, 'b': 2}, vectorizer.dictionary)
+        self.assertEqual(np.int32, vectorizer.data.dtype)
+        self.assertEqual([1, 2, 1, 0, 1, 2, 0], vectorizer.data.tolist())
+        self.assertEqual(['UNK', 2], vectorizer.count[0])
+
+    def test_build_dataset_from_tokens(self):
+        songs = [['c', 'b', 'a', 'b'], [], ['a', 'd', 'c', 'e', 'a']]
+        expected = lyrics2vec.lyrics2vec(4, 3)
+        expected.build_dataset([w for song in songs for w in song])
+        # interned in a different order than the words appear
+        tokens = ragged_tokens.RaggedTokens.from_lists(songs, vocab=['e', 'd', 'a'])
+        vectorizer = lyrics2vec.lyrics2vec(4, 3)
+        vectorizer.build_dataset(tokens)
+        self.assertEqual(expected.dictionary, vectorizer.dictionary)
+        self.assertEqual(expected.count, vectorizer.count)
+        self.assertEqual(expected.data.tolist(), vectorizer.data.tolist())
+        # ties are broken the same when first occurrences are found chunk by chunk
+        chunk = lyrics2vec.FIRST_OCCURRENCE_CHUNK
+        lyrics2vec.FIRST_OCCURRENCE_CHUNK = 2
+        try:
+            vectorizer.build_dataset(tokens)
+        finally:
+            lyrics2vec.FIRST_OCCURRENCE_CHUNK = chunk
+        self.assertEqual(expected.count, vectorizer.count)
+        self.assertEqual(expected.data.tolist(), vectorizer.data.tolist())
+        # padding is not a word
+        padded = [song + ['<PAD>'] * 2 for song in songs]
+        vectorizer.build_dataset(ragged_tokens.RaggedTokens.from_lists(padded))
+        expected.build_dataset(lyrics2vec.LyricsCorpus(padded))
+        self.assertEqual(expected.count, vectorizer.count)
+        self.assertEqual(expected.data.tolist(), vectorizer.data.tolist())
+
+
+class TestRaggedTokens(unittest.TestCase):
+
+    def test_ragged_tokens(self):
+        songs = [['red', 'green'], [], ['blue', 'red', 'red'], ['green']]
+        tokens = ragged_tokens.RaggedTokens.from_lists(songs)
+        self.assertEqual(['red', 'green', 'blue'], tokens.vocab)
+        self.assertEqual(np.int32, tokens.ids.dtype)
+        self.assertEqual(songs, list(tokens))
+        self.assertEqual([2, 0, 3, 1], tokens.lengths().tolist())
+        # splits are views of the same ids
+        train, dev = tokens.split([3, 1])
+        self.assertIs(tokens.ids, dev.ids)
+        self.assertEqual([['green']], list(dev))
+        self.assertEqual(songs[:3], list(train))
+        joined = ragged_tokens.RaggedTokens.concat([train, dev])
+        self.assertIs(tokens.ids, joined.ids)
+        self.assertEqual(songs, list(joined))
+        self.assertEqual(songs[2:] + songs[:1], list(ragged_tokens.RaggedTokens.concat([train.split([2, 1])[1], dev, train.split([1, 2])[0]])))
+        # containers whose vocabularies grew from one another are joined song by song
+        more = ragged_tokens.RaggedTokens.from_lists([['pink'], ['red', 'pink', 'blue']], list(tokens.vocab))
+        joined = ragged_tokens.RaggedTokens.concat([train, more])
+        self.assertEqual(songs[:3] + [['pink'], ['red', 'pink', 'blue']], list(joined))
+        self.assertIs(more.vocab, joined.vocab)
+        with self.assertRaises(Exception):
+            ragged_tokens.RaggedTokens.concat([more, ragged_tokens.RaggedTokens.from_lists([['blue']])])
+        with self.assertRaises(Exception):
+            tokens.split([1, 1])
+
+    def test_writer(self):
+        store_dir = 'test_ragged_tokens'
+        songs = [['red', 'green'], [], ['blue', 'red', 'red'], ['green'], ['pink']]
+        vocab = list()
+        try:
+            writer = ragged_tokens.RaggedTokensWriter(store_dir)
+            writer.append(ragged_tokens.RaggedTokens.from_lists(songs[:3], vocab))
+            # a part whose vocabulary grew from the one before
+            writer.append(ragged_tokens.RaggedTokens.from_lists(songs[3:], list(vocab)))
+            with self.assertRaises(Exception):
+                writer.append(ragged_tokens.RaggedTokens.from_lists([['blue']]))
+            writer.close()
+            tokens = ragged_tokens.RaggedTokens.load(store_dir)
+            self.assertIsInstance(tokens.ids, np.memmap)
+            self.assertEqual(['red', 'green', 'blue', 'pink'], tokens.vocab)
+            self.assertEqual(songs, list(tokens))
+            self.assertEqual(songs[3:], list(tokens.split([3, 2])[1]))
+            self.assertEqual(songs, list(ragged_tokens.RaggedTokens.load(store_dir, mmap_mode=None)))
+            # an empty container
+            ragged_tokens.RaggedTokensWriter(store_dir).close()
+            self.assertEqual(0, len(ragged_tokens.RaggedTokens.load(store_dir)))
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_pad(self):
+        preprocessor = mood_classification.LyricsPreprocessor(mood_classification.regex_tokenize, remove_stop=False)
+        songs = preprocessor.process(['red green blue red', '', 'blue'])
+        tokens = ragged_tokens.RaggedTokens.from_lists(songs)
+        self.assertEqual([[0, 1, 2], [-1, -1, -1], [2, -1, -1]], tokens.pad(3, pad_id=-1).tolist())
+        # the same ids as vectorizing the padded token lists
+        vectorizer = lyrics2vec.lyrics2vec(10, 3)
+        vectorizer.dictionary = {'UNK': 0, 'blue': 1, 'red': 2, '<PAD>': 3}
+        lookup = np.array([vectorizer.dictionary.get(w, 0) for w in tokens.vocab])
+        expected = [vectorizer.transform(preprocessor.pad(t, 5)) for t in songs]
+        self.assertEqual(expected, tokens.split([1, 2])[0].pad(5, lookup, 3).tolist() +
+                         tokens.split([1, 2])[1].pad(5, lookup, 3).tolist())
+        # transform_batch writes the same rows into the given array, from tokens or padded lists
+        out = np.zeros((4, 5), dtype=np.int32)
+        vectorizer.transform_batch(tokens, out=out[1:])
+        self.assertEqual([[0] * 5] + expected, out.tolist())
+        self.assertEqual(expected, vectorizer.transform_batch([preprocessor.pad(t, 5) for t in songs], 5).tolist())
+        with self.assertRaises(Exception):
+            vectorizer.transform_batch(tokens, out=out)
+
+
+class TestLyricsPreprocessor(unittest.TestCase):
+
+    lyrics = ("[Verse 1] "
+              "Yesterday All my troubles seemed so far away "
+              "Now it looks as though they're here to stay "
+              "Oh, I believe in yesterday... don't you? It's 10:30 o'clock")
+
+    def test_regex_tokenize(self):
+        expected = [
+            '[', 'verse', '1', ']',
+            'yesterday', 'all', 'my', 'troubles', 'seemed', 'so', 'far', 'away',
+            'now', 'it', 'looks', 'as', 'though', 'they', "'re", 'here', 'to', 'stay',
+            'oh', ',', 'i', 'believe', 'in', 'yesterday', '...', 'do', "n't", 'you', '?',
+            'it', "'s", '10:30', "o'clock"]
+        self.assertEqual(expected, mood_classification.regex_tokenize(self.lyrics.lower()))
+        self.assertEqual(3, mood_classification.word_tokenizers[mood_classification.regex_tokenize])
+
+    def test_process(self):
+        preprocessor = mood_classification.LyricsPreprocessor(mood_classification.regex_tokenize, remove_stop=False)
+        self.assertIsInstance(preprocessor.stop, frozenset)
+        actual = preprocessor.process([self.lyrics, 'Hello, hello!'], do_padding=True, cutoff=4)
+        self.assertEqual([['verse', '1', 'yesterday', 'all'], ['hello', 'hello', '<PAD>', '<PAD>']], actual)
+        self.assertEqual(preprocessor.tokenize(self.lyrics),
+                         mood_classification.preprocess_lyrics(self.lyrics, mood_classification.regex_tokenize,
+                                                               remove_stop=False))
+
+    def test_parallel_process(self):
+        preprocessor = mood_classification.LyricsPreprocessor(mood_classification.regex_tokenize)
+        parallel = mood_classification.ParallelLyricsPreprocessor(mood_classification.regex_tokenize, num_workers=2)
+        lyrics_list = ['{0} song number {1}'.format(self.lyrics, i) for i in range(1200)]
+        try:
+            # results keep their input order across chunks and repeated calls
+            self.assertEqual(preprocessor.process(lyrics_list), parallel.process(lyrics_list))
+            self.assertEqual(preprocessor.process(lyrics_list[:3], True, 40), parallel.process(lyrics_list[:3], True, 40))
+            # a lyrics buffer is sent to the workers in chunks of the buffer
+            buffer = lyrics_loader.LyricsBuffer(''.join(lyrics_list), np.cumsum([0] + [len(l) for l in lyrics_list]))
+            self.assertEqual(preprocessor.process(lyrics_list), parallel.process(buffer))
+        finally:
+            parallel.close()
+
+
+class TestPadData(unittest.TestCase):
+
+    def test_pad_data(self):
+        df = pd.DataFrame({
+            'mood': ['sad'] * 7 + ['happy'] * 3 + ['calm'] * 2,
+            'lyrics': ['song {0}\nline a\nline b\nline c'.format(i) for i in range(12)],
+            'song_id': np.arange(12, dtype=np.int32)})
+        padded = mood_classification.pad_data(df)
+        self.assertEqual({'sad': 7, 'happy': 7, 'calm': 7}, padded.groupby('mood').size().to_dict())
+        self.assertEqual(df.lyrics.tolist(), padded.lyrics[:12].tolist())
+        # copies keep their song's lines, in some order
+        for row in padded[12:].itertuples():
+            self.assertEqual(sorted(df.lyrics[row.song_id].split('\n')), sorted(row.lyrics.split('\n')))
+        # happy is copied once in full and then sampled without replacement
+        self.assertEqual([2, 2, 3], sorted(padded[padded.mood == 'happy'].song_id.value_counts().tolist()))
+        # the same seed pads the same way
+        self.assertTrue(padded.equals(mood_classification.pad_data(df)))
+
+    def test_iter_lyrics_shards(self):
+        lyrics_dir = os.path.abspath('test_lyrics_shards')
+        os.makedirs(lyrics_dir, exist_ok=True)
+        df = pd.DataFrame({
+            'mood': ['sad'] * 7 + ['happy'] * 3 + ['calm'] * 2,
+            'lyrics': ['song {0}\nline a\nline b\nline c'.format(i) for i in range(12)],
+            'lyrics_filename': [os.path.join(lyrics_dir, 'song{0}'.format(i)) for i in range(12)]})
+        for row in df.itertuples():
+            with open(row.lyrics_filename + '.txt', 'w') as f:
+                f.write(row.lyrics)
+        try:
+            expected = mood_classification.pad_data(df).lyrics.tolist()
+            # shards of copies read their songs again but shuffle them the same as pad_data
+            # 5 songs of 27 or 28 bytes fit 140 bytes
+            for shard_bytes in [None, 140]:
+                rs = np.random.RandomState(mood_classification.PAD_DATA_SEED)
+                plan = lyrics_cnn.oversample_plan(df.mood.values, rs)
+                shards = list(mood_classification.iter_lyrics_shards(df.drop('lyrics', axis=1), plan, rs, shard_bytes))
+                self.assertEqual(expected, [song for lyrics, _ in shards for song in lyrics])
+                self.assertTrue(all(isinstance(lyrics, lyrics_loader.LyricsBuffer) for lyrics, real in shards if real))
+            self.assertEqual([True, True, True, False, False], [real for _, real in shards])
+            self.assertEqual([5, 5, 2, 5, 4], [len(lyrics) for lyrics, _ in shards])
+        finally:
+            shutil.rmtree(lyrics_dir)
+
+    def test_shard_bounds(self):
+        self.assertEqual([(0, 2), (2, 3), (3, 6)], mood_classification.shard_bounds(np.array([4, 6, 11, 3, 2, 5]), 10))
+        self.assertEqual([], mood_classification.shard_bounds(np.zeros(0, dtype=np.int64), 10))
+
+    def test_line_shuffle_augmenter(self):
+        vectorizer = lyrics2vec.lyrics2vec(10, 3)
+        vectorizer.dictionary = {'UNK': 0, 'red': 1, 'green': 2, 'blue': 3, '<PAD>': 4}
+        preprocessor = mood_classification.LyricsPreprocessor(mood_classification.regex_tokenize)
+        augmenter = mood_classification.LineShuffleAugmenter(['red\ngreen\nblue', 'Blue sky'], preprocessor, vectorizer, 4)
+        copies = augmenter([0, 1, 0])
+        self.assertEqual((3, 4), copies.shape)
+        self.assertEqual([1, 2, 3, 4], sorted(copies[0]))
+        self.assertEqual([3, 0, 4, 4], copies[1].tolist())
+        # the same copies as shuffling the lines of every training song
+        rs = np.random.RandomState(mood_classification.PAD_DATA_SEED)
+        shuffled = mood_classification.shuffle_lines(['red\ngreen\nblue', 'Blue sky'], np.array([0, 1, 0]), rs)
+        self.assertEqual(vectorizer.transform_batch(preprocessor.process(shuffled), 4).tolist(), copies.tolist())
+
+
+class TestVectorizeLyricsDataset(unittest.TestCase):
+
+    store_dir = 'test_vectorized_lyrics'
+
+    def tearDown(self):
+        for path in [self.store_dir, self.store_dir + '_raw']:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def test_vectorize_lyrics_dataset(self):
+        vectorizer = lyrics2vec.lyrics2vec(10, 3)
+        vectorizer.dictionary = {'UNK': 0, 'red': 1, 'green': 2, 'blue': 3}
+        songs = [['red', 'green'], ['blue'], ['green', 'pink', 'red', 'blue'], [], ['red'], ['blue', 'blue']]
+        tokens = ragged_tokens.RaggedTokens.from_lists(songs).split([3, 2, 1])
+        expected = mood_classification.vectorize_lyrics_dataset(tokens, 3, vectorizer)
+        self.assertEqual([[1, 2, 0], [3, 0, 0], [2, 0, 1]], expected[0].tolist())
+        # vectorized a shard at a time into the given matrices
+        out = [np.full((len(df_tokens), 3), -1, dtype=np.int32) for df_tokens in tokens]
+        # rows of 3 int32 ids, 2 at a time
+        xs = mood_classification.vectorize_lyrics_dataset(tokens, 3, vectorizer, shard_bytes=24, out=out)
+        for x, x_expected, x_out in zip(xs, expected, out):
+            self.assertIs(x_out, x)
+            self.assertEqual(x_expected.tolist(), x.tolist())
+
+    def test_save_vectorized_lyrics(self):
+        vectorizer = lyrics2vec.lyrics2vec(10, 3)
+        vectorizer.dictionary = {'UNK': 0, 'red': 1, 'green': 2, 'blue': 3}
+        songs = [['red', 'green'], ['blue'], ['green', 'pink', 'red', 'blue'], [], ['red']]
+        tokens = ragged_tokens.RaggedTokens.from_lists(songs).split([3, 1, 1])
+        dfs = [pd.DataFrame({'mood_cats': cats}) for cats in [[0, 2, 1], [1], [2]]]
+        writer = lyrics_loader.LyricsStoreWriter(self.store_dir + '_raw')
+        writer.append(['red green', 'blue', 'green pink red blue'])
+        writer.close()
+        manifest = mood_classification.save_vectorized_lyrics(self.store_dir, dfs, tokens, 3, vectorizer, 12,
+                                                              self.store_dir + '_raw', vocab_size=10)
+        self.assertEqual(3, manifest['num_classes'])
+        tensors = tensor_store.load_tensors(self.store_dir, vocab_size=10)
+        # the same x and y as split_x_y makes from the vectorized lyrics
+        xs = mood_classification.vectorize_lyrics_dataset(tokens, 3, vectorizer)
+        x_y = mood_classification.split_x_y(dfs[0], dfs[1], dfs[2], xs=xs, sparse_labels=True)
+        for name, expected in zip(tensor_store.X_Y_NAMES, x_y):
+            self.assertEqual(expected.tolist(), tensors[name].tolist())
+        raw_lyrics = tensor_store.extra_dir(self.store_dir, mood_classification.COL_RAW_LYRICS)
+        self.assertEqual(['red green', 'blue', 'green pink red blue'], list(lyrics_loader.LyricsStore(raw_lyrics)))
+
+
+class TestLoadLyricsData(unittest.TestCase):
+
+    input_csv = 'test_load_lyrics_data.csv'
+
+    def tearDown(self):
+        if os.path.exists(self.input_csv):
+            os.remove(self.input_csv)
+
+    def test_load_lyrics_data(self):
+        moods = ['angst', 'upbeat', 'dreamy', 'sad', 'confident', 'cheerful', 'romantic', 'grief']
+        df = pd.DataFrame({
+            'msd_id': ['TR{0}'.format(i) for i in range(8)],
+            'msd_artist': 'artist',
+            'msd_title': 'title',
+            'is_english': [1, 1, 1, 1, 0, 1, 1, 1],
+            'lyrics_available': [1, 1, 1, 1, 1, 0, 1, 1],
+            'wordcount': np.arange(8) * 10,
+            'lyrics_filename': ['f{0}'.format(i) for i in range(8)],
+            'mood': moods,
+            'matched_mood': [1, 1, 1, 1, 1, 1, 1, 0],
+            'extra': 'unused'})
+        df.to_csv(self.input_csv, index=False)
+        actual = mood_classification.load_lyrics_data(self.input_csv, chunksize=3)
+        self.assertEqual(['TR0', 'TR1', 'TR3'], actual.msd_id.tolist())
+        self.assertEqual(['anger', 'happy', 'sad'], actual.mood.tolist())
+        self.assertEqual('category', str(actual.mood.dtype))
+        self.assertEqual(['anger', 'happy', 'sad'], list(actual.mood.cat.categories))
+        self.assertNotIn('is_english', actual.columns)
+        # the same rows as importing the whole csv and filtering it
+        expected = mood_classification.filter_lyrics_data(mood_classification.import_lyrics_data(self.input_csv))
+        self.assertEqual(expected.mood.tolist(), actual.mood.tolist())
+        self.assertEqual(expected.wordcount.tolist(), actual.wordcount.tolist())
+        without_quadrants = mood_classification.load_lyrics_data(self.input_csv, quadrants=False)
+        self.assertEqual(['angst', 'upbeat', 'dreamy', 'sad', 'romantic'], without_quadrants.mood.tolist())
+
+
+class TestSplitXY(unittest.TestCase):
+
+    def test_sparse_labels(self):
+        df = mood_classification.categorize_lyrics_data(pd.DataFrame({'mood': ['sad', 'calm', 'happy', 'sad']}))
+        dfs = [df[:2], df[2:3], df[3:]]
+        xs = [np.zeros((len(d), 2), dtype=np.int32) for d in dfs]
+        one_hot = mood_classification.split_x_y(*dfs, xs=xs)
+        sparse = mood_classification.split_x_y(*dfs, xs=xs, sparse_labels=True)
+        self.assertIs(xs[0], sparse[0])
+        self.assertEqual([2, 0], sparse[1].tolist())
+        self.assertEqual(np.argmax(one_hot[1], axis=1).tolist(), sparse[1].tolist())
+
+
+class TestTokenCache(unittest.TestCase):
+
+    cache_dir = 'test_token_cache'
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def test_process(self):
+        preprocessor = mood_classification.LyricsPreprocessor(mood_classification.regex_tokenize, remove_stop=False)
+        lyrics = ['Hello, hello!', 'Goodbye hello', 'Shuffled copy']
+        cache = token_cache.TokenCache(3, False, True, self.cache_dir)
+        cacheable = set(token_cache.content_hash(l) for l in lyrics[:2])
+        expected = preprocessor.process(lyrics)
+        self.assertEqual(expected, cache.process(preprocessor, lyrics, cacheable))
+        # unsaved entries are served from memory
+        self.assertEqual(['goodbye', 'hello'], cache.get('Goodbye hello'))
+        cache.save()
+        # a new cache with the same configuration reads the saved tokens
+        cache = token_cache.TokenCache(3, False, True, self.cache_dir)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(['hello', 'hello'], cache.get('Hello, hello!'))
+        self.assertIsNone(cache.get('Shuffled copy'))
+        self.assertEqual(expected, cache.process(preprocessor, lyrics))
+        cache.save()
+        self.assertEqual(['shuffled', 'copy'], token_cache.TokenCache(3, False, True, self.cache_dir).get('Shuffled copy'))
+        # the ragged tokens of a cache read the same
+        ragged = token_cache.TokenCache(3, False, True, self.cache_dir).process_ragged(preprocessor, lyrics)
+        self.assertEqual(expected, list(ragged))
+        # other configurations have their own cache
+        self.assertEqual(0, len(token_cache.TokenCache(3, True, True, self.cache_dir)))
+
+    def test_shared_dir(self):
+        preprocessor = mood_classification.LyricsPreprocessor(mood_classification.regex_tokenize, remove_stop=False)
+        # two builds open the same cache and tokenize different songs
+        build_a = token_cache.TokenCache(3, False, True, self.cache_dir)
+        build_b = token_cache.TokenCache(3, False, True, self.cache_dir)
+        build_a.process(preprocessor, ['alpha beta', 'shared song'])
+        build_b.process(preprocessor, ['gamma beta', 'shared song'])
+        build_a.save()
+        build_b.save()
+        # neither save overwrites the other's tokens or vocab
+        for cache in [build_b, token_cache.TokenCache(3, False, True, self.cache_dir)]:
+            self.assertEqual(3, len(cache))
+            self.assertEqual(['alpha', 'beta'], cache.get('alpha beta'))
+            self.assertEqual(['gamma', 'beta'], cache.get('gamma beta'))
+            self.assertEqual(['shared', 'song'], cache.get('shared song'))
+        self.assertEqual(['gamma', 'beta'], list(build_b.process_ragged(preprocessor, ['gamma beta']))[0])
+        self.assertFalse([f for f in os.listdir(build_a.cache_dir) if f.endswith('.tmp')])
 
 
 class TestMoodClassificationDataImport(unittest.TestCase):
@@ -400,6 +1429,74 @@ class TestLyricsCnn(unittest.TestCase):
         actual = self.cnn._build_experiment_name()
         self.assertEqual(expected, actual)
 
+    def test__batch_iter_policy(self):
+        labels = [0] * 5 + [1] * 2 + [2]
+        x = np.repeat(np.arange(8), 3).reshape(8, 3)
+        y = np.eye(3, dtype=np.int8)[labels]
+        # copies are marked by the augmenter with negative ids
+        policy = lyrics_cnn.BalancedBatchPolicy(lambda indices: [np.full(3, -1 - i) for i in indices], seed=1)
+        self.cnn.batch_size = 4
+        batches = self.cnn._batch_iter(x, y, policy=policy)
+        epoch = [pair for _ in range(4) for pair in zip(*next(batches))]
+        self.assertEqual(4, self.cnn.num_batches_per_epoch)
+        self.assertEqual(15, len(epoch))
+        originals = sorted(int(x[0]) for x, _ in epoch if x[0] >= 0)
+        self.assertEqual(list(range(8)), originals)
+        ids = [int(x[0]) if x[0] >= 0 else -1 - int(x[0]) for x, _ in epoch]
+        self.assertEqual([5, 5, 5], np.bincount([labels[i] for i in ids]).tolist())
+        for (x, y), i in zip(epoch, ids):
+            self.assertEqual(labels[i], np.argmax(y))
+
+    def test__batch_iter_sparse_labels(self):
+        labels = np.array([0] * 5 + [1] * 2 + [2], dtype=np.int8)
+        x = np.arange(8).reshape(8, 1)
+        self.cnn.batch_size = 4
+        self.cnn.sparse_labels = True
+        policy = lyrics_cnn.BalancedBatchPolicy(seed=1)
+        batches = self.cnn._batch_iter(x, labels, policy=policy)
+        epoch = [pair for _ in range(4) for pair in zip(*next(batches))]
+        self.assertEqual([5, 5, 5], np.bincount([y for _, y in epoch]).tolist())
+        for x_row, y in epoch:
+            self.assertEqual(labels[x_row[0]], y)
+
+    def test__batch_iter_bucket_batches(self):
+        lengths = np.array([1, 9, 2, 8, 3, 7, 4, 6, 5, 10])
+        x = np.zeros((10, 12), dtype=np.int32)
+        for i, length in enumerate(lengths):
+            x[i, :length] = i + 1
+        self.cnn.batch_size = 3
+        self.cnn.bucket_batches = True
+        batches = self.cnn._batch_iter(x, np.arange(10))
+        epoch = [next(batches) for _ in range(4)]
+        self.assertEqual(4, self.cnn.num_batches_per_epoch)
+        self.assertEqual(list(range(10)), sorted(int(i) for _, y in epoch for i in y))
+        for x_batch, y_batch in epoch:
+            # padded to the longest member but no shorter than the largest filter size
+            self.assertEqual(max(5, lengths[y_batch].max()), x_batch.shape[1])
+            for row, i in zip(x_batch, y_batch):
+                self.assertEqual(x[i, :x_batch.shape[1]].tolist(), row.tolist())
+        # the pool is sorted, so each batch holds neighbouring lengths
+        self.assertEqual([[1, 2, 3], [4, 5, 6], [7, 8, 9], [10]],
+                         sorted(sorted(lengths[y].tolist()) for _, y in epoch))
+
+    def test_sequence_lengths(self):
+        x = np.array([[4, 5, 0, 0], [0, 3, 0, 1], [0, 0, 0, 0], [7, 7, 7, 7]])
+        self.assertEqual([2, 4, 0, 4], lyrics_cnn.sequence_lengths(x).tolist())
+        self.assertEqual([2, 4, 0, 4], lyrics_cnn.sequence_lengths(x, chunk_rows=3).tolist())
+        self.assertEqual([4, 4, 4, 0], lyrics_cnn.sequence_lengths(x, pad_id=7).tolist())
+
+    def test_length_buckets(self):
+        lengths = np.array([5, 1, 4, 2, 3, 9, 8, 7])
+        batches = lyrics_cnn.length_buckets(lengths, 2, np.random.RandomState(0), pool_batches=2)
+        # pools of 4 examples are sorted by length, then the batches are shuffled
+        self.assertEqual([[1, 3], [2, 0], [4, 7], [6, 5]],
+                         sorted(batch.tolist() for batch in batches))
+
+    def test_confusion_matrix(self):
+        confusion = lyrics_cnn.confusion_matrix([0, 0, 1, 2, 2, 2], [0, 1, 1, 2, 2, 0], 4)
+        expected = [[1, 1, 0, 0], [0, 1, 0, 0], [1, 0, 2, 0], [0, 0, 0, 0]]
+        self.assertEqual(expected, confusion.tolist())
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
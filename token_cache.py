@@ -0,0 +1,243 @@
+"""
+Contains the TokenCache class, an on-disk cache of tokenized lyrics.
+
+Tokenizing the corpus is the slowest part of building the lyrics dataset, but it
+only depends on the lyrics and on the tokenizer settings. The cache is keyed by
+the sha1 of each song's lyrics within one directory per tokenizer configuration,
+so rebuilding the dataset (new vocab_size, quadrants, CNN hyperparameters, ...)
+takes its tokens from disk instead of re-tokenizing:
+
+    logs/tf/mood_classification/token_cache/Wt-<tokenizer id>_S-<remove_stop>_P-<remove_punc>/
+        vocab.pickle      list of str, every token seen; a token's id is its position
+        entries.pickle    dict of lyrics sha1 -> (offset, length) into tokens.bin
+        tokens.bin        int32 token ids of every cached song, appended back to back
+        cache.lock        held while the files above are read or written
+
+Builds that share a cache dir may save side by side: a save merges with whatever
+other builds saved since this cache was opened.
+"""
+# project imports
+from ragged_tokens import RaggedTokens
+from lyrics2vec import LOGS_TF_DIR
+from utils import logger, picklify, unpicklify, file_lock
+
+# python and package imports
+import numpy as np
+import hashlib
+import os
+
+
+TOKEN_CACHE_DIR = os.path.join(LOGS_TF_DIR, 'mood_classification', 'token_cache')
+
+
+def content_hash(lyrics):
+    """
+    Returns: bytes, sha1 digest of lyrics
+    """
+    return hashlib.sha1(lyrics.encode('utf-8')).digest()
+
+
+class TokenCache(object):
+    """
+    Persistent map from lyrics to their tokens for one tokenizer configuration
+    """
+
+    def __init__(self, tokenizer_id, remove_stop=True, remove_punc=True, cache_dir=TOKEN_CACHE_DIR):
+        """
+        Args:
+            tokenizer_id: int, id of the word tokenizer (see mood_classification.word_tokenizers)
+            remove_stop: bool, whether the cached tokens have stop words removed
+            remove_punc: bool, whether the cached tokens have punctuation removed
+            cache_dir: str, root dir of all token caches
+        """
+        self.cache_dir = os.path.join(cache_dir, 'Wt-{0}_S-{1}_P-{2}'.format(tokenizer_id, int(remove_stop), int(remove_punc)))
+        self.vocab = list()
+        self.entries = dict()
+        self._saved_len = 0
+        if os.path.exists(self._path('entries.pickle')):
+            with self._lock():
+                self.vocab, self.entries, self._saved_len = self._load_saved()
+        self.word_ids = dict((w, i) for i, w in enumerate(self.vocab))
+        # ids in tokens.bin index the vocab on disk; None while it is the same as self.vocab
+        self._saved_to_vocab = None
+        self._token_ids = None
+        self._pending = list()
+        self._pending_len = 0
+        return
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _lock(self):
+        return file_lock(self._path('cache.lock'))
+
+    def _load_saved(self):
+        """
+        Returns: tuple of (list of str, dict, int), the vocab, entries, and number of token ids on disk
+        """
+        if not os.path.exists(self._path('entries.pickle')):
+            return list(), dict(), 0
+        vocab = unpicklify(self._path('vocab.pickle'))
+        entries = unpicklify(self._path('entries.pickle'))
+        return vocab, entries, os.path.getsize(self._path('tokens.bin')) // 4
+
+    def _save_pickle(self, data, name):
+        # readers never see a partly written pickle
+        tmp = self._path(name + '.tmp')
+        picklify(data, tmp)
+        os.replace(tmp, self._path(name))
+        return
+
+    def _saved_ids(self, offset, length):
+        if self._token_ids is None:
+            self._token_ids = np.memmap(self._path('tokens.bin'), dtype=np.int32, mode='r', shape=(self._saved_len,))
+        ids = self._token_ids[offset:offset + length]
+        if self._saved_to_vocab is not None:
+            ids = self._saved_to_vocab[ids]
+        return ids
+
+    def _entry_ids(self, entry):
+        offset, length = entry
+        if offset >= self._saved_len:
+            return self._pending_ids(offset, length)
+        return self._saved_ids(offset, length)
+
+    def get(self, lyrics, key=None):
+        """
+        Returns: list of str, the cached tokens of lyrics or None on a cache miss
+        """
+        entry = self.entries.get(key if key else content_hash(lyrics))
+        if entry is None:
+            return None
+        vocab = self.vocab
+        return [vocab[i] for i in self._entry_ids(entry).tolist()]
+
+    def _pending_ids(self, offset, length):
+        # unsaved entries are few; find the chunk that holds them
+        start = self._saved_len
+        for _, ids in self._pending:
+            if offset < start + len(ids):
+                return ids[offset - start:offset - start + length]
+            start += len(ids)
+        raise KeyError('token cache offset {0} out of range'.format(offset))
+
+    def put(self, lyrics, tokens, key=None):
+        """
+        Adds tokens of lyrics to the cache (written to disk on save)
+        """
+        key = key if key else content_hash(lyrics)
+        if key in self.entries:
+            return
+        self._put_ids(key, self._intern(tokens))
+        return
+
+    def _intern(self, tokens):
+        ids = np.empty(len(tokens), dtype=np.int32)
+        for i, token in enumerate(tokens):
+            token_id = self.word_ids.get(token)
+            if token_id is None:
+                token_id = len(self.vocab)
+                self.word_ids[token] = token_id
+                self.vocab.append(token)
+            ids[i] = token_id
+        return ids
+
+    def _put_ids(self, key, ids):
+        self.entries[key] = (self._saved_len + self._pending_len, len(ids))
+        self._pending.append((key, ids))
+        self._pending_len += len(ids)
+        return
+
+    def process(self, preprocessor, lyrics_list, cacheable=None):
+        """
+        Tokenizes lyrics_list with preprocessor, taking tokens from the cache where possible
+
+        Args:
+            preprocessor: mood_classification.LyricsPreprocessor, matching this cache's configuration
+            lyrics_list: iterable of str
+            cacheable: set of bytes, only lyrics whose content_hash is in this set are
+                added to the cache (default: all)
+
+        Returns: list of list of str
+        """
+        return list(self.process_ragged(preprocessor, lyrics_list, cacheable))
+
+    def process_ragged(self, preprocessor, lyrics_list, cacheable=None):
+        """
+        Like process, but the tokens stay ids into (a copy of) the cache's vocab
+
+        Cached songs are copied straight from tokens.bin without being turned back into strings.
+
+        Returns: ragged_tokens.RaggedTokens
+        """
+        results = list()
+        misses = list()
+        for lyrics in lyrics_list:
+            key = content_hash(lyrics)
+            entry = self.entries.get(key)
+            if entry is None:
+                misses.append((len(results), lyrics, key))
+                results.append(None)
+            else:
+                results.append(self._entry_ids(entry))
+        # misses are tokenized in one batch so a parallel preprocessor can spread them out
+        missed_tokens = preprocessor.process([lyrics for _, lyrics, _ in misses]) if misses else list()
+        for (i, lyrics, key), tokens in zip(misses, missed_tokens):
+            # songs that are not cacheable are still interned, they just get no entry
+            results[i] = self._intern(tokens)
+            if (cacheable is None or key in cacheable) and key not in self.entries:
+                self._put_ids(key, results[i])
+        logger.info('token cache: {0} of {1} songs cached'.format(len(results) - len(misses), len(results)))
+        return RaggedTokens.from_arrays(list(self.vocab), results)
+
+    def save(self):
+        """
+        Appends the token ids added since the last save and rewrites the vocab and entries
+
+        Another build may have saved to the same dir since this cache was opened, so the
+        files are re-read under the lock and this cache's songs are added to them: new
+        tokens are appended to the vocab on disk and new songs to the end of tokens.bin.
+        """
+        if not self._pending:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock():
+            saved_vocab, saved_entries, saved_len = self._load_saved()
+            saved_word_ids = dict((w, i) for i, w in enumerate(saved_vocab))
+            vocab_to_saved = np.empty(len(self.vocab), dtype=np.int32)
+            for i, token in enumerate(self.vocab):
+                token_id = saved_word_ids.get(token)
+                if token_id is None:
+                    token_id = len(saved_vocab)
+                    saved_word_ids[token] = token_id
+                    saved_vocab.append(token)
+                vocab_to_saved[i] = token_id
+            with open(self._path('tokens.bin'), 'ab') as f:
+                for key, ids in self._pending:
+                    if key in saved_entries:
+                        continue
+                    saved_entries[key] = (saved_len, len(ids))
+                    f.write(vocab_to_saved[ids].tobytes())
+                    saved_len += len(ids)
+            self._save_pickle(saved_vocab, 'vocab.pickle')
+            # entries last: an interrupted save leaves entries pointing only at data that was written
+            self._save_pickle(saved_entries, 'entries.pickle')
+        # tokens saved by other builds join this cache's vocab
+        self._intern(saved_vocab)
+        saved_to_vocab = np.array([self.word_ids[token] for token in saved_vocab], dtype=np.int32)
+        same = len(saved_to_vocab) == len(self.vocab) and (saved_to_vocab == np.arange(len(self.vocab))).all()
+        self._saved_to_vocab = None if same else saved_to_vocab
+        self.entries = saved_entries
+        self._saved_len = saved_len
+        self._pending = list()
+        self._pending_len = 0
+        self._token_ids = None
+        logger.info('token cache: {0} songs, {1} tokens, {2} distinct in {3}'.format(
+            len(self.entries), self._saved_len, len(self.vocab), self.cache_dir))
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return '<TokenCache(dir={0}, songs={1})>'.format(self.cache_dir, len(self))
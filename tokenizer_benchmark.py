@@ -0,0 +1,149 @@
+"""
+Benchmarks the word tokenizers in mood_classification.word_tokenizers on the sample
+lyrics in data/lyrics/txt and reports how closely each one agrees with word_tokenize,
+the tokenizer our published models were trained with.
+
+For each tokenizer the report has:
+
+    raw s       best time to tokenize the corpus (no stop word or punctuation removal)
+    full s      best time for LyricsPreprocessor.process with stop words and punctuation removed
+    agreement   tokens shared with word_tokenize / tokens in the longer of the two outputs
+    identical   share of songs tokenized exactly like word_tokenize
+
+followed by the tokens each tokenizer most often disagrees on.
+
+Recommended Command:
+
+    python tokenizer_benchmark.py
+
+Output: report in the log
+"""
+# project imports
+from mood_classification import word_tokenizers_ids, LyricsPreprocessor, prep_nltk
+from lyrics_loader import load_lyrics
+from scrape_lyrics import LYRICS_TXT_DIR
+from utils import configure_logging, logger
+
+# python and package imports
+from collections import Counter
+import argparse
+import time
+import glob
+import os
+
+
+REFERENCE_TOKENIZER_ID = 1
+
+
+def load_corpus(lyrics_dir=LYRICS_TXT_DIR, limit=None):
+    """
+    Returns: list of str, the lyrics of every txt file in lyrics_dir (up to limit songs)
+    """
+    paths = sorted(glob.glob(os.path.join(lyrics_dir, '*.txt')))
+    if limit:
+        paths = paths[:limit]
+    # unreadable files come back empty
+    return [lyrics for lyrics in load_lyrics(paths) if lyrics]
+
+
+def token_agreement(reference, candidate):
+    """
+    Compares two tokenizations of the same corpus
+
+    Args:
+        reference: list of list of str
+        candidate: list of list of str
+
+    Returns:
+        agreement: float, shared tokens / tokens in the longer output, summed over songs
+        identical: float, share of songs with identical tokens
+        disagreements: Counter, tokens only one of the two produced
+    """
+    shared = 0
+    total = 0
+    identical = 0
+    disagreements = Counter()
+    for ref, cand in zip(reference, candidate):
+        identical += ref == cand
+        ref_counts = Counter(ref)
+        cand_counts = Counter(cand)
+        shared += sum((ref_counts & cand_counts).values())
+        total += max(len(ref), len(cand))
+        disagreements.update(ref_counts - cand_counts)
+        disagreements.update(cand_counts - ref_counts)
+    return shared / max(total, 1), identical / max(len(reference), 1), disagreements
+
+
+def best_time(func, repeat):
+    """
+    Returns: (float, result), fastest of <repeat> runs of func and its result
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_tokenizers(corpus, repeat=3, top=10):
+    """
+    Runs the benchmark and logs the report
+
+    Returns: dict of tokenizer id to dict of results
+    """
+    lowered = [lyrics.lower() for lyrics in corpus]
+    reference = None
+    results = dict()
+    for tokenizer_id in sorted(i for i in word_tokenizers_ids if i):
+        tokenizer = word_tokenizers_ids[tokenizer_id]
+        raw_s, tokens = best_time(lambda: [tokenizer(lyrics) for lyrics in lowered], repeat)
+        preprocessor = LyricsPreprocessor(tokenizer)
+        full_s, _ = best_time(lambda: preprocessor.process(corpus), repeat)
+        if tokenizer_id == REFERENCE_TOKENIZER_ID:
+            reference = tokens
+        results[tokenizer_id] = {'raw_s': raw_s, 'full_s': full_s, 'tokens': tokens}
+
+    logger.info('{0} songs, {1} word_tokenize tokens'.format(len(corpus), sum(len(t) for t in reference)))
+    logger.info('{0:>3} {1:>8} {2:>8} {3:>10} {4:>10}'.format('id', 'raw s', 'full s', 'agreement', 'identical'))
+    for tokenizer_id, result in sorted(results.items()):
+        agreement, identical, disagreements = token_agreement(reference, result.pop('tokens'))
+        result.update({'agreement': agreement, 'identical': identical, 'disagreements': disagreements.most_common(top)})
+        logger.info('{0:>3} {1:>8.3f} {2:>8.3f} {3:>10.4f} {4:>10.4f}'.format(
+            tokenizer_id, result['raw_s'], result['full_s'], agreement, identical))
+    for tokenizer_id, result in sorted(results.items()):
+        if tokenizer_id != REFERENCE_TOKENIZER_ID:
+            logger.info('tokenizer {0} most common disagreements: {1}'.format(tokenizer_id, result['disagreements']))
+    return results
+
+
+def parse_args():
+
+    # parse args
+    parser = argparse.ArgumentParser()
+
+    # universal args
+    parser.add_argument('-d', '--lyrics-dir', action='store', required=False, default=LYRICS_TXT_DIR, help='dir of lyrics txt files to benchmark on')
+    parser.add_argument('-n', '--num-songs', action='store', type=int, required=False, default=None, help='only use the first n songs')
+    parser.add_argument('-r', '--repeat', action='store', type=int, required=False, default=3, help='times to run each tokenizer (the best time is reported)')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    configure_logging(logname='tokenizer_benchmark')
+    args = parse_args()
+    prep_nltk()
+    corpus = load_corpus(args.lyrics_dir, args.num_songs)
+    benchmark_tokenizers(corpus, args.repeat)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,452 @@
+"""
+The track catalog is a single store for everything the pipeline knows about each
+track. It replaces passing whole CSVs from stage to stage.
+
+Groups are keyed by the int32 song_id of the catalog's song registry (see
+song_registry.py); msd_id is only decoded when a reader asks for it.
+
+Each stage owns one column group and only ever writes that group:
+
+    mxm    - musixmatch mapping columns (see scrape_lyrics.CSV_HEADER)
+    index  - columns added by index_lyrics.py
+    label  - mood, found_tags, matched_mood and the mood scoreboard from label_lyrics.py
+    genre  - magd_genre from merge_genre.py
+
+Every group is partitioned by the first letter of the track's msd_artist (digits
+get their own partitions, everything else shares "_"), the same split the
+--artist-first-letter flag of each stage uses. A sharded run reads and rewrites
+only its own partition's files and never loads the rest of the catalog. The files
+every shard shares (the song registry, song_partitions.npy and the manifest) are
+re-read and rewritten under catalog.lock, so shards can write side by side.
+
+Within a partition every column is stored in its own gzipped pickle so dtypes
+survive the round trip and readers only load the columns they ask for:
+
+    data/catalog/manifest.json
+    data/catalog/catalog.lock
+    data/catalog/song_partitions.npy          partition of each song_id
+    data/catalog/song_registry/msd_ids.npy
+    data/catalog/<group>/<partition>/song_id.pkl.gz
+    data/catalog/<group>/<partition>/<column>.pkl.gz
+
+Use this script to import an existing csv (mxm_mappings.csv, indexed_lyrics.csv,
+labeled_lyrics_expanded.csv, ...) into the catalog.
+
+Recommended Command:
+
+    python track_catalog.py -i data/mxm_mappings.csv
+
+Output: data/catalog
+"""
+# project imports
+from download_data import DATA_DIR
+from song_registry import SongRegistry, SONG_ID_COL, UNKNOWN_SONG_ID
+from utils import configure_logging, logger, file_lock
+
+# python and package imports
+import pandas as pd
+import numpy as np
+import datetime
+import argparse
+import string
+import shutil
+import json
+import os
+
+
+CATALOG_DIR = os.path.join(DATA_DIR, 'catalog')
+CATALOG_MANIFEST = 'manifest.json'
+CATALOG_LOCK = 'catalog.lock'
+PARTITIONS_FILE = 'song_partitions.npy'
+PARTITION_CHARS = string.ascii_lowercase + string.digits
+OTHER_PARTITION = '_'
+ARTIST_COL = 'msd_artist'
+KEY_COL = 'msd_id'
+MXM_GROUP = 'mxm'
+INDEX_GROUP = 'index'
+LABEL_GROUP = 'label'
+GENRE_GROUP = 'genre'
+COLUMN_GROUPS = {
+    MXM_GROUP: ['msd_artist', 'msd_title', 'mxm_id', 'mxm_artist', 'mxm_title'],
+    INDEX_GROUP: ['is_english', 'lyrics_available', 'wordcount', 'lyrics_filename'],
+    LABEL_GROUP: ['mood', 'found_tags', 'matched_mood'],
+    GENRE_GROUP: ['magd_genre'],
+}
+# columns a stage reads back and fills in row by row (index_lyrics.py) are stored as
+# they are; a downcast int or categorical could not take the values written later
+UPDATED_IN_PLACE = COLUMN_GROUPS[INDEX_GROUP]
+
+
+def artist_partitions(artists):
+    """
+    Maps artist names to their partition: the lowercased first character of the name
+    when it is a letter or digit, otherwise OTHER_PARTITION
+
+    Args:
+        artists: pd.Series of str
+
+    Returns: pd.Series of str
+    """
+    first = artists.astype(object).fillna('').astype(str).str[:1].str.lower()
+    return first.where(first.isin(list(PARTITION_CHARS)), OTHER_PARTITION)
+
+
+def artist_partition(artist_first_letter):
+    """
+    Returns: str, the single partition holding every artist that starts with artist_first_letter
+    """
+    return artist_partitions(pd.Series([artist_first_letter])).iloc[0]
+
+
+def compact_series(series):
+    """
+    Chooses a compact dtype for a column before it is stored
+
+    * low cardinality strings become categoricals
+    * integers are downcast to the smallest int type that holds them
+    * floats are downcast to float32 when that is lossless
+
+    Returns: pd.Series
+    """
+    if series.dtype == object:
+        if len(series) > 0 and series.nunique() < len(series) / 2:
+            return series.astype('category')
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series):
+        downcast = series.astype('float32')
+        if downcast.astype(series.dtype).equals(series):
+            return downcast
+    return series
+
+
+def widest_dtype(dtype, other):
+    """
+    Returns: str, a dtype that holds the values of both dtypes: the wider of two numeric
+        dtypes or object if they otherwise differ
+    """
+    if dtype == other:
+        return dtype
+    try:
+        if all(np.issubdtype(np.dtype(d), np.number) for d in (dtype, other)):
+            return str(np.promote_types(dtype, other))
+    except TypeError:
+        # category
+        pass
+    return 'object'
+
+
+class TrackCatalog(object):
+    """
+    Columnar store of track data keyed by song_id and partitioned by artist
+    """
+
+    def __init__(self, root=CATALOG_DIR):
+        self.root = root
+        self.registry = SongRegistry(os.path.join(root, 'song_registry'))
+        self.manifest = {'groups': dict()}
+        self._load_manifest()
+        self._load_song_partitions()
+        return
+
+    def _lock(self):
+        return file_lock(os.path.join(self.root, CATALOG_LOCK))
+
+    def _load_manifest(self):
+        manifest_path = os.path.join(self.root, CATALOG_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        return
+
+    def _save_manifest(self):
+        os.makedirs(self.root, exist_ok=True)
+        manifest_path = os.path.join(self.root, CATALOG_MANIFEST)
+        tmp = manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp, manifest_path)
+        return
+
+    def _load_song_partitions(self):
+        partitions_path = os.path.join(self.root, PARTITIONS_FILE)
+        if os.path.exists(partitions_path):
+            self.song_partitions = np.load(partitions_path)
+        else:
+            self.song_partitions = np.zeros(0, dtype='S1')
+        return
+
+    def _save_song_partitions(self):
+        os.makedirs(self.root, exist_ok=True)
+        partitions_path = os.path.join(self.root, PARTITIONS_FILE)
+        tmp = partitions_path + '.tmp.npy'
+        np.save(tmp, self.song_partitions)
+        os.replace(tmp, partitions_path)
+        return
+
+    def _partition_dir(self, group, partition):
+        return os.path.join(self.root, group, partition)
+
+    def _column_path(self, group, partition, col):
+        return os.path.join(self._partition_dir(group, partition), '{0}.pkl.gz'.format(col))
+
+    def groups(self):
+        """
+        Returns: list of str, groups in the order they were first written
+        """
+        return list(self.manifest['groups'].keys())
+
+    def has_group(self, group):
+        return group in self.manifest['groups']
+
+    def columns(self, group=None):
+        """
+        Returns: list of str, non-key columns of group (or of the whole catalog)
+        """
+        groups = [group] if group else self.groups()
+        cols = list()
+        for g in groups:
+            cols += [c for c in self.manifest['groups'][g]['columns'] if c not in cols]
+        return cols
+
+    def group_of(self, col):
+        for group in self.groups():
+            if col in self.manifest['groups'][group]['columns']:
+                return group
+        raise KeyError('column {0} is not in the track catalog at {1}'.format(col, self.root))
+
+    def partitions(self, group):
+        """
+        Returns: list of str, the partitions group has been written for
+        """
+        group_dir = os.path.join(self.root, group)
+        if not os.path.isdir(group_dir):
+            return list()
+        return sorted(p for p in os.listdir(group_dir) if os.path.exists(self._column_path(group, p, SONG_ID_COL)))
+
+    def partition_of(self, song_ids):
+        """
+        Looks up the artist partition of each song; songs the catalog has no artist for go to '_'
+
+        Returns: np.array of str
+        """
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        partitions = np.full(len(song_ids), OTHER_PARTITION.encode(), dtype='S1')
+        known = song_ids < len(self.song_partitions)
+        partitions[known] = self.song_partitions[song_ids[known]]
+        return partitions.astype(str)
+
+    def read_group(self, group, columns=None, partitions=None):
+        """
+        Reads song_id plus the requested columns of a single group
+
+        Args:
+            group: str, name of the column group
+            columns: list of str, columns to load (default: all of the group's)
+            partitions: list of str, only read these artist partitions (default: all)
+
+        Returns: pd.DataFrame
+        """
+        if columns is None:
+            columns = self.columns(group)
+        available = self.partitions(group)
+        if partitions is not None:
+            available = [p for p in available if p in partitions]
+        frames = list()
+        for partition in available:
+            data = {SONG_ID_COL: pd.read_pickle(self._column_path(group, partition, SONG_ID_COL))}
+            for col in columns:
+                series = pd.read_pickle(self._column_path(group, partition, col))
+                # partitions compact their columns on their own, so bring each up to the group's dtype
+                dtype = self.manifest['groups'][group]['columns'].get(col)
+                if dtype and dtype != str(series.dtype) and widest_dtype(dtype, str(series.dtype)) == dtype:
+                    series = series.astype(dtype)
+                data[col] = series
+            frames.append(pd.DataFrame(data, columns=[SONG_ID_COL] + list(columns)))
+        if not frames:
+            empty = pd.DataFrame({SONG_ID_COL: np.zeros(0, dtype=np.int32)})
+            return empty.reindex(columns=[SONG_ID_COL] + list(columns))
+        return pd.concat(frames, ignore_index=True, sort=False)
+
+    def read(self, columns=None, partitions=None):
+        """
+        Reads song_id plus the requested columns, loading only the files that hold them.
+        Groups are joined on song_id, anchored on the earliest-written group requested.
+        msd_id is decoded from the song registry only if it is one of the columns.
+
+        Args:
+            columns: list of str, columns to load (default: all, including msd_id)
+            partitions: list of str, only read these artist partitions (default: all);
+                see artist_partition
+
+        Returns: pd.DataFrame
+        """
+        if columns is None:
+            columns = [KEY_COL] + self.columns()
+        with_msd_id = KEY_COL in columns
+        columns = [c for c in columns if c not in (KEY_COL, SONG_ID_COL)]
+        by_group = dict()
+        for col in columns:
+            by_group.setdefault(self.group_of(col), list()).append(col)
+        df = None
+        for group in self.groups():
+            if group not in by_group:
+                continue
+            group_df = self.read_group(group, by_group[group], partitions)
+            df = group_df if df is None else df.merge(group_df, how='left', on=SONG_ID_COL)
+        if df is None:
+            # only the key was requested
+            df = self.read_group(self.groups()[0], [], partitions)
+        keys = [SONG_ID_COL]
+        if with_msd_id:
+            df[KEY_COL] = self.registry.decode(df[SONG_ID_COL].values)
+            keys = [KEY_COL] + keys
+        logger.debug('read {0} from track catalog {1} (partitions={2})'.format(df.shape, self.root, partitions))
+        return df[keys + columns]
+
+    def write_group(self, group, df, replace=True):
+        """
+        Writes a stage's column group. Other groups are never touched.
+
+        Args:
+            group: str, name of the column group
+            df: pd.DataFrame, song_id or msd_id plus the group's columns; msd ids that
+                are new to the catalog are registered
+            replace: bool, if True, the group is replaced by df; if False, only the
+                artist partitions df has rows in are read and rewritten: rows of df
+                replace rows with the same song_id and new rows are appended
+
+        Returns: None
+        """
+        if SONG_ID_COL not in df.columns and KEY_COL not in df.columns:
+            raise KeyError('{0} or {1} column is required to write to the track catalog'.format(SONG_ID_COL, KEY_COL))
+        # sharded jobs register songs too, so extend the latest registry and partitions on disk
+        with self._lock():
+            self.registry = SongRegistry(self.registry.registry_dir)
+            self._load_song_partitions()
+            if SONG_ID_COL not in df.columns:
+                df = df.assign(**{SONG_ID_COL: self.registry.encode(df[KEY_COL], register=True)})
+                self.registry.save()
+            df = df[df[SONG_ID_COL] != UNKNOWN_SONG_ID].drop(KEY_COL, axis=1, errors='ignore')
+            if ARTIST_COL in df.columns:
+                # the artist decides which partition every group stores the song in
+                partitions = np.full(len(self.registry), OTHER_PARTITION.encode(), dtype='S1')
+                partitions[:len(self.song_partitions)] = self.song_partitions
+                partitions[df[SONG_ID_COL].values] = artist_partitions(df[ARTIST_COL]).values.astype('S1')
+                self.song_partitions = partitions
+                self._save_song_partitions()
+        df = df.assign(_partition=self.partition_of(df[SONG_ID_COL].values))
+        columns = [c for c in df.columns if c not in (SONG_ID_COL, '_partition')]
+
+        self._load_manifest()
+        stale = list()
+        if replace:
+            stale = [p for p in self.partitions(group) if p not in set(df._partition)]
+        dtypes = dict()
+        for partition, part_df in df.groupby('_partition', sort=True):
+            part_df = part_df.drop('_partition', axis=1)
+            if not replace and partition in self.partitions(group):
+                old = self.read_group(group, partitions=[partition])
+                old = old[~old[SONG_ID_COL].isin(part_df[SONG_ID_COL])]
+                part_df = pd.concat([old, part_df], ignore_index=True, sort=False)
+            for col, dtype in self._write_partition(group, partition, part_df).items():
+                dtypes[col] = widest_dtype(dtypes.get(col, dtype), dtype)
+        for partition in stale:
+            shutil.rmtree(self._partition_dir(group, partition))
+
+        # sharded jobs rewrite the manifest too, so update the latest copy on disk
+        with self._lock():
+            self._load_manifest()
+            if not replace and self.has_group(group):
+                # the partitions this write did not touch keep their dtypes
+                for col, dtype in self.manifest['groups'][group]['columns'].items():
+                    if col in dtypes:
+                        dtypes[col] = widest_dtype(dtypes[col], dtype)
+            self.manifest['groups'][group] = {
+                'columns': dict((c, dtypes.get(c, 'object')) for c in columns),
+                'updated': datetime.datetime.now().isoformat(),
+            }
+            self._save_manifest()
+        logger.info('wrote {0} rows x {1} cols to track catalog group "{2}"'.format(len(df), len(columns), group))
+        return
+
+    def _write_partition(self, group, partition, df):
+        """
+        Writes every column of one partition of a group
+
+        Returns: dict of column name to dtype str
+        """
+        df = df.drop_duplicates(subset=SONG_ID_COL, keep='last').reset_index(drop=True)
+        partition_dir = self._partition_dir(group, partition)
+        os.makedirs(partition_dir, exist_ok=True)
+        dtypes = dict()
+        for col in df.columns:
+            # song ids stay int32 in every group so joins never need a cast
+            if col == SONG_ID_COL:
+                series = df[col].astype('int32')
+            elif col in UPDATED_IN_PLACE:
+                series = df[col]
+            else:
+                series = compact_series(df[col])
+            series.to_pickle(self._column_path(group, partition, col), compression='gzip')
+            dtypes[col] = str(series.dtype)
+        # drop columns that the stage no longer produces
+        for filename in os.listdir(partition_dir):
+            if filename[:-len('.pkl.gz')] not in dtypes:
+                os.remove(os.path.join(partition_dir, filename))
+        return dtypes
+
+    def __repr__(self):
+        return '<TrackCatalog(root={0}, groups={1})>'.format(self.root, self.groups())
+
+
+def import_csv(csv_input, root=CATALOG_DIR):
+    """
+    Splits an existing pipeline csv into the catalog's column groups. Columns that
+    do not belong to a known group (such as the mood scoreboard) go to the label group.
+
+    Args:
+        csv_input: str, csv with a msd_id column
+        root: str, catalog dir
+
+    Returns: TrackCatalog
+    """
+    logger.info('Importing {0} into track catalog {1}'.format(csv_input, root))
+    df = pd.read_csv(csv_input, encoding='utf-8', dtype={'msd_artist': str, 'msd_title': str})
+    catalog = TrackCatalog(root)
+    known = [c for cols in COLUMN_GROUPS.values() for c in cols] + [KEY_COL, SONG_ID_COL]
+    for group, cols in COLUMN_GROUPS.items():
+        cols = [c for c in cols if c in df.columns]
+        if group == LABEL_GROUP and cols:
+            cols += [c for c in df.columns if c not in known]
+        if cols:
+            catalog.write_group(group, df[[KEY_COL] + cols])
+    return catalog
+
+
+def parse_args():
+
+    # parse args
+    parser = argparse.ArgumentParser()
+
+    # universal args
+    parser.add_argument('-i', '--csv-input', action='store', required=True, help='pipeline csv to import')
+    parser.add_argument('-c', '--catalog-dir', action='store', required=False, default=CATALOG_DIR, help='track catalog dir')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+
+    configure_logging(logname='track_catalog')
+    args = parse_args()
+    import_csv(args.csv_input, args.catalog_dir)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
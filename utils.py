@@ -1,3 +1,4 @@
+import contextlib
 import datetime
 import logging
 import pickle
@@ -5,6 +6,12 @@ import time
 import json
 import os
 
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +54,31 @@ def full_elapsed_time_str(start):
     return 'Elapsed Time: {0}'.format(elapsed_time_str(start))
 
 
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on path (created if missing) for the with block, so that
+    processes sharing a file on disk take turns reading and rewriting it. Where file
+    locks are unavailable (windows) the block runs unlocked.
+
+    Args:
+        path: str, lock file
+
+    Yields: None
+    """
+    lock_dir = os.path.dirname(path)
+    if lock_dir:
+        os.makedirs(lock_dir, exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 def picklify(data, dest):
     """
     Helper function to save variables as pickle files to be reloaded by python later